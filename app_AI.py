@@ -8,15 +8,35 @@ import openai
 from openai import OpenAI
 import base64
 import gspread
-from datetime import datetime
+from gspread.utils import ValueRenderOption, DateTimeOption
+from google.auth.exceptions import RefreshError
+from requests.exceptions import RequestException
+from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
 import time
+import threading
+import heapq
+import math
+import random
 from dateutil import parser
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Tuple, Dict, Any, Optional, Iterable, Iterator
 import hashlib
+import copy
+import sqlite3
+from contextlib import closing
 import json
 import unicodedata
 import jellyfish  # Pour la distance de Jaro-Winkler
+try:
+    import cv2  # opencv-python-headless : recadrage et prétraitement rapides
+except ImportError:
+    cv2 = None
+try:
+    import pypdfium2 as pdfium  # rastérisation locale des PDF scannés
+except ImportError:
+    pdfium = None
 
 # ============================================================
 # STANDARDISATION INTELLIGENTE DES PRODUITS - MIS À JOUR
@@ -774,6 +794,8 @@ if "duplicate_action" not in st.session_state:
     st.session_state.duplicate_action = None
 if "duplicate_rows" not in st.session_state:
     st.session_state.duplicate_rows = []
+if "sheet_snapshot" not in st.session_state:
+    st.session_state.sheet_snapshot = None
 if "data_for_sheets" not in st.session_state:
     st.session_state.data_for_sheets = None
 if "edited_standardized_df" not in st.session_state:
@@ -782,6 +804,8 @@ if "export_triggered" not in st.session_state:
     st.session_state.export_triggered = False
 if "export_status" not in st.session_state:
     st.session_state.export_status = None
+if "sheets_batch_mode" not in st.session_state:
+    st.session_state.sheets_batch_mode = False
 if "image_preview_visible" not in st.session_state:
     st.session_state.image_preview_visible = False
 if "document_scanned" not in st.session_state:
@@ -798,6 +822,30 @@ if "nom_magasin_ulys" not in st.session_state:
     st.session_state.nom_magasin_ulys = ""
 if "fact_manuscrit" not in st.session_state:
     st.session_state.fact_manuscrit = ""
+if "last_vision_call" not in st.session_state:
+    st.session_state.last_vision_call = None
+if "vision_cascade" not in st.session_state:
+    st.session_state.vision_cascade = {}
+if "processed_image_bytes" not in st.session_state:
+    st.session_state.processed_image_bytes = None
+if "field_repair_info" not in st.session_state:
+    st.session_state.field_repair_info = None
+if "image_crop_info" not in st.session_state:
+    st.session_state.image_crop_info = None
+if "fact_crop_info" not in st.session_state:
+    st.session_state.fact_crop_info = None
+if "disambiguation_info" not in st.session_state:
+    st.session_state.disambiguation_info = None
+if "ocr_replay" not in st.session_state:
+    st.session_state.ocr_replay = None
+if "replay_info" not in st.session_state:
+    st.session_state.replay_info = None
+if "image_quality" not in st.session_state:
+    st.session_state.image_quality = None
+if "multi_photo_quality" not in st.session_state:
+    st.session_state.multi_photo_quality = {}
+if "analysis_coalesced" not in st.session_state:
+    st.session_state.analysis_coalesced = False
 
 # ============================================================
 # FONCTION DE NORMALISATION DES PRODUITS (COMPATIBILITÉ)
@@ -1782,6 +1830,34 @@ def normalize_document_type(doc_type: str) -> str:
 # ============================================================
 # OPENAI CONFIGURATION
 # ============================================================
+def get_openai_setting(name: str, default: Any = None) -> Any:
+    """Lit un réglage OpenAI dans st.secrets["openai"], puis dans la variable d'environnement OPENAI_<NAME>"""
+    try:
+        if "openai" in st.secrets and name in st.secrets["openai"]:
+            return st.secrets["openai"][name]
+    except Exception:
+        pass
+    return os.environ.get(f"OPENAI_{name.upper()}", default)
+
+# Cascade de modèles : modèle Vision rapide d'abord, GPT-4o uniquement si la validation échoue
+VISION_MODEL_FAST = get_openai_setting("fast_model", "gpt-4o-mini")
+VISION_MODEL_FULL = get_openai_setting("full_model", "gpt-4o")
+VISION_MAX_TOKENS = 4000
+VISION_CASCADE_ENABLED = str(get_openai_setting("cascade", "1")).lower() not in ["0", "false", "non"]
+VISION_CASCADE_MIN_CONFIDENCE = 0.7
+
+# Tarifs indicatifs en USD par million de tokens (entrée, sortie) pour le suivi des coûts
+VISION_MODEL_PRICING = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+
+# Dossier d'enregistrement des réponses Vision (rejeu hors-ligne avec openai_standin.py)
+OPENAI_RECORD_DIR = get_openai_setting("record_dir")
+
+# Lignes de catégorie des BDC (pas de vrais articles)
+CATEGORY_LINE_MARKERS = ["VINS ROUGES", "VINS BLANCS", "VINS ROSES", "LIQUEUR", "CONSIGNE"]
+
 def get_openai_client():
     """Initialise et retourne le client OpenAI"""
     try:
@@ -1794,7 +1870,12 @@ def get_openai_client():
             st.error("❌ Clé API OpenAI non configurée")
             return None
         
-        client = OpenAI(api_key=api_key)
+        # Serveur compatible OpenAI (ex: openai_standin.py pour les tests hors-ligne)
+        base_url = get_openai_setting("base_url")
+        if base_url:
+            client = OpenAI(api_key=api_key, base_url=base_url)
+        else:
+            client = OpenAI(api_key=api_key)
         return client
     except Exception as e:
         st.error(f"❌ Erreur d'initialisation OpenAI: {str(e)}")
@@ -1941,126 +2022,640 @@ def extract_text_features_for_detection(text: str) -> Dict[str, Any]:
     
     return features
 
-def openai_vision_ocr_improved(image_bytes: bytes) -> Dict:
+# ============================================================
+# LIMITEUR DE DÉBIT OPENAI PARTAGÉ ENTRE LES SESSIONS
+# ============================================================
+OPENAI_RPM_LIMIT = int(get_openai_setting("rpm", 500))
+OPENAI_TPM_LIMIT = int(get_openai_setting("tpm", 30000))
+OPENAI_LIMITER_MAX_WAIT = 300
+
+# Priorités de la file d'attente (la plus petite passe en premier)
+OPENAI_PRIORITY_INTERACTIVE = 0
+OPENAI_PRIORITY_BATCH = 1
+OPENAI_PRIORITY_LABELS = {OPENAI_PRIORITY_INTERACTIVE: "Interactif", OPENAI_PRIORITY_BATCH: "Lot / rattrapage"}
+
+@st.cache_resource
+def get_openai_rate_limiter() -> Dict[str, Any]:
+    """Seaux à jetons (requêtes/min et tokens/min) et file de priorité partagés par toutes les sessions"""
+    return {
+        "condition": threading.Condition(),
+        "requests": float(OPENAI_RPM_LIMIT),
+        "tokens": float(OPENAI_TPM_LIMIT),
+        "updated": time.monotonic(),
+        "queue": [],
+        "sequence": 0,
+        "stats": {}
+    }
+
+def refill_openai_buckets(limiter: Dict[str, Any]):
+    """Recharge les seaux au prorata du temps écoulé (à appeler sous le verrou)"""
+    now = time.monotonic()
+    elapsed = now - limiter["updated"]
+    limiter["updated"] = now
+    limiter["requests"] = min(float(OPENAI_RPM_LIMIT), limiter["requests"] + elapsed * OPENAI_RPM_LIMIT / 60)
+    limiter["tokens"] = min(float(OPENAI_TPM_LIMIT), limiter["tokens"] + elapsed * OPENAI_TPM_LIMIT / 60)
+
+def vision_view_size(width: int, height: int) -> Tuple[float, float]:
+    """Dimensions de l'image telle que vue par le modèle (réduction OpenAI : 2048px puis 768px côté court)"""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    return width * scale, height * scale
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """Estime les tokens facturés pour une image (règle des tuiles 512px d'OpenAI)"""
+    if detail == "low":
+        return 85
+    width, height = vision_view_size(width, height)
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def estimate_request_tokens(prompt: str, image_bytes: Optional[bytes], max_tokens: int, detail: str = "auto") -> int:
+    """Estime les tokens décomptés par OpenAI pour une requête (prompt + image + max_tokens)"""
+    tokens = len(prompt) // 4 + max_tokens
+    if image_bytes:
+        try:
+            width, height = Image.open(BytesIO(image_bytes)).size
+            tokens += estimate_image_tokens(width, height, "low" if detail == "low" else "high")
+        except Exception:
+            tokens += 1105
+    return tokens
+
+def acquire_openai_capacity(estimated_tokens: int, priority: int = OPENAI_PRIORITY_INTERACTIVE) -> float:
+    """
+    Attend son tour dans la file de priorité puis réserve une requête et les tokens estimés
+    
+    Returns:
+        Temps d'attente en secondes
+    """
+    limiter = get_openai_rate_limiter()
+    condition = limiter["condition"]
+    started = time.monotonic()
+    # Une requête plus grosse que le quota/minute doit quand même pouvoir passer
+    tokens_needed = min(float(estimated_tokens), float(OPENAI_TPM_LIMIT))
+    
+    with condition:
+        limiter["sequence"] += 1
+        ticket = (priority, limiter["sequence"])
+        heapq.heappush(limiter["queue"], ticket)
+        try:
+            while True:
+                refill_openai_buckets(limiter)
+                is_next = limiter["queue"][0] == ticket
+                if is_next and limiter["requests"] >= 1 and limiter["tokens"] >= tokens_needed:
+                    limiter["requests"] -= 1
+                    limiter["tokens"] -= tokens_needed
+                    break
+                if time.monotonic() - started > OPENAI_LIMITER_MAX_WAIT:
+                    raise TimeoutError("File d'attente OpenAI saturée")
+                if is_next:
+                    delay = max(
+                        (1 - limiter["requests"]) * 60 / OPENAI_RPM_LIMIT,
+                        (tokens_needed - limiter["tokens"]) * 60 / OPENAI_TPM_LIMIT,
+                        0.05
+                    )
+                else:
+                    delay = 1.0
+                condition.wait(timeout=min(delay, 1.0))
+        finally:
+            limiter["queue"].remove(ticket)
+            heapq.heapify(limiter["queue"])
+            condition.notify_all()
+        
+        waited = time.monotonic() - started
+        stats = limiter["stats"].setdefault(priority, {"granted": 0, "wait_total": 0.0, "wait_max": 0.0})
+        stats["granted"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+    
+    return waited
+
+def release_openai_capacity(estimated_tokens: int):
+    """Rend au limiteur une réservation non utilisée (requête abandonnée avant l'envoi)"""
+    limiter = get_openai_rate_limiter()
+    with limiter["condition"]:
+        limiter["requests"] = min(float(OPENAI_RPM_LIMIT), limiter["requests"] + 1)
+        limiter["tokens"] = min(float(OPENAI_TPM_LIMIT), limiter["tokens"] + min(float(estimated_tokens), float(OPENAI_TPM_LIMIT)))
+        limiter["condition"].notify_all()
+
+def settle_openai_tokens(estimated_tokens: int, actual_tokens: int):
+    """Corrige le seau de tokens avec la consommation réelle renvoyée par l'API"""
+    if not actual_tokens:
+        return
+    limiter = get_openai_rate_limiter()
+    with limiter["condition"]:
+        tokens_reserved = min(float(estimated_tokens), float(OPENAI_TPM_LIMIT))
+        limiter["tokens"] = max(-float(OPENAI_TPM_LIMIT), limiter["tokens"] + tokens_reserved - actual_tokens)
+        limiter["condition"].notify_all()
+
+# Prompt principal d'extraction (partagé par tous les niveaux de la cascade)
+VISION_EXTRACTION_PROMPT = """
+ANALYSE CE DOCUMENT ET EXTRACT LES INFORMATIONS SUIVANTES:
+
+IMPORTANT RÈGLE SPÉCIALE POUR LES BONS DE COMMANDE (BDC):
+- Pour TOUS les BDC (DLP, S2M, ULYS), cherche TOUJOURS le numéro manuscrit écrit à la main
+- Ce numéro est généralement écrit après "F" ou "Fact" (exemple: Fact 251193 → 251193)
+- Il se trouve souvent en haut à droite de l'entête, parfois sur le côté droit
+- Si tu vois deux valeurs manuscrites différentes (ex: f 4567 et Fact 7890), 
+  prends TOUJOURS la valeur de Fact 7890 (donc 7890)
+- Si aucun "F" ou "Fact" manuscrit n'est trouvé, laisse ce champ vide
+
+IMPORTANT RÈGLE SPÉCIALE POUR LES FACTURES:
+- Pour les FACTURES EN COMPTE, cherche le texte après "DOIT M :" ou "DOIT M:"
+- Ce texte contient le nom du magasin/client
+- Exemple: "DOIT M : Motel d'Antananarivo -anosy- Antananarivo" → 
+  doit_m = "Motel d'Antananarivo -anosy- Antananarivo"
+
+Pour TOUS les documents, extrais:
+{
+    "type_document": "BDC" ou "FACTURE",
+    "document_subtype": "DLP", "S2M", "ULYS", ou "FACTURE",
+    "client": "...",
+    "adresse_livraison": "...",
+    "quartier_s2m": "...",  (uniquement si S2M: le quartier sous "SUPERMAKI")
+    "nom_magasin_ulys": "...",  (uniquement si ULYS: le nom du magasin)
+    "doit_m": "...",  (uniquement si FACTURE: texte après "DOIT M :")
+    "fact_manuscrit_trouve": "oui" ou "non",
+    "fact_manuscrit": "...",  (le numéro exact après F ou Fact, SANS le F/Fact)
+}
+
+Puis selon le type:
+
+1. SI C'EST UNE FACTURE (FACTURE EN COMPTE):
+    "numero_facture": "...",
+    "date": "...",  (IMPORTANT: extraire la date de la facture, pas la date du scan)
+    "bon_commande": "...",
+    "articles": [
+        {
+            "article_brut": "TEXT EXACT de l'article (colonne 'Désignation')",
+            "quantite": nombre  (colonne 'Nb bills', PAS 'Btlls/colis')
+        }
+    ]
+
+2. SI C'EST UN BDC (DLP, S2M, ULYS):
+    "numero": "...",  (IMPORTANT: utiliser TOUJOURS le fact_manuscrit si disponible, sinon vide)
+    "date": "...",  (IMPORTANT: extraire la date du BDC, pas la date du scan)
+    "articles": [
+        {
+            "article_brut": "TEXT EXACT de la colonne Désignation",
+            "quantite": nombre
+        }
+    ]
+
+RÈGLES SPÉCIFIQUES POUR CHAQUE TYPE:
+• DLP: client = "DLP", adresse = "Leader Price Akadimbahoaka"  (TOUJOURS CETTE ADRESSE POUR DLP)
+• S2M: client = "S2M", adresse = "Supermaki " + quartier_s2m (nettoyer format)
+• ULYS: client = "ULYS", adresse = nom_magasin_ulys
+• FACTURE: 
+  - Pour les colonnes: utiliser "Désignation" pour article_brut et "Nb bills" pour quantité
+  - Si le client est "Autre client" (pas DLP, ULYS ou S2M), forcer client = adresse
+  - NOUVEAU: Si "doit_m" est présent, utiliser doit_m pour client et adresse
+
+IMPORTANT POUR LES FACTURES:
+- Utiliser la colonne "Désignation" pour les articles
+- Utiliser la colonne "Nb bills" pour la quantité (PAS "Btlls/colis")
+
+INDICES DÉCISIFS:
+• "DISTRIBUTION LEADER PRICE" = TOUJOURS DLP
+• "SUPERMAKI" = TOUJOURS S2M
+• "BON DE COMMANDE FOURNISSEUR" = TOUJOURS ULYS
+• "FACTURE EN COMPTE" = TOUJOURS FACTURE
+• "DOIT M :" = TOUJOURS EXTRAIRE LE TEXTE APRÈS
+
+EXEMPLE CORRECT POUR UNE FACTURE:
+Si tu vois "DOIT M : Motel d'Antananarivo -anosy- Antananarivo" → 
+"doit_m": "Motel d'Antananarivo -anosy- Antananarivo"
+Si client n'est pas DLP, ULYS, S2M → 
+"client": "Motel d'Antananarivo -anosy- Antananarivo"
+"adresse_livraison": "Motel d'Antananarivo -anosy- Antananarivo"
+
+IMPORTANT POUR LA DATE: 
+- Extraire la date qui est écrite sur le document (facture ou BDC)
+- Ne pas utiliser la date actuelle ou une date estimée
+- Formater la date en format clair (ex: 15/01/2024)
+"""
+
+# ============================================================
+# REQUÊTES DE SECOURS (HEDGING) CONTRE LES LATENCES EXTRÊMES
+# ============================================================
+VISION_HEDGING_ENABLED = str(get_openai_setting("hedging", "0")).lower() in ["1", "true", "oui"]
+VISION_HEDGE_PERCENTILE = float(get_openai_setting("hedge_percentile", 90))
+VISION_HEDGE_MIN_SAMPLES = 20
+# Plafond de coût : part maximale des appels pouvant déclencher une requête de secours
+VISION_HEDGE_MAX_RATE = float(get_openai_setting("hedge_max_rate", 0.10))
+VISION_LATENCY_HISTORY_SIZE = 200
+# Tailles de réponse : champ isolé ou désambiguïsation, bande de tableau, page entière
+VISION_SHORT_RESPONSE_TOKENS = 500
+VISION_PARTIAL_RESPONSE_TOKENS = 2000
+
+@st.cache_resource
+def get_vision_executor() -> ThreadPoolExecutor:
+    """Pool de threads partagé pour les appels Vision concurrents"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="vision")
+
+@st.cache_resource
+def get_vision_latency_history() -> Dict[str, Any]:
+    """Historique partagé des latences Vision par classe d'appel et compteurs de hedging"""
+    return {
+        "lock": threading.Lock(),
+        "samples": {},
+        "primary": deque(maxlen=VISION_LATENCY_HISTORY_SIZE),
+        "effective": deque(maxlen=VISION_LATENCY_HISTORY_SIZE),
+        "calls": 0,
+        "hedged": 0,
+        "hedge_wins": 0,
+        "hedge_cost_usd": 0.0
+    }
+
+def latency_percentile(samples, percentile: float) -> Optional[float]:
+    """Percentile (méthode du rang le plus proche) d'une série de latences"""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, math.ceil(percentile / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+def latency_class(model: str, detail: Optional[str], max_tokens: int) -> str:
+    """
+    Classe d'appel pour l'historique des latences : modèle, image (et son niveau de détail)
+    ou texte seul, réponse courte ou extraction complète
+    
+    Les lectures de champ, bandes et désambiguïsations ne faussent pas le seuil des pages entières.
+    """
+    if max_tokens <= VISION_SHORT_RESPONSE_TOKENS:
+        size = "courte"
+    elif max_tokens <= VISION_PARTIAL_RESPONSE_TOKENS:
+        size = "partielle"
+    else:
+        size = "complète"
+    return f"{model} · {'texte' if detail is None else f'image {detail}'} · {size}"
+
+def record_vision_latency(call_class: str, latency: float):
+    """Ajoute une latence de service (hors file d'attente) à l'historique de la classe d'appel"""
+    history = get_vision_latency_history()
+    with history["lock"]:
+        history["samples"].setdefault(call_class, deque(maxlen=VISION_LATENCY_HISTORY_SIZE)).append(latency)
+
+def get_hedge_threshold(call_class: str) -> Optional[float]:
+    """Délai après lequel envoyer une requête de secours, ou None si le hedging ne s'applique pas"""
+    if not VISION_HEDGING_ENABLED:
+        return None
+    history = get_vision_latency_history()
+    with history["lock"]:
+        samples = list(history["samples"].get(call_class, []))
+    if len(samples) < VISION_HEDGE_MIN_SAMPLES:
+        return None
+    return latency_percentile(samples, VISION_HEDGE_PERCENTILE)
+
+def reserve_hedge_budget() -> bool:
+    """Autorise une requête de secours si le taux de hedging reste sous le plafond de coût"""
+    history = get_vision_latency_history()
+    with history["lock"]:
+        if history["hedged"] + 1 > VISION_HEDGE_MAX_RATE * max(history["calls"], 1):
+            return False
+        history["hedged"] += 1
+        return True
+
+def compute_call_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Coût en USD d'un appel selon les tarifs indicatifs du modèle"""
+    price_in, price_out = VISION_MODEL_PRICING.get(model, VISION_MODEL_PRICING["gpt-4o"])
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+def send_vision_request(client, model: str, messages: List[Dict], max_tokens: int, estimated_tokens: int,
+                        call_class: str):
+    """
+    Envoie une requête (capacité déjà réservée) et met à jour le limiteur et l'historique
+    
+    Returns:
+        Tuple (réponse, latence de service)
+    """
+    started = time.perf_counter()
+    response = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=0.1
+    )
+    latency = time.perf_counter() - started
+    
+    usage = getattr(response, "usage", None)
+    settle_openai_tokens(
+        estimated_tokens,
+        (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+    )
+    record_vision_latency(call_class, latency)
+    return response, latency
+
+def send_hedged_vision_request(client, model: str, messages: List[Dict], max_tokens: int,
+                               estimated_tokens: int, threshold: float, priority: int, call_class: str):
+    """
+    Envoie la requête ; si elle dépasse le seuil, lance une requête de secours et garde la première réponse
+    
+    Returns:
+        Tuple (réponse, latence effective, requête de secours envoyée, secours gagnant)
+    """
+    executor = get_vision_executor()
+    history = get_vision_latency_history()
+    started = time.perf_counter()
+    
+    primary = executor.submit(send_vision_request, client, model, messages, max_tokens, estimated_tokens, call_class)
+    primary.add_done_callback(
+        lambda f: history["primary"].append(f.result()[1]) if not f.cancelled() and f.exception() is None else None
+    )
+    
+    done, _ = wait([primary], timeout=threshold)
+    if done or not reserve_hedge_budget():
+        response, _ = primary.result()
+        return response, time.perf_counter() - started, False, False
+    
+    def backup_request():
+        acquire_openai_capacity(estimated_tokens, priority)
+        if primary.done() and primary.exception() is None:
+            # La requête principale a répondu pendant l'attente dans la file : secours inutile
+            release_openai_capacity(estimated_tokens)
+            return None
+        return send_vision_request(client, model, messages, max_tokens, estimated_tokens, call_class)
+    
+    backup = executor.submit(backup_request)
+    pending = {primary, backup}
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None or future.result() is None:
+                first_error = first_error or future.exception()
+                continue
+            # Le perdant ne peut pas être interrompu côté API : sa réponse est ignorée et son coût comptabilisé
+            for loser in pending:
+                loser.cancel()
+                loser.add_done_callback(lambda f: record_hedge_loser_cost(model, f))
+            won_by_backup = future is backup
+            if won_by_backup:
+                with history["lock"]:
+                    history["hedge_wins"] += 1
+            return future.result()[0], time.perf_counter() - started, True, won_by_backup
+    raise first_error
+
+def record_hedge_loser_cost(model: str, future):
+    """Comptabilise le coût de la requête perdante d'un hedging"""
+    if future.cancelled() or future.exception() is not None or future.result() is None:
+        return
+    usage = getattr(future.result()[0], "usage", None)
+    cost = compute_call_cost(model, getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+    history = get_vision_latency_history()
+    with history["lock"]:
+        history["hedge_cost_usd"] += cost
+
+# ============================================================
+# DISJONCTEUR (CIRCUIT BREAKER) DE L'API VISION
+# ============================================================
+VISION_BREAKER_FAILURE_THRESHOLD = int(get_openai_setting("breaker_failures", 3))
+VISION_BREAKER_COOLDOWN = float(get_openai_setting("breaker_cooldown", 60))
+# Erreurs traduisant une indisponibilité du service (et non une requête invalide)
+VISION_OUTAGE_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+class VisionUnavailableError(Exception):
+    """Levée sans appel réseau tant que le disjoncteur de l'API Vision est ouvert"""
+
+@st.cache_resource
+def get_vision_circuit_breaker() -> Dict[str, Any]:
+    """État partagé du disjoncteur : closed (normal), open (échec immédiat), half_open (essai unique)"""
+    return {
+        "lock": threading.Lock(),
+        "state": "closed",
+        "failures": 0,
+        "opened_at": 0.0,
+        "trial_in_flight": False,
+        "opened_count": 0,
+        "rejected": 0
+    }
+
+def vision_circuit_allows_request() -> bool:
+    """Indique si un appel Vision serait tenté (sans modifier l'état du disjoncteur)"""
+    breaker = get_vision_circuit_breaker()
+    with breaker["lock"]:
+        if breaker["state"] == "closed":
+            return True
+        if breaker["state"] == "open":
+            return time.time() - breaker["opened_at"] >= VISION_BREAKER_COOLDOWN
+        return not breaker["trial_in_flight"]
+
+def enter_vision_circuit():
+    """Autorise l'appel ou lève VisionUnavailableError ; après le délai, laisse passer un seul appel d'essai"""
+    breaker = get_vision_circuit_breaker()
+    with breaker["lock"]:
+        if breaker["state"] == "open" and time.time() - breaker["opened_at"] >= VISION_BREAKER_COOLDOWN:
+            breaker["state"] = "half_open"
+            breaker["trial_in_flight"] = False
+        if breaker["state"] == "closed":
+            return
+        if breaker["state"] == "half_open" and not breaker["trial_in_flight"]:
+            breaker["trial_in_flight"] = True
+            return
+        breaker["rejected"] += 1
+        retry_in = max(0.0, VISION_BREAKER_COOLDOWN - (time.time() - breaker["opened_at"]))
+    raise VisionUnavailableError(f"Service OpenAI Vision indisponible (nouvel essai dans {retry_in:.0f}s)")
+
+def release_vision_circuit_trial():
+    """Libère l'essai du disjoncteur sans appel effectué (file d'attente saturée...) : ni succès ni panne"""
+    breaker = get_vision_circuit_breaker()
+    with breaker["lock"]:
+        breaker["trial_in_flight"] = False
+
+def reserve_vision_call(estimated_tokens: int, priority: int) -> float:
+    """
+    Entre dans le disjoncteur puis attend la capacité du limiteur
+    
+    Si l'attente échoue, l'éventuel essai "half_open" est libéré : sans cela, le disjoncteur
+    resterait bloqué jusqu'au redémarrage du processus.
+    
+    Returns:
+        Temps d'attente dans la file en secondes
+    """
+    enter_vision_circuit()
+    try:
+        return acquire_openai_capacity(estimated_tokens, priority)
+    except BaseException:
+        release_vision_circuit_trial()
+        raise
+
+def record_vision_circuit_result(success: bool):
+    """Met à jour le disjoncteur après un appel : réinitialise sur succès, ouvre après N échecs consécutifs"""
+    breaker = get_vision_circuit_breaker()
+    with breaker["lock"]:
+        breaker["trial_in_flight"] = False
+        if success:
+            breaker["state"] = "closed"
+            breaker["failures"] = 0
+            return
+        breaker["failures"] += 1
+        if breaker["state"] == "half_open" or breaker["failures"] >= VISION_BREAKER_FAILURE_THRESHOLD:
+            if breaker["state"] != "open":
+                breaker["opened_count"] += 1
+            breaker["state"] = "open"
+            breaker["opened_at"] = time.time()
+
+def create_vision_completion(client, prompt: str, image_bytes: bytes, model: str = VISION_MODEL_FULL,
+                             max_tokens: int = VISION_MAX_TOKENS, detail: str = "auto",
+                             priority: int = OPENAI_PRIORITY_INTERACTIVE) -> Tuple[str, Dict[str, Any]]:
+    """
+    Appel brut à OpenAI Vision, sans accès à la session Streamlit
+    
+    Returns:
+        Tuple (contenu, métriques de l'appel: modèle, latence, attente, tokens, coût, hedging)
+    """
+    image_url = {"url": f"data:image/png;base64,{encode_image_to_base64(image_bytes)}"}
+    if detail != "auto":
+        image_url["detail"] = detail
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": image_url}
+            ]
+        }
+    ]
+    
+    estimated_tokens = estimate_request_tokens(prompt, image_bytes, max_tokens, detail)
+    call_class = latency_class(model, detail, max_tokens)
+    threshold = get_hedge_threshold(call_class)
+    queue_wait = reserve_vision_call(estimated_tokens, priority)
+    try:
+        if threshold is None:
+            response, latency = send_vision_request(client, model, messages, max_tokens, estimated_tokens, call_class)
+            hedged, hedge_won = False, False
+        else:
+            response, latency, hedged, hedge_won = send_hedged_vision_request(
+                client, model, messages, max_tokens, estimated_tokens, threshold, priority, call_class
+            )
+    except VISION_OUTAGE_ERRORS:
+        record_vision_circuit_result(success=False)
+        raise
+    except Exception:
+        # Requête rejetée mais service joignable : ne compte pas comme une panne
+        record_vision_circuit_result(success=True)
+        raise
+    record_vision_circuit_result(success=True)
+
+    history = get_vision_latency_history()
+    with history["lock"]:
+        history["calls"] += 1
+        history["effective"].append(latency)
+        if threshold is None:
+            history["primary"].append(latency)
+    
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    
+    metrics = {
+        "model": model,
+        "latency": latency,
+        "queue_wait": queue_wait,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost_usd": compute_call_cost(model, prompt_tokens, completion_tokens),
+        "hedged": hedged,
+        "hedge_won": hedge_won
+    }
+    content = response.choices[0].message.content or ""
+    
+    if OPENAI_RECORD_DIR:
+        record_vision_response(model, prompt, image_bytes, content, metrics)
+    
+    return content, metrics
+
+def recording_key(model: str, prompt: str, image_bytes: Optional[bytes]) -> str:
+    """Clé d'enregistrement : SHA-256 du modèle, du prompt et de l'image (même calcul dans openai_standin.py)"""
+    digest = hashlib.sha256()
+    for part in [model.encode("utf-8"), prompt.encode("utf-8"), image_bytes or b""]:
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+def record_vision_response(model: str, prompt: str, image_bytes: Optional[bytes], content: str, metrics: Dict[str, Any]):
+    """Enregistre la réponse sous <clé>.json pour le rejeu par openai_standin.py"""
+    try:
+        os.makedirs(OPENAI_RECORD_DIR, exist_ok=True)
+        path = os.path.join(OPENAI_RECORD_DIR, f"{recording_key(model, prompt, image_bytes)}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"content": content, **metrics}, f, ensure_ascii=False, indent=2)
+    except OSError:
+        pass
+
+def create_text_completion(client, prompt: str, model: str = VISION_MODEL_FAST, max_tokens: int = 500,
+                           priority: int = OPENAI_PRIORITY_INTERACTIVE) -> Tuple[str, Dict[str, Any]]:
+    """
+    Requête texte seule (sans image), soumise au même disjoncteur et au même limiteur que Vision
+    
+    Returns:
+        Tuple (contenu, métriques de l'appel: modèle, latence, attente, tokens, coût)
+    """
+    messages = [{"role": "user", "content": prompt}]
+    
+    estimated_tokens = estimate_request_tokens(prompt, None, max_tokens)
+    queue_wait = reserve_vision_call(estimated_tokens, priority)
+    try:
+        response, latency = send_vision_request(client, model, messages, max_tokens, estimated_tokens,
+                                                latency_class(model, None, max_tokens))
+    except VISION_OUTAGE_ERRORS:
+        record_vision_circuit_result(success=False)
+        raise
+    except Exception:
+        record_vision_circuit_result(success=True)
+        raise
+    record_vision_circuit_result(success=True)
+    
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    
+    metrics = {
+        "model": model,
+        "latency": latency,
+        "queue_wait": queue_wait,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost_usd": compute_call_cost(model, prompt_tokens, completion_tokens),
+        "hedged": False,
+        "hedge_won": False
+    }
+    content = response.choices[0].message.content or ""
+    
+    if OPENAI_RECORD_DIR:
+        record_vision_response(model, prompt, None, content, metrics)
+    
+    return content, metrics
+
+def openai_vision_ocr_improved(image_bytes: bytes, model: str = VISION_MODEL_FULL, silent: bool = False) -> Dict:
     """Utilise OpenAI Vision pour analyser le document avec un prompt amélioré pour la détection V1.3"""
+    st.session_state.last_vision_call = None
     try:
         client = get_openai_client()
         if not client:
             return None
         
-        base64_image = encode_image_to_base64(image_bytes)
-        
-        # PROMPT AMÉLIORÉ AVEC EXTRACTION "DOIT M :"
-        prompt = """
-        ANALYSE CE DOCUMENT ET EXTRACT LES INFORMATIONS SUIVANTES:
-
-        IMPORTANT RÈGLE SPÉCIALE POUR LES BONS DE COMMANDE (BDC):
-        - Pour TOUS les BDC (DLP, S2M, ULYS), cherche TOUJOURS le numéro manuscrit écrit à la main
-        - Ce numéro est généralement écrit après "F" ou "Fact" (exemple: Fact 251193 → 251193)
-        - Il se trouve souvent en haut à droite de l'entête, parfois sur le côté droit
-        - Si tu vois deux valeurs manuscrites différentes (ex: f 4567 et Fact 7890), 
-          prends TOUJOURS la valeur de Fact 7890 (donc 7890)
-        - Si aucun "F" ou "Fact" manuscrit n'est trouvé, laisse ce champ vide
-        
-        IMPORTANT RÈGLE SPÉCIALE POUR LES FACTURES:
-        - Pour les FACTURES EN COMPTE, cherche le texte après "DOIT M :" ou "DOIT M:"
-        - Ce texte contient le nom du magasin/client
-        - Exemple: "DOIT M : Motel d'Antananarivo -anosy- Antananarivo" → 
-          doit_m = "Motel d'Antananarivo -anosy- Antananarivo"
-        
-        Pour TOUS les documents, extrais:
-        {
-            "type_document": "BDC" ou "FACTURE",
-            "document_subtype": "DLP", "S2M", "ULYS", ou "FACTURE",
-            "client": "...",
-            "adresse_livraison": "...",
-            "quartier_s2m": "...",  (uniquement si S2M: le quartier sous "SUPERMAKI")
-            "nom_magasin_ulys": "...",  (uniquement si ULYS: le nom du magasin)
-            "doit_m": "...",  (uniquement si FACTURE: texte après "DOIT M :")
-            "fact_manuscrit_trouve": "oui" ou "non",
-            "fact_manuscrit": "...",  (le numéro exact après F ou Fact, SANS le F/Fact)
-        }
-        
-        Puis selon le type:
-        
-        1. SI C'EST UNE FACTURE (FACTURE EN COMPTE):
-            "numero_facture": "...",
-            "date": "...",  (IMPORTANT: extraire la date de la facture, pas la date du scan)
-            "bon_commande": "...",
-            "articles": [
-                {
-                    "article_brut": "TEXT EXACT de l'article (colonne 'Désignation')",
-                    "quantite": nombre  (colonne 'Nb bills', PAS 'Btlls/colis')
-                }
-            ]
-        
-        2. SI C'EST UN BDC (DLP, S2M, ULYS):
-            "numero": "...",  (IMPORTANT: utiliser TOUJOURS le fact_manuscrit si disponible, sinon vide)
-            "date": "...",  (IMPORTANT: extraire la date du BDC, pas la date du scan)
-            "articles": [
-                {
-                    "article_brut": "TEXT EXACT de la colonne Désignation",
-                    "quantite": nombre
-                }
-            ]
-        
-        RÈGLES SPÉCIFIQUES POUR CHAQUE TYPE:
-        • DLP: client = "DLP", adresse = "Leader Price Akadimbahoaka"  (TOUJOURS CETTE ADRESSE POUR DLP)
-        • S2M: client = "S2M", adresse = "Supermaki " + quartier_s2m (nettoyer format)
-        • ULYS: client = "ULYS", adresse = nom_magasin_ulys
-        • FACTURE: 
-          - Pour les colonnes: utiliser "Désignation" pour article_brut et "Nb bills" pour quantité
-          - Si le client est "Autre client" (pas DLP, ULYS ou S2M), forcer client = adresse
-          - NOUVEAU: Si "doit_m" est présent, utiliser doit_m pour client et adresse
-        
-        IMPORTANT POUR LES FACTURES:
-        - Utiliser la colonne "Désignation" pour les articles
-        - Utiliser la colonne "Nb bills" pour la quantité (PAS "Btlls/colis")
-        
-        INDICES DÉCISIFS:
-        • "DISTRIBUTION LEADER PRICE" = TOUJOURS DLP
-        • "SUPERMAKI" = TOUJOURS S2M
-        • "BON DE COMMANDE FOURNISSEUR" = TOUJOURS ULYS
-        • "FACTURE EN COMPTE" = TOUJOURS FACTURE
-        • "DOIT M :" = TOUJOURS EXTRAIRE LE TEXTE APRÈS
-        
-        EXEMPLE CORRECT POUR UNE FACTURE:
-        Si tu vois "DOIT M : Motel d'Antananarivo -anosy- Antananarivo" → 
-        "doit_m": "Motel d'Antananarivo -anosy- Antananarivo"
-        Si client n'est pas DLP, ULYS, S2M → 
-        "client": "Motel d'Antananarivo -anosy- Antananarivo"
-        "adresse_livraison": "Motel d'Antananarivo -anosy- Antananarivo"
-        
-        IMPORTANT POUR LA DATE: 
-        - Extraire la date qui est écrite sur le document (facture ou BDC)
-        - Ne pas utiliser la date actuelle ou une date estimée
-        - Formater la date en format clair (ex: 15/01/2024)
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=4000,
-            temperature=0.1
+        content, call_metrics = create_vision_completion(
+            client, VISION_EXTRACTION_PROMPT, image_bytes, model=model,
+            priority=st.session_state.get("openai_priority", OPENAI_PRIORITY_INTERACTIVE)
         )
         
-        content = response.choices[0].message.content
-        
         st.session_state.ocr_raw_text = content
+        st.session_state.ocr_replay = {"main": content}
+        st.session_state.last_vision_call = call_metrics
         
+        return parse_vision_content(content)
+
+    except (VisionUnavailableError,) + VISION_OUTAGE_ERRORS:
+        # Panne du service : remontée à l'appelant pour mise en file d'attente locale
+        raise
+    except Exception as e:
+        if not silent:
+            st.error(f"❌ Erreur OpenAI Vision: {str(e)}")
+        return None
+
+def parse_vision_content(content: str) -> Dict:
+    """Extrait le JSON de la réponse Vision et applique les corrections par client"""
+    try:
         json_match = re.search(r'\{.*\}', content, re.DOTALL)
         if json_match:
             json_str = json_match.group()
@@ -2131,7 +2726,7 @@ def openai_vision_ocr_improved(image_bytes: bytes) -> Dict:
             return guess_document_type_from_text(content)
             
     except Exception as e:
-        st.error(f"❌ Erreur OpenAI Vision: {str(e)}")
+        st.error(f"❌ Erreur d'interprétation de la réponse Vision: {str(e)}")
         return None
 
 def guess_document_type_from_text(text: str) -> Dict:
@@ -2185,29 +2780,355 @@ def guess_document_type_from_text(text: str) -> Dict:
             return {"type_document": "FACTURE", "document_subtype": "FACTURE", "articles": []}
         else:
             return {"type_document": "BDC", "document_subtype": "UNKNOWN", "fact_manuscrit": fact_manuscrit, "numero": fact_manuscrit, "articles": []}
-#=============================================================
+# ============================================================
+# CASCADE DE MODÈLES VISION - RAPIDE D'ABORD, GPT-4O SI NÉCESSAIRE
+# ============================================================
+@st.cache_resource
+def get_vision_tier_stats() -> Dict[str, Any]:
+    """Statistiques partagées par toutes les sessions : escalades, latence et coût par niveau"""
+    return {
+        "lock": threading.Lock(),
+        "documents": 0,
+        "escalations": 0,
+        "tiers": {}
+    }
+
+def record_vision_tier_call(call_metrics: Optional[Dict[str, Any]], accepted: bool):
+    """Enregistre un appel Vision d'un niveau de la cascade dans les statistiques partagées"""
+    if not call_metrics:
+        return
+    stats = get_vision_tier_stats()
+    with stats["lock"]:
+        tier = stats["tiers"].setdefault(call_metrics["model"], {
+            "calls": 0, "accepted": 0, "latency_total": 0.0,
+            "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0
+        })
+        tier["calls"] += 1
+        tier["accepted"] += 1 if accepted else 0
+        tier["latency_total"] += call_metrics["latency"]
+        tier["prompt_tokens"] += call_metrics["prompt_tokens"]
+        tier["completion_tokens"] += call_metrics["completion_tokens"]
+        tier["cost_usd"] += call_metrics["cost_usd"]
+
+def is_category_line(designation: str) -> bool:
+    """Indique si la ligne est un intitulé de catégorie (VINS ROUGES, LIQUEUR...) et non un article"""
+    return any(cat in str(designation or "").upper() for cat in CATEGORY_LINE_MARKERS)
+
+def is_numeric_quantity(qty: Any) -> bool:
+    """Vérifie qu'une quantité extraite est bien un nombre"""
+    if qty is None or isinstance(qty, bool):
+        return False
+    try:
+        float(str(qty).replace(',', '.').strip())
+        return True
+    except ValueError:
+        return False
+
+def validate_vision_result(result: Optional[Dict]) -> Tuple[bool, List[str]]:
+    """
+    Valide un résultat Vision pour décider de l'escalade vers le modèle complet
+    
+    Returns:
+        Tuple (valide, raisons de l'échec)
+    """
+    if not result:
+        return False, ["Réponse vide ou illisible"]
+    
+    reasons = []
+    document_subtype = str(result.get("document_subtype", "")).upper()
+    
+    if document_subtype not in ["DLP", "S2M", "ULYS", "FACTURE"]:
+        reasons.append(f"Sous-type inconnu: {document_subtype or 'vide'}")
+    if not str(result.get("client", "") or "").strip():
+        reasons.append("Client absent")
+    if not str(result.get("date", "") or "").strip():
+        reasons.append("Date absente")
+    if document_subtype == "FACTURE" and not str(result.get("numero_facture", "") or "").strip():
+        reasons.append("N° facture absent")
+    
+    articles = result.get("articles") or []
+    if not articles:
+        reasons.append("Aucun article")
+    
+    for article in articles:
+        raw_name = str(article.get("article_brut", article.get("article", "")) or "")
+        if is_category_line(raw_name):
+            continue
+        if not is_numeric_quantity(article.get("quantite")):
+            reasons.append(f"Quantité non numérique: {raw_name}")
+        _, _, confidence, _ = standardize_product_for_bdc(raw_name)
+        if confidence < VISION_CASCADE_MIN_CONFIDENCE:
+            reasons.append(f"Désignation incertaine ({confidence*100:.0f}%): {raw_name}")
+    
+    return not reasons, reasons
+
+def openai_vision_ocr_cascade(image_bytes: bytes) -> Dict:
+    """Analyse avec le modèle rapide puis escalade vers GPT-4o uniquement si la validation échoue"""
+    if not VISION_CASCADE_ENABLED or VISION_MODEL_FAST == VISION_MODEL_FULL:
+        result = openai_vision_ocr_improved(image_bytes, model=VISION_MODEL_FULL)
+        record_vision_tier_call(st.session_state.last_vision_call, accepted=result is not None)
+        calls = [st.session_state.last_vision_call] if st.session_state.last_vision_call else []
+        st.session_state.vision_cascade = {"tiers": calls, "escalated": False, "reasons": []}
+        return result
+    
+    stats = get_vision_tier_stats()
+    with stats["lock"]:
+        stats["documents"] += 1
+    
+    result = openai_vision_ocr_improved(image_bytes, model=VISION_MODEL_FAST, silent=True)
+    fast_call = st.session_state.last_vision_call
+    valid, reasons = validate_vision_result(result)
+    record_vision_tier_call(fast_call, accepted=valid)
+    
+    if valid:
+        st.session_state.vision_cascade = {"tiers": [fast_call], "escalated": False, "reasons": []}
+        return result
+    
+    with stats["lock"]:
+        stats["escalations"] += 1
+    
+    # Oublier les valeurs posées en session par le niveau rapide avant l'escalade
+    st.session_state.fact_manuscrit = ""
+    st.session_state.quartier_s2m = ""
+    st.session_state.nom_magasin_ulys = ""
+    
+    result = openai_vision_ocr_improved(image_bytes, model=VISION_MODEL_FULL)
+    full_call = st.session_state.last_vision_call
+    record_vision_tier_call(full_call, accepted=result is not None)
+    
+    st.session_state.vision_cascade = {
+        "tiers": [call for call in [fast_call, full_call] if call],
+        "escalated": True,
+        "reasons": reasons
+    }
+    return result
+
+# ============================================================
+# REGROUPEMENT DES ANALYSES IDENTIQUES EN COURS (SINGLE-FLIGHT)
+# ============================================================
+# Clés de session produites par l'analyse et recopiées vers les appels regroupés
+COALESCED_SESSION_KEYS = [
+    "ocr_raw_text", "fact_manuscrit", "quartier_s2m", "nom_magasin_ulys",
+    "document_analysis_details", "last_vision_call", "vision_cascade", "fact_crop_info", "ocr_replay"
+]
+SINGLE_FLIGHT_WAIT_TIMEOUT = 180
+
+@st.cache_resource
+def get_inflight_analyses() -> Dict[str, Any]:
+    """Registre partagé des analyses en cours, indexé par empreinte SHA-256 de l'image"""
+    return {
+        "lock": threading.Lock(),
+        "inflight": {},
+        "leaders": 0,
+        "coalesced": 0
+    }
+
 def analyze_document_with_backup(image_bytes: bytes) -> Dict:
+    """Analyse le document ; les appels simultanés pour la même image partagent une seule requête OpenAI"""
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    registry = get_inflight_analyses()
+    
+    with registry["lock"]:
+        entry = registry["inflight"].get(image_hash)
+        is_leader = entry is None
+        if is_leader:
+            entry = {"event": threading.Event(), "result": None, "session": {}}
+            registry["inflight"][image_hash] = entry
+            registry["leaders"] += 1
+        else:
+            registry["coalesced"] += 1
+    
+    if not is_leader:
+        entry["event"].wait(timeout=SINGLE_FLIGHT_WAIT_TIMEOUT)
+        if entry["result"] is not None:
+            for key, value in entry["session"].items():
+                st.session_state[key] = copy.deepcopy(value)
+            st.session_state.analysis_coalesced = True
+            return copy.deepcopy(entry["result"])
+        # Le premier appel a échoué ou n'a pas abouti à temps : analyse indépendante
+        return analyze_document_core(image_bytes)
+    
+    try:
+        st.session_state.analysis_coalesced = False
+        result = analyze_document_core(image_bytes)
+        entry["session"] = {key: copy.deepcopy(st.session_state.get(key)) for key in COALESCED_SESSION_KEYS}
+        entry["result"] = copy.deepcopy(result)
+        return result
+    finally:
+        with registry["lock"]:
+            registry["inflight"].pop(image_hash, None)
+        entry["event"].set()
+
+# ============================================================
+# LECTURE CIBLÉE DU NUMÉRO "FACT" MANUSCRIT (COIN DE L'EN-TÊTE)
+# ============================================================
+FACT_CROP_ENABLED = str(get_openai_setting("fact_crop", "1")).lower() in ["1", "true", "oui"]
+# Zone lue (gauche, haut, droite, bas) en proportion de la page : coin supérieur droit
+FACT_CROP_BOX = (0.45, 0.0, 1.0, 0.3)
+# Au plus 512px : l'image tient dans la vue "low" (85 tokens) sans perte de résolution
+FACT_CROP_MAX_SIDE = 512
+FACT_CROP_MAX_TOKENS = 20
+
+FACT_CROP_PROMPT = """
+Cette image est le coin supérieur droit d'un bon de commande.
+Un numéro y est souvent écrit à la main après "F", "F." ou "Fact".
+Si deux valeurs manuscrites différentes apparaissent (ex: F 4567 et Fact 7890),
+prends TOUJOURS la valeur écrite après "Fact" (donc 7890).
+Réponds UNIQUEMENT par ce numéro (chiffres seuls), ou par "AUCUN" s'il n'y en a pas.
+"""
+
+@st.cache_resource
+def get_fact_crop_stats() -> Dict[str, Any]:
+    """Compteurs partagés de la lecture ciblée du numéro Fact"""
+    return {
+        "lock": threading.Lock(),
+        "calls": 0,
+        "found": 0,
+        "disagreements": 0,
+        "latency_total": 0.0,
+        "tokens_total": 0,
+        "cost_usd": 0.0,
+        "discarded": 0,
+        "discarded_cost_usd": 0.0
+    }
+
+def crop_fact_region(image_bytes: bytes) -> bytes:
+    """Découpe le coin de l'en-tête portant le numéro Fact, réduit à FACT_CROP_MAX_SIDE"""
+    img = Image.open(BytesIO(image_bytes)).convert("RGB")
+    left, top, right, bottom = FACT_CROP_BOX
+    img = img.crop((int(img.width * left), int(img.height * top), int(img.width * right), int(img.height * bottom)))
+    img.thumbnail((FACT_CROP_MAX_SIDE, FACT_CROP_MAX_SIDE))
+    out = BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+def read_fact_number(client, image_bytes: bytes, priority: int) -> Tuple[str, Dict[str, Any]]:
+    """Petite requête sur le coin de l'en-tête (sans accès à la session) : (numéro ou "", métriques)"""
+    content, call_metrics = create_vision_completion(
+        client, FACT_CROP_PROMPT, crop_fact_region(image_bytes), model=VISION_MODEL_FAST,
+        max_tokens=FACT_CROP_MAX_TOKENS, detail="low", priority=priority
+    )
+    match = re.search(r'\d{4,}', content.replace(" ", ""))
+    return (match.group() if match else ""), call_metrics
+
+def start_fact_crop_reading(image_bytes: bytes):
+    """Lance la lecture ciblée du coin de l'en-tête, en parallèle de l'extraction principale (None si désactivée)"""
+    if not FACT_CROP_ENABLED:
+        return None
+    client = get_openai_client()
+    if not client:
+        return None
+    priority = st.session_state.get("openai_priority", OPENAI_PRIORITY_INTERACTIVE)
+    return get_analysis_executor().submit(read_fact_number, client, image_bytes, priority)
+
+def discard_fact_crop_reading(future):
+    """Document autre qu'un BDC : lecture ciblée annulée, ou son coût compté à part si déjà partie"""
+    if future is None or future.cancel():
+        return
+    
+    def record_discarded(done):
+        if done.cancelled() or done.exception() is not None:
+            return
+        stats = get_fact_crop_stats()
+        with stats["lock"]:
+            stats["discarded"] += 1
+            stats["discarded_cost_usd"] += done.result()[1]["cost_usd"]
+    future.add_done_callback(record_discarded)
+
+def collect_fact_crop_reading(future, main_value: str) -> Optional[Dict[str, Any]]:
+    """Récupère la lecture ciblée, met à jour les compteurs ; None si indisponible ou en échec"""
+    if future is None:
+        return None
+    try:
+        value, call_metrics = future.result()
+    except Exception:
+        return None
+    
+    stats = get_fact_crop_stats()
+    with stats["lock"]:
+        stats["calls"] += 1
+        stats["found"] += 1 if value else 0
+        stats["disagreements"] += 1 if value and main_value and value != main_value else 0
+        stats["latency_total"] += call_metrics["latency"]
+        stats["tokens_total"] += call_metrics["prompt_tokens"] + call_metrics["completion_tokens"]
+        stats["cost_usd"] += call_metrics["cost_usd"]
+    return {"value": value, "main_value": main_value, "call": call_metrics}
+
+def choose_fact_number(main_value: str, crop_value: str, text_value: str) -> Tuple[str, str]:
+    """
+    Numéro Fact retenu et sa source, à partir des trois lectures
+    
+    La lecture pleine page reste la référence. La lecture ciblée (modèle rapide, détail
+    "low") complète une valeur absente, et ne l'emporte sur un désaccord que si le texte
+    brut donne le même numéro qu'elle.
+    """
+    if main_value:
+        if crop_value and crop_value != main_value and text_value == crop_value:
+            return crop_value, "Lecture ciblée confirmée par le texte brut"
+        return main_value, "Lecture pleine page"
+    if crop_value:
+        return crop_value, "Lecture ciblée du coin de l'en-tête"
+    if text_value:
+        return text_value, "Fact manuscrit extrait du texte brut"
+    return "", ""
+
+#=============================================================
+def analyze_document_core(image_bytes: bytes) -> Dict:
     """Analyse le document avec vérification de cohérence - VERSION MISE À JOUR"""
     
-    result = openai_vision_ocr_improved(image_bytes)
+    # Numéro Fact relu sur le coin de l'en-tête, en parallèle de l'extraction principale
+    fact_crop_future = start_fact_crop_reading(image_bytes)
+    
+    # Longs tableaux : bandes de lignes en parallèle, sinon analyse pleine page
+    try:
+        result = openai_vision_ocr_tiled(image_bytes) or openai_vision_ocr_cascade(image_bytes)
+    except BaseException:
+        discard_fact_crop_reading(fact_crop_future)
+        raise
+    
+    # Lecture ciblée retenue pour les seuls BDC
+    fact_crop = None
+    if result and result.get("type_document") == "BDC":
+        fact_crop = collect_fact_crop_reading(fact_crop_future, result.get("fact_manuscrit", ""))
+    else:
+        discard_fact_crop_reading(fact_crop_future)
     
     if not result:
         return {"type_document": "DOCUMENT INCONNU", "articles": []}
 
-    ocr_text = st.session_state.ocr_raw_text or ""
+    st.session_state.fact_crop_info = fact_crop
+    if fact_crop:
+        cascade = dict(st.session_state.vision_cascade or {})
+        cascade["tiers"] = list(cascade.get("tiers", [])) + [fact_crop["call"]]
+        st.session_state.vision_cascade = cascade
+    
+    replay = dict(st.session_state.ocr_replay or {})
+    replay["fact_crop"] = fact_crop["value"] if fact_crop else ""
+    st.session_state.ocr_replay = replay
+    
+    result = post_process_analysis(result, st.session_state.ocr_raw_text or "", replay["fact_crop"])
+    if fact_crop:
+        fact_crop["retained"] = result.get("fact_manuscrit", "")
+    return result
+
+def post_process_analysis(result: Dict, ocr_text: str, fact_crop_value: str = "") -> Dict:
+    """Étapes locales après la réponse Vision : numéro Fact, règle DOIT M, contrôle croisé du sous-type"""
 
     # ============================================================
     # 1. CAS BDC : extraction numéro manuscrit
     # ============================================================
-    if ocr_text and result.get("type_document") == "BDC":
-        fact_manuscrit = extract_fact_number_from_handwritten(ocr_text)
+    if result.get("type_document") == "BDC":
+        main_value = result.get("fact_manuscrit", "") or ""
+        text_value = extract_fact_number_from_handwritten(ocr_text) if ocr_text else ""
+        fact_manuscrit, source = choose_fact_number(main_value, fact_crop_value, text_value)
         
-        if fact_manuscrit and not result.get("fact_manuscrit"):
+        if fact_manuscrit and fact_manuscrit != main_value:
             result["fact_manuscrit"] = fact_manuscrit
             result["numero"] = fact_manuscrit
+            st.session_state.fact_manuscrit = fact_manuscrit
             
             st.session_state.document_analysis_details = {
-                "action": "Fact manuscrit extrait du texte brut",
+                "action": source,
                 "fact": fact_manuscrit
             }
 
@@ -2288,27 +3209,1479 @@ def analyze_document_with_backup(image_bytes: bytes) -> Dict:
 
     return result
 
-#===============================================================
-# FONCTIONS UTILITAIRES
 # ============================================================
-def preprocess_image(b: bytes) -> bytes:
-    """Prétraitement de l'image pour améliorer la qualité"""
-    img = Image.open(BytesIO(b)).convert("RGB")
-    img = ImageOps.autocontrast(img)
-    img = img.filter(ImageFilter.UnsharpMask(radius=1.2, percent=180))
+# RÉPARATION CIBLÉE DES CHAMPS MANQUANTS (SANS RÉANALYSE COMPLÈTE)
+# ============================================================
+FIELD_REPAIR_DESCRIPTIONS = {
+    "fact_manuscrit": 'le numéro manuscrit écrit après "F" ou "Fact", SANS le F/Fact (si "F" et "Fact" coexistent, prendre celui de "Fact")',
+    "date": "la date écrite sur le document (pas la date du scan), au format JJ/MM/AAAA",
+    "numero_facture": "le numéro de la facture",
+}
+FIELD_REPAIR_MAX_TOKENS = 200
+HEADER_CROP_RATIO = 0.35
+
+def is_valid_document_date(value: Any) -> bool:
+    """Vérifie qu'une date extraite est lisible (sans repli sur la date du jour)"""
+    if not str(value or "").strip():
+        return False
+    try:
+        parser.parse(str(value), dayfirst=True)
+        return True
+    except (ValueError, OverflowError):
+        return False
+
+def detect_missing_fields(result: Optional[Dict]) -> List[str]:
+    """Liste les champs clés absents ou invalides dans le résultat Vision"""
+    if not result:
+        return []
+    
+    missing = []
+    document_subtype = str(result.get("document_subtype", "")).upper()
+    is_facture = document_subtype == "FACTURE" or "FACTURE" in str(result.get("type_document", "")).upper()
+    
+    if not is_facture and not re.fullmatch(r'\d{4,}', str(result.get("fact_manuscrit", "") or "").strip()):
+        missing.append("fact_manuscrit")
+    if not is_valid_document_date(result.get("date")):
+        missing.append("date")
+    if is_facture and not str(result.get("numero_facture", "") or "").strip():
+        missing.append("numero_facture")
+    
+    return missing
+
+def crop_header_region(image_bytes: bytes, height_ratio: float = HEADER_CROP_RATIO) -> bytes:
+    """Découpe la bande supérieure (entête) du document"""
+    img = Image.open(BytesIO(image_bytes)).convert("RGB")
+    width, height = img.size
+    header = img.crop((0, 0, width, max(1, int(height * height_ratio))))
     out = BytesIO()
-    img.save(out, format="PNG", optimize=True, quality=95)
+    header.save(out, format="PNG")
     return out.getvalue()
 
-def encode_image_to_base64(image_bytes: bytes) -> str:
-    """Encode l'image en base64 pour OpenAI Vision"""
-    return base64.b64encode(image_bytes).decode('utf-8')
-
-def clean_text(text: str) -> str:
-    """Nettoie le texte"""
-    text = text.replace("\r", "\n")
-    text = re.sub(r"[^\S\r\n]+", " ", text)
-    return text.strip()
+def repair_missing_fields(image_bytes: bytes, result: Dict, fields: Optional[List[str]] = None,
+                          use_header_crop: bool = True) -> Tuple[Dict, Dict[str, Any]]:
+    """
+    Redemande uniquement les champs manquants (requête courte, entête recadré en option)
+    et fusionne la réponse dans le résultat existant
+    
+    Returns:
+        Tuple (résultat fusionné, détails de la réparation)
+    """
+    fields = [f for f in (fields or detect_missing_fields(result)) if f in FIELD_REPAIR_DESCRIPTIONS]
+    details = {"requested": fields, "filled": [], "header_crop": use_header_crop, "call": None}
+    if not fields:
+        return result, details
+    
+    client = get_openai_client()
+    if not client:
+        return result, details
+    
+    field_lines = "\n".join(f'- "{field}": {FIELD_REPAIR_DESCRIPTIONS[field]}' for field in fields)
+    prompt = f"""
+Sur cette image de document (facture ou bon de commande), extrais UNIQUEMENT les champs suivants:
+{field_lines}
+
+Réponds uniquement avec un objet JSON contenant ces clés. Laisse la valeur vide si le champ n'est pas visible.
+"""
+    
+    target_bytes = crop_header_region(image_bytes) if use_header_crop else image_bytes
+    content, call_metrics = create_vision_completion(
+        client, prompt, target_bytes, model=VISION_MODEL_FULL, max_tokens=FIELD_REPAIR_MAX_TOKENS,
+        priority=st.session_state.get("openai_priority", OPENAI_PRIORITY_INTERACTIVE)
+    )
+    details["call"] = call_metrics
+    
+    json_match = re.search(r'\{.*\}', content, re.DOTALL)
+    try:
+        answer = json.loads(json_match.group()) if json_match else {}
+    except json.JSONDecodeError:
+        answer = {}
+    
+    merged, details["filled"] = merge_repaired_fields(result, answer, fields)
+    if details["filled"]:
+        # Conservé avec la réponse Vision : « Réappliquer les règles » ne perd pas les champs complétés
+        replay = dict(st.session_state.ocr_replay or {})
+        replay["repairs"] = dict(replay.get("repairs") or {}, **{field: merged[field] for field in details["filled"]})
+        st.session_state.ocr_replay = replay
+    
+    return merged, details
+
+def merge_repaired_fields(result: Dict, answer: Dict, fields: List[str]) -> Tuple[Dict, List[str]]:
+    """Fusionne les valeurs valides de la réponse ciblée dans le résultat ; retourne (résultat, champs complétés)"""
+    merged, filled = dict(result), []
+    for field in fields:
+        value = str(answer.get(field, "") or "").strip()
+        if field == "fact_manuscrit":
+            value = re.sub(r'\D', '', value)
+            if len(value) < 4:
+                continue
+            merged["fact_manuscrit"] = value
+            merged["numero"] = value
+            st.session_state.fact_manuscrit = value
+        elif field == "date":
+            if not is_valid_document_date(value):
+                continue
+            merged["date"] = value
+        elif value:
+            merged[field] = value
+        else:
+            continue
+        filled.append(field)
+    return merged, filled
+
+# ============================================================
+# DÉCOUPAGE DES LONGS TABLEAUX EN BANDES DE LIGNES
+# ============================================================
+# Nombre minimal de lignes d'articles (délimitées par des traits) pour découper le tableau
+TABLE_TILING_MIN_ROWS = 25
+TABLE_STRIP_ROWS = 12
+# Lignes répétées entre deux bandes consécutives (dédoublonnées à la fusion)
+TABLE_STRIP_OVERLAP_ROWS = 2
+TABLE_STRIP_MAX_TOKENS = 1500
+# Écart toléré entre deux traits du tableau (facteur de l'écart médian, dans les deux sens)
+TABLE_RULING_SPACING_TOLERANCE = 2.0
+ARTICLE_MATCH_MIN_SIMILARITY = 0.92
+
+TABLE_HEADER_PROMPT_SUFFIX = """
+
+ATTENTION: le tableau des articles a été retiré de cette image (il est analysé séparément).
+Extraire uniquement les informations d'en-tête et renvoyer "articles": [].
+"""
+
+TABLE_STRIP_PROMPT = """
+Cette image est une portion du tableau des articles d'un document (facture ou bon de commande).
+La première ligne contient les titres des colonnes du tableau.
+
+Retourne UNIQUEMENT ce JSON, avec une entrée par ligne du tableau visible sous les titres, dans l'ordre:
+{
+    "articles": [
+        {"article_brut": "TEXTE EXACT de la colonne Désignation", "quantite": nombre}
+    ]
+}
+
+RÈGLES:
+- Recopier aussi les lignes de catégorie (ex: "VINS ROUGES") avec leur quantité éventuelle
+- Quantité: colonne "Qté" / "Nb bills" (PAS "Btlls/colis")
+- Ne pas inventer de lignes ; ne pas inclure les titres de colonnes
+"""
+
+@st.cache_resource
+def get_analysis_executor() -> ThreadPoolExecutor:
+    """Pool de threads des analyses découpées (bandes, pages, photos) ; distinct du pool des requêtes Vision"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="analysis")
+
+def find_horizontal_rulings(gray: np.ndarray) -> Tuple[List[int], int, int]:
+    """
+    Repère les traits horizontaux longs (lignes du tableau)
+    
+    Returns:
+        Tuple (ordonnées des traits, abscisse min, abscisse max)
+    """
+    binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 15, 10)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(20, gray.shape[1] // 3), 1))
+    horizontal = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+    
+    rows = np.flatnonzero(horizontal.any(axis=1))
+    if len(rows) == 0:
+        return [], 0, gray.shape[1]
+    
+    rulings = []
+    group = [rows[0]]
+    for y in rows[1:]:
+        if y - group[-1] <= 2:
+            group.append(y)
+        else:
+            rulings.append(int(np.mean(group)))
+            group = [y]
+    rulings.append(int(np.mean(group)))
+    
+    columns = np.flatnonzero(horizontal.any(axis=0))
+    return rulings, int(columns.min()), int(columns.max())
+
+def select_table_rulings(rulings: List[int]) -> List[int]:
+    """
+    Garde la plus longue suite de traits régulièrement espacés : le tableau
+    
+    Les autres traits longs (cadre d'en-tête, lignes de signature) restent dans l'en-tête
+    ou le pied de page au lieu d'être pris pour le haut ou le bas du tableau.
+    """
+    if len(rulings) < 3:
+        return rulings
+    gaps = np.diff(rulings)
+    median_gap = float(np.median(gaps))
+    regular = [median_gap / TABLE_RULING_SPACING_TOLERANCE <= gap <= median_gap * TABLE_RULING_SPACING_TOLERANCE
+               for gap in gaps]
+    
+    best_start, best_length, start = 0, 0, 0
+    for i, is_regular in enumerate(regular + [False]):
+        if not is_regular:
+            if i - start > best_length:
+                best_start, best_length = start, i - start
+            start = i + 1
+    return rulings[best_start:best_start + best_length + 1] if best_length else rulings[:1]
+
+def detect_table_layout(image_bytes: bytes) -> Optional[Dict[str, Any]]:
+    """Détecte un long tableau réglé ; None si le document est court ou sans traits exploitables"""
+    if cv2 is None:
+        return None
+    img = decode_image_cv(image_bytes)
+    if img is None:
+        return None
+    
+    rulings, x_min, x_max = find_horizontal_rulings(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+    rulings = select_table_rulings(rulings)
+    # Premier intervalle = titres des colonnes, les suivants = lignes d'articles
+    if len(rulings) - 2 < TABLE_TILING_MIN_ROWS:
+        return None
+    return {"image": img, "rulings": rulings, "x_min": x_min, "x_max": x_max, "rows": len(rulings) - 2}
+
+def build_table_tiles(layout: Dict[str, Any]) -> Tuple[bytes, List[bytes]]:
+    """
+    Construit l'image d'en-tête (document sans le tableau) et les bandes de lignes chevauchantes
+    
+    Chaque bande reprend la ligne des titres de colonnes au-dessus de ses lignes.
+    """
+    img, rulings = layout["image"], layout["rulings"]
+    height = img.shape[0]
+    
+    top, bottom = img[:max(rulings[0], 1)], img[min(rulings[-1] + 1, height - 1):]
+    header = np.vstack([top, bottom]) if bottom.shape[0] > 20 else top
+    if header.shape[0] < 0.05 * height:
+        header = img
+    
+    column_titles = img[max(rulings[0] - 2, 0):rulings[1] + 2]
+    strips = []
+    step = TABLE_STRIP_ROWS - TABLE_STRIP_OVERLAP_ROWS
+    for first_row in range(1, len(rulings) - 1, step):
+        last_row = min(first_row + TABLE_STRIP_ROWS, len(rulings) - 1)
+        strips.append(encode_png_cv(np.vstack([column_titles, img[rulings[first_row]:rulings[last_row] + 2]])))
+        if last_row == len(rulings) - 1:
+            break
+    
+    return encode_png_cv(header), strips
+
+def parse_strip_articles(content: str) -> List[Dict]:
+    """Articles renvoyés pour une bande (liste vide si la réponse est inexploitable)"""
+    json_match = re.search(r'\{.*\}', content, re.DOTALL)
+    try:
+        data = json.loads(json_match.group()) if json_match else {}
+    except json.JSONDecodeError:
+        return []
+    articles = data.get("articles", [])
+    return [article for article in articles if isinstance(article, dict)]
+
+def articles_match(first: Dict, second: Dict) -> bool:
+    """Deux lignes lues dans des bandes différentes désignent-elles la même ligne du tableau ?"""
+    name_first = re.sub(r'\s+', ' ', str(first.get("article_brut", ""))).strip().upper()
+    name_second = re.sub(r'\s+', ' ', str(second.get("article_brut", ""))).strip().upper()
+    if str(first.get("quantite", "")).strip() != str(second.get("quantite", "")).strip():
+        return False
+    return name_first == name_second or jellyfish.jaro_winkler_similarity(name_first, name_second) >= ARTICLE_MATCH_MIN_SIMILARITY
+
+def merge_overlapping_article_lists(article_lists: List[List[Dict]],
+                                    max_overlap: int = TABLE_STRIP_OVERLAP_ROWS + 1) -> List[Dict]:
+    """Concatène les articles des bandes en retirant les lignes lues deux fois dans les zones de chevauchement"""
+    merged = []
+    for articles in article_lists:
+        overlap = 0
+        for size in range(min(len(merged), len(articles), max_overlap), 0, -1):
+            if all(articles_match(a, b) for a, b in zip(merged[-size:], articles[:size])):
+                overlap = size
+                break
+        merged.extend(articles[overlap:])
+    return merged
+
+def openai_vision_ocr_tiled(image_bytes: bytes) -> Optional[Dict]:
+    """
+    Long tableau : en-tête et bandes de lignes extraits en parallèle, puis fusionnés
+    
+    Returns:
+        Résultat d'analyse, ou None si le document ne s'y prête pas (analyse pleine page à faire)
+    """
+    layout = detect_table_layout(image_bytes)
+    if layout is None:
+        return None
+    client = get_openai_client()
+    if not client:
+        return None
+    
+    header_bytes, strip_images = build_table_tiles(layout)
+    priority = st.session_state.get("openai_priority", OPENAI_PRIORITY_INTERACTIVE)
+    executor = get_analysis_executor()
+    started = time.perf_counter()
+    
+    header_future = executor.submit(
+        create_vision_completion, client, VISION_EXTRACTION_PROMPT + TABLE_HEADER_PROMPT_SUFFIX,
+        header_bytes, VISION_MODEL_FULL, VISION_MAX_TOKENS, "auto", priority
+    )
+    strip_futures = [
+        executor.submit(create_vision_completion, client, TABLE_STRIP_PROMPT, strip,
+                        VISION_MODEL_FULL, TABLE_STRIP_MAX_TOKENS, "auto", priority)
+        for strip in strip_images
+    ]
+    try:
+        header_content, header_call = header_future.result()
+        strip_results = [future.result() for future in strip_futures]
+    except (VisionUnavailableError,) + VISION_OUTAGE_ERRORS:
+        raise
+    except Exception:
+        return None
+    wall_time = time.perf_counter() - started
+    
+    result = parse_vision_content(header_content)
+    if not result:
+        return None
+    result["articles"] = merge_overlapping_article_lists(
+        [parse_strip_articles(content) for content, _ in strip_results]
+    )
+    
+    calls = [header_call] + [call for _, call in strip_results]
+    for call in calls:
+        record_vision_tier_call(call, accepted=True)
+    
+    st.session_state.ocr_raw_text = "\n".join([header_content] + [content for content, _ in strip_results])
+    st.session_state.ocr_replay = {"main": header_content, "strips": [content for content, _ in strip_results]}
+    st.session_state.last_vision_call = header_call
+    st.session_state.vision_cascade = {
+        "tiers": calls,
+        "escalated": False,
+        "reasons": [],
+        "tiling": {
+            "rows": layout["rows"],
+            "strips": len(strip_images),
+            "wall_time": wall_time,
+            "longest_call": max(call["latency"] + call["queue_wait"] for call in calls)
+        }
+    }
+    return result
+
+# ============================================================
+# DOCUMENTS EN PLUSIEURS IMAGES (PHOTOS SUCCESSIVES, PAGES)
+# ============================================================
+# Lignes pouvant apparaître sur deux photos successives d'un même document
+PHOTO_MAX_OVERLAP_ROWS = 10
+PDF_RENDER_DPI = 200
+PDF_MAX_PAGES = 30
+
+CONTINUATION_ARTICLES_PROMPT = """
+Cette image est la suite d'un document (facture ou bon de commande) dont l'en-tête a déjà été lu.
+
+Retourne UNIQUEMENT ce JSON, avec une entrée par ligne du tableau des articles visible, dans l'ordre:
+{
+    "articles": [
+        {"article_brut": "TEXTE EXACT de la colonne Désignation", "quantite": nombre}
+    ]
+}
+
+RÈGLES:
+- Recopier aussi les lignes de catégorie (ex: "VINS ROUGES") avec leur quantité éventuelle
+- Quantité: colonne "Qté" / "Nb bills" (PAS "Btlls/colis")
+- Ignorer l'en-tête, les titres de colonnes, les totaux et les signatures
+- Ne pas inventer de lignes ; renvoyer "articles": [] si aucun tableau n'est visible
+"""
+
+def is_pdf_upload(uploaded_file) -> bool:
+    """Le fichier déposé est-il un PDF ?"""
+    return uploaded_file.name.lower().endswith(".pdf") or uploaded_file.type == "application/pdf"
+
+class PdfPageError(Exception):
+    """PDF refusé avant toute analyse (aucune page, ou trop de pages pour être lu en entier)"""
+
+@st.cache_resource
+def get_pdfium_lock() -> threading.Lock:
+    """Verrou du processus autour de tout appel pdfium (bibliothèque non thread-safe, partagée par les sessions)"""
+    return threading.Lock()
+
+def count_pdf_pages(pdf_bytes: bytes) -> int:
+    """Nombre de pages du PDF"""
+    if pdfium is None:
+        raise RuntimeError("Lecture PDF indisponible : installer pypdfium2")
+    with get_pdfium_lock():
+        document = pdfium.PdfDocument(pdf_bytes)
+        try:
+            return len(document)
+        finally:
+            document.close()
+
+def check_pdf_pages(pdf_bytes: bytes) -> int:
+    """Refuse un PDF vide ou trop long (les articles des pages non lues seraient perdus) ; retourne le nombre de pages"""
+    page_count = count_pdf_pages(pdf_bytes)
+    if page_count == 0:
+        raise PdfPageError("Le PDF ne contient aucune page")
+    if page_count > PDF_MAX_PAGES:
+        raise PdfPageError(f"PDF de {page_count} pages : au-delà de {PDF_MAX_PAGES} pages, découpez le fichier "
+                           f"pour qu'aucun article ne soit perdu")
+    return page_count
+
+def iter_pdf_pages(pdf_bytes: bytes, dpi: int = PDF_RENDER_DPI) -> Iterator[bytes]:
+    """
+    Rastérise les pages du PDF une à une et renvoie l'image prétraitée de chacune
+    
+    Une seule page est décodée en mémoire à la fois. Chaque appel pdfium se fait sous le
+    verrou du processus (pdfium n'est pas thread-safe) ; la compression et le prétraitement
+    de l'image se font hors verrou.
+    """
+    if pdfium is None:
+        raise RuntimeError("Lecture PDF indisponible : installer pypdfium2")
+    lock = get_pdfium_lock()
+    with lock:
+        document = pdfium.PdfDocument(pdf_bytes)
+        page_count = len(document)
+    try:
+        for index in range(min(page_count, PDF_MAX_PAGES)):
+            with lock:
+                page = document[index]
+                bitmap = page.render(scale=dpi / 72)
+                image = bitmap.to_pil().convert("RGB").copy()
+                bitmap.close()
+                page.close()
+            buffer = BytesIO()
+            image.save(buffer, format="JPEG", quality=92)
+            yield prepare_document_image(buffer.getvalue())[0]
+    finally:
+        with lock:
+            document.close()
+
+def merge_part_article_lists(article_lists: List[List[Dict]], overlapping: bool) -> List[Dict]:
+    """Fusionne les articles des photos successives (recouvrement possible) ou des pages (simple concaténation)"""
+    if overlapping:
+        return merge_overlapping_article_lists(article_lists, max_overlap=PHOTO_MAX_OVERLAP_ROWS)
+    return [article for articles in article_lists for article in articles]
+
+def analyze_document_parts(parts: Iterable[bytes], overlapping: bool = True,
+                           labels: Optional[List[str]] = None, label_prefix: str = "Photo") -> Dict:
+    """
+    Analyse un document réparti sur plusieurs images
+    
+    La première image passe par l'analyse complète (en-tête + articles) pendant que les
+    suivantes sont lues en parallèle (articles seuls) dès qu'elles sont produites : `parts`
+    peut être un générateur (pages d'un PDF rastérisées une à une). Les articles sont ensuite
+    fusionnés, en retirant les lignes présentes sur deux images successives si overlapping=True.
+    """
+    parts = iter(parts)
+    started = time.perf_counter()
+    first_part = next(parts, None)
+    if first_part is None:
+        raise ValueError("Aucune image à analyser")
+    first_ready = time.perf_counter() - started
+    # Image de référence du document (aperçu, requêtes ciblées sur l'en-tête)
+    st.session_state.processed_image_bytes = first_part
+    client = get_openai_client()
+    
+    priority = st.session_state.get("openai_priority", OPENAI_PRIORITY_INTERACTIVE)
+    executor = get_analysis_executor()
+    futures, render_times, feeder_errors = [], [], []
+    stop = threading.Event()
+    
+    def submit_remaining_parts():
+        # Thread dédié : production des images (sans session Streamlit) et envoi au fil de l'eau
+        try:
+            while not stop.is_set():
+                produced = time.perf_counter()
+                part = next(parts, None)
+                if part is None or stop.is_set():
+                    return
+                render_times.append(time.perf_counter() - produced)
+                futures.append(executor.submit(create_vision_completion, client, CONTINUATION_ARTICLES_PROMPT, part,
+                                               VISION_MODEL_FULL, VISION_MAX_TOKENS, "auto", priority))
+        except Exception as e:
+            feeder_errors.append(e)
+    
+    feeder = threading.Thread(target=submit_remaining_parts, daemon=True) if client else None
+    if feeder:
+        feeder.start()
+    try:
+        first_started = time.perf_counter()
+        result = analyze_document_with_backup(first_part)
+        first_duration = time.perf_counter() - first_started
+        if feeder:
+            feeder.join()
+        if feeder_errors:
+            raise feeder_errors[0]
+        continuations = [future.result() for future in futures]
+    except BaseException:
+        # Plus aucune page rendue ni appel Vision soumis après l'échec
+        stop.set()
+        if feeder:
+            feeder.join()
+        for future in futures:
+            future.cancel()
+        close_parts = getattr(parts, "close", None)
+        if close_parts:
+            close_parts()
+        raise
+    
+    if not continuations:
+        return result
+    labels = labels or [f"{label_prefix} {index}" for index in range(1, len(continuations) + 2)]
+    
+    article_lists = [result.get("articles", [])] + [parse_strip_articles(content) for content, _ in continuations]
+    result["articles"] = merge_part_article_lists(article_lists, overlapping)
+    
+    cascade = dict(st.session_state.vision_cascade or {})
+    calls = [call for _, call in continuations]
+    cascade["tiers"] = list(cascade.get("tiers", [])) + calls
+    cascade["parts"] = [
+        {"label": labels[0], "prepare_seconds": first_ready, "seconds": first_duration, "articles": len(article_lists[0])}
+    ] + [
+        {"label": label, "prepare_seconds": render_time, "seconds": call["latency"] + call["queue_wait"],
+         "articles": len(articles)}
+        for label, render_time, call, articles in zip(labels[1:], render_times, calls, article_lists[1:])
+    ]
+    cascade["parts_wall_time"] = time.perf_counter() - started
+    st.session_state.vision_cascade = cascade
+    st.session_state.ocr_raw_text = "\n".join(
+        [st.session_state.ocr_raw_text or ""] + [content for content, _ in continuations]
+    )
+    st.session_state.ocr_replay = dict(st.session_state.ocr_replay or {},
+                                       continuations=[content for content, _ in continuations],
+                                       overlapping=overlapping)
+    for call in calls:
+        record_vision_tier_call(call, accepted=True)
+    return result
+
+# ============================================================
+# RÉANALYSE LOCALE DEPUIS LA RÉPONSE VISION ENREGISTRÉE
+# ============================================================
+def rebuild_result_from_replay(replay: Dict[str, Any]) -> Optional[Dict]:
+    """
+    Rejoue les étapes locales sur les réponses brutes enregistrées (aucun appel OpenAI)
+    
+    Lecture JSON et corrections par client, fusion des bandes et des photos/pages,
+    numéro Fact, règle DOIT M, contrôle croisé du sous-type, puis champs complétés
+    par une réparation ciblée s'ils manquent encore.
+    """
+    main_content = (replay or {}).get("main")
+    if not main_content:
+        return None
+    
+    result = parse_vision_content(main_content)
+    if not result:
+        return None
+    strips = replay.get("strips")
+    if strips:
+        result["articles"] = merge_overlapping_article_lists([parse_strip_articles(content) for content in strips])
+    
+    ocr_text = "\n".join([main_content] + list(strips or []))
+    result = post_process_analysis(result, ocr_text, replay.get("fact_crop", ""))
+    
+    continuations = replay.get("continuations")
+    if continuations:
+        article_lists = [result.get("articles", [])] + [parse_strip_articles(content) for content in continuations]
+        result["articles"] = merge_part_article_lists(article_lists, replay.get("overlapping", True))
+    
+    repairs = replay.get("repairs")
+    if repairs:
+        missing = [field for field in detect_missing_fields(result) if field in repairs]
+        result, _ = merge_repaired_fields(result, repairs, missing)
+    return result
+
+def replay_document_analysis() -> bool:
+    """Réapplique les règles actuelles au document courant à partir de sa réponse Vision enregistrée"""
+    replay = st.session_state.ocr_replay
+    if not replay:
+        return False
+    
+    started = time.perf_counter()
+    st.session_state.fact_manuscrit = ""
+    st.session_state.quartier_s2m = ""
+    st.session_state.nom_magasin_ulys = ""
+    st.session_state.document_analysis_details = {}
+    result = rebuild_result_from_replay(replay)
+    if result is None:
+        return False
+    
+    st.session_state.duplicate_check_done = False
+    st.session_state.duplicate_found = False
+    st.session_state.duplicate_action = None
+    st.session_state.export_triggered = False
+    st.session_state.export_status = None
+    st.session_state.product_matching_scores = {}
+    for widget_key in DOCUMENT_FIELD_WIDGET_KEYS:
+        st.session_state.pop(widget_key, None)
+    apply_analysis_result(result, cached_disambiguation_only=True)
+    st.session_state.replay_info = {"seconds": time.perf_counter() - started, "articles": len(result.get("articles", []))}
+    return True
+
+# ============================================================
+# DÉSAMBIGUÏSATION GROUPÉE DES LIGNES À FAIBLE CONFIANCE
+# ============================================================
+DISAMBIGUATION_ENABLED = str(get_openai_setting("disambiguation", "1")).lower() in ["1", "true", "oui"]
+# Tokens de réponse prévus par ligne envoyée (objet JSON court)
+DISAMBIGUATION_TOKENS_PER_LINE = 25
+# En dessous, le choix du modèle est ignoré et la ligne reste à vérifier
+DISAMBIGUATION_MIN_CONFIDENCE = 0.5
+DISAMBIGUATION_SOURCE_LOCAL = "Catalogue"
+DISAMBIGUATION_SOURCE_AI = "IA (texte)"
+DISAMBIGUATION_SOURCE_REVIEW = "À vérifier"
+
+DISAMBIGUATION_PROMPT = """
+Tu rapproches des désignations lues sur des bons de commande d'un catalogue de vins et spiritueux.
+
+CATALOGUE (numéro: produit):
+{catalog}
+
+DÉSIGNATIONS À RAPPROCHER (numéro: texte lu):
+{lines}
+
+Pour chaque désignation, choisis le produit du catalogue correspondant (couleur, gamme et contenance).
+Si aucun produit ne correspond de façon sûre, mets null.
+
+Réponds UNIQUEMENT avec ce JSON:
+{{"choix": [{{"ligne": 1, "produit": 12, "confiance": 0.9}}]}}
+"""
+
+@st.cache_resource
+def get_disambiguation_cache() -> Dict[str, Any]:
+    """Choix déjà obtenus par désignation normalisée (partagés entre sessions) et compteurs"""
+    return {
+        "lock": threading.Lock(),
+        "picks": {},
+        "calls": 0,
+        "lines_sent": 0,
+        "lines_cached": 0,
+        "lines_picked": 0,
+        "cost_usd": 0.0
+    }
+
+def get_disambiguation_catalog() -> List[str]:
+    """Catalogue sans doublons, dans l'ordre de STANDARD_PRODUCTS"""
+    return list(dict.fromkeys(STANDARD_PRODUCTS))
+
+def find_low_confidence_rows(df: pd.DataFrame) -> List[int]:
+    """Index des lignes d'articles non standardisées automatiquement (partial_match / no_match)"""
+    if df is None or df.empty or "Auto" not in df.columns:
+        return []
+    return [
+        index for index, row in df.iterrows()
+        if not bool(row.get("Auto")) and str(row.get("Produit Brute") or "").strip()
+        and not is_category_line(row.get("Produit Brute"))
+    ]
+
+def parse_disambiguation_picks(content: str, line_count: int, catalog: List[str]) -> Dict[int, Tuple[Optional[str], float]]:
+    """Lit la réponse JSON ; seuls les numéros présents dans le catalogue sont retenus"""
+    json_match = re.search(r'\{.*\}', content or "", re.DOTALL)
+    if not json_match:
+        return {}
+    try:
+        data = json.loads(json_match.group())
+    except json.JSONDecodeError:
+        return {}
+    
+    picks = {}
+    for choice in data.get("choix", []) if isinstance(data, dict) else []:
+        try:
+            line = int(choice.get("ligne"))
+            confidence = float(choice.get("confiance", 0) or 0)
+        except (TypeError, ValueError, AttributeError):
+            continue
+        if not 1 <= line <= line_count:
+            continue
+        # Numéro de produit parfois renvoyé en texte ("3") ; null ou texte libre = aucun choix
+        try:
+            product = int(choice.get("produit"))
+        except (TypeError, ValueError):
+            product = None
+        if product is not None and 1 <= product <= len(catalog) and confidence >= DISAMBIGUATION_MIN_CONFIDENCE:
+            picks[line - 1] = (catalog[product - 1], min(confidence, 1.0))
+        else:
+            picks[line - 1] = (None, 0.0)
+    return picks
+
+def disambiguate_designations(designations: List[str], priority: int = OPENAI_PRIORITY_INTERACTIVE,
+                              cached_only: bool = False) -> Tuple[Dict[str, Tuple[Optional[str], float]], Dict[str, Any]]:
+    """
+    Rapproche du catalogue, en une seule requête texte, les désignations pas encore connues
+    
+    Returns:
+        Tuple (choix par désignation normalisée : (produit ou None, confiance),
+               résumé: désignations envoyées, trouvées en cache, métriques de l'appel ou None)
+    """
+    cache = get_disambiguation_cache()
+    pending = {}
+    for designation in designations:
+        key = preprocess_text(designation)
+        if key:
+            pending.setdefault(key, designation.strip())
+    
+    with cache["lock"]:
+        picks = {key: cache["picks"][key] for key in pending if key in cache["picks"]}
+        cache["lines_cached"] += len(picks)
+    pending = {key: text for key, text in pending.items() if key not in picks}
+    summary = {"sent": 0, "cached": len(picks), "call": None}
+    if not pending or cached_only:
+        return picks, summary
+    
+    client = get_openai_client()
+    if not client:
+        return picks, summary
+    
+    catalog = get_disambiguation_catalog()
+    pending_keys = list(pending)
+    prompt = DISAMBIGUATION_PROMPT.format(
+        catalog="\n".join(f"{i}: {product}" for i, product in enumerate(catalog, 1)),
+        lines="\n".join(f"{i}: {pending[key]}" for i, key in enumerate(pending_keys, 1))
+    )
+    try:
+        content, call_metrics = create_text_completion(
+            client, prompt, model=VISION_MODEL_FAST,
+            max_tokens=50 + DISAMBIGUATION_TOKENS_PER_LINE * len(pending_keys), priority=priority
+        )
+    except Exception:
+        return picks, summary
+    
+    summary.update(sent=len(pending_keys), call=call_metrics)
+    new_picks = parse_disambiguation_picks(content, len(pending_keys), catalog)
+    with cache["lock"]:
+        cache["calls"] += 1
+        cache["lines_sent"] += len(pending_keys)
+        cache["cost_usd"] += call_metrics["cost_usd"]
+        for i, key in enumerate(pending_keys):
+            if i in new_picks:
+                picks[key] = new_picks[i]
+                # Seuls les choix confiants sont gardés : une réponse vide ou douteuse sera redemandée
+                if new_picks[i][0]:
+                    cache["picks"][key] = new_picks[i]
+                    cache["lines_picked"] += 1
+    return picks, summary
+
+def disambiguate_low_confidence_rows(frames: List[pd.DataFrame], priority: int = OPENAI_PRIORITY_INTERACTIVE,
+                                     cached_only: bool = False) -> Tuple[List[pd.DataFrame], Dict[str, Any]]:
+    """
+    Envoie en une requête les lignes à faible confiance d'un ou plusieurs documents et réintègre les choix
+    
+    Les lignes déjà rapprochées avec confiance ne quittent pas le poste. La colonne "Source"
+    indique l'origine du produit standard (catalogue local, IA texte, ou à vérifier).
+    Avec cached_only, seuls les choix déjà en cache sont appliqués (aucun appel).
+    
+    Returns:
+        Tuple (tableaux mis à jour, résumé: lignes, envoyées, en cache, choisies, métriques de l'appel)
+    """
+    rows_by_frame = [find_low_confidence_rows(df) for df in frames]
+    designations = [str(df.at[index, "Produit Brute"]) for df, rows in zip(frames, rows_by_frame) for index in rows]
+    info = {"lines": len(designations), "sent": 0, "cached": 0, "picked": 0, "call": None}
+    
+    picks = {}
+    if designations and DISAMBIGUATION_ENABLED:
+        picks, summary = disambiguate_designations(designations, priority, cached_only)
+        info.update(summary)
+    
+    updated = []
+    for df, rows in zip(frames, rows_by_frame):
+        df = df.copy()
+        if "Source" not in df.columns:
+            df["Source"] = DISAMBIGUATION_SOURCE_LOCAL
+        for index in rows:
+            product, confidence = picks.get(preprocess_text(str(df.at[index, "Produit Brute"])), (None, 0.0))
+            if product:
+                df.at[index, "Produit Standard"] = product
+                df.at[index, "Confiance"] = f"{confidence*100:.1f}%"
+                df.at[index, "Source"] = DISAMBIGUATION_SOURCE_AI
+                info["picked"] += 1
+            else:
+                df.at[index, "Source"] = DISAMBIGUATION_SOURCE_REVIEW
+        updated.append(df)
+    
+    return updated, info
+
+# ============================================================
+# FILE D'ATTENTE LOCALE (INBOX) PENDANT LES PANNES OCR
+# ============================================================
+LOCAL_DB_PATH = os.environ.get("CHANFOUI_LOCAL_DB", "chanfoui_local.db")
+INBOX_POLL_SECONDS = 10
+# Un document resté "processing" plus longtemps (session fermée en cours de route) est repris
+INBOX_STALE_SECONDS = 300
+INBOX_STATUS_LABELS = {
+    "pending": "⏳ En attente",
+    "processing": "⚙️ En cours",
+    "done": "✅ Analysé",
+    "error": "❌ Échec"
+}
+DOCUMENT_FIELD_WIDGET_KEYS = ["bdc_numero", "bdc_date", "facture_num", "facture_date", "facture_mois"]
+
+LOCAL_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_inbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    filename TEXT,
+    image BLOB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    result_json TEXT,
+    session_json TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_ocr_inbox_user_status ON ocr_inbox (username, status);
+CREATE TABLE IF NOT EXISTS sheets_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    document_type TEXT NOT NULL,
+    gid INTEGER NOT NULL,
+    rows_json TEXT NOT NULL,
+    fingerprint TEXT NOT NULL UNIQUE,
+    base_row_count INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    error TEXT,
+    action TEXT NOT NULL DEFAULT 'add_new',
+    client TEXT,
+    doc_number TEXT,
+    doc_date TEXT,
+    label TEXT,
+    duplicate_rows_json TEXT,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    base_recorded INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sheets_outbox_user_status ON sheets_outbox (username, status);
+CREATE TABLE IF NOT EXISTS quality_gate_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT,
+    created_at REAL NOT NULL,
+    passed INTEGER NOT NULL,
+    overridden INTEGER NOT NULL DEFAULT 0,
+    issues TEXT,
+    sharpness REAL,
+    paper_brightness REAL,
+    text_height REAL,
+    duration REAL
+);
+"""
+
+# Colonnes ajoutées après la création de la table : ajoutées aux bases locales existantes
+LOCAL_DB_ADDED_COLUMNS = {
+    "sheets_outbox": [
+        ("action", "TEXT NOT NULL DEFAULT 'add_new'"),
+        ("client", "TEXT"),
+        ("doc_number", "TEXT"),
+        ("doc_date", "TEXT"),
+        ("label", "TEXT"),
+        ("duplicate_rows_json", "TEXT"),
+        ("next_attempt_at", "REAL NOT NULL DEFAULT 0"),
+        ("base_recorded", "INTEGER NOT NULL DEFAULT 0")
+    ]
+}
+
+@st.cache_resource
+def init_local_db() -> str:
+    """Crée la base SQLite locale (une seule fois par processus) et retourne son chemin"""
+    with closing(sqlite3.connect(LOCAL_DB_PATH)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        for table, columns in LOCAL_DB_ADDED_COLUMNS.items():
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if existing:
+                for name, declaration in columns:
+                    if name not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+        conn.executescript(LOCAL_DB_SCHEMA)
+        conn.commit()
+    return LOCAL_DB_PATH
+
+def get_local_db() -> sqlite3.Connection:
+    """Ouvre une connexion à la base locale (une connexion par opération, partage entre threads/sessions)"""
+    conn = sqlite3.connect(init_local_db(), timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def enqueue_ocr_document(username: str, filename: str, image_bytes: bytes) -> int:
+    """Place un document dans la file d'attente locale et retourne son identifiant"""
+    now = time.time()
+    with closing(get_local_db()) as conn, conn:
+        cursor = conn.execute(
+            "INSERT INTO ocr_inbox (username, filename, image, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (username, filename, image_bytes, now, now)
+        )
+        return cursor.lastrowid
+
+def list_ocr_inbox(username: str) -> List[Dict[str, Any]]:
+    """Documents de l'utilisateur encore dans la file (sans les images)"""
+    with closing(get_local_db()) as conn:
+        rows = conn.execute(
+            "SELECT id, filename, status, attempts, created_at, updated_at, error FROM ocr_inbox "
+            "WHERE username = ? ORDER BY created_at",
+            (username,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+def claim_ocr_inbox_item(username: str) -> Optional[Dict[str, Any]]:
+    """Réserve le plus ancien document en attente (ou abandonné en cours de traitement)"""
+    now = time.time()
+    with closing(get_local_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT id, filename, image FROM ocr_inbox WHERE username = ? "
+            "AND (status = 'pending' OR (status = 'processing' AND updated_at < ?)) "
+            "ORDER BY created_at LIMIT 1",
+            (username, now - INBOX_STALE_SECONDS)
+        ).fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+        conn.execute(
+            "UPDATE ocr_inbox SET status = 'processing', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (now, row["id"])
+        )
+        conn.commit()
+    return dict(row)
+
+def finish_ocr_inbox_item(item_id: int, status: str, result: Optional[Dict] = None,
+                          session: Optional[Dict] = None, error: Optional[str] = None):
+    """Enregistre l'issue du traitement d'un document de la file"""
+    with closing(get_local_db()) as conn, conn:
+        conn.execute(
+            "UPDATE ocr_inbox SET status = ?, updated_at = ?, result_json = COALESCE(?, result_json), "
+            "session_json = COALESCE(?, session_json), error = ? WHERE id = ?",
+            (
+                status, time.time(),
+                json.dumps(result, ensure_ascii=False) if result is not None else None,
+                json.dumps(session, ensure_ascii=False, default=str) if session is not None else None,
+                error, item_id
+            )
+        )
+
+def load_ocr_inbox_item(item_id: int) -> Optional[Dict[str, Any]]:
+    """Charge un document analysé (image, résultat et valeurs de session produites par l'analyse)"""
+    with closing(get_local_db()) as conn:
+        row = conn.execute(
+            "SELECT id, filename, image, result_json, session_json FROM ocr_inbox WHERE id = ?", (item_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return {
+        "id": row["id"],
+        "filename": row["filename"],
+        "image": row["image"],
+        "result": json.loads(row["result_json"]) if row["result_json"] else None,
+        "session": json.loads(row["session_json"]) if row["session_json"] else {}
+    }
+
+def delete_ocr_inbox_item(item_id: int):
+    """Retire un document de la file"""
+    with closing(get_local_db()) as conn, conn:
+        conn.execute("DELETE FROM ocr_inbox WHERE id = ?", (item_id,))
+
+def process_next_ocr_inbox_item(username: str) -> bool:
+    """
+    Analyse le prochain document en attente de l'utilisateur, en priorité batch
+    
+    Les valeurs de session du document affiché sont préservées : celles produites par
+    l'analyse sont stockées avec le résultat et restaurées à l'ouverture du document.
+    
+    Returns:
+        True si un document a été traité
+    """
+    item = claim_ocr_inbox_item(username)
+    if item is None:
+        return False
+    
+    preserved_keys = COALESCED_SESSION_KEYS + ["analysis_coalesced", "openai_priority"]
+    preserved = {key: st.session_state.get(key) for key in preserved_keys}
+    try:
+        st.session_state.openai_priority = OPENAI_PRIORITY_BATCH
+        st.session_state.fact_manuscrit = ""
+        st.session_state.quartier_s2m = ""
+        st.session_state.nom_magasin_ulys = ""
+        st.session_state.document_analysis_details = {}
+        result = analyze_document_with_backup(item["image"])
+        outputs = {key: st.session_state.get(key) for key in COALESCED_SESSION_KEYS}
+        finish_ocr_inbox_item(item["id"], "done", result=result, session=outputs)
+    except (VisionUnavailableError,) + VISION_OUTAGE_ERRORS as e:
+        finish_ocr_inbox_item(item["id"], "pending", error=str(e))
+    except Exception as e:
+        finish_ocr_inbox_item(item["id"], "error", error=str(e))
+    except BaseException:
+        # Exécution interrompue par Streamlit (rerun) : le document reste en attente
+        finish_ocr_inbox_item(item["id"], "pending")
+        raise
+    finally:
+        for key, value in preserved.items():
+            st.session_state[key] = value
+    return True
+
+def reset_document_session():
+    """Remet à zéro l'état du document courant avant d'en charger un nouveau"""
+    st.session_state.ocr_result = None
+    st.session_state.show_results = False
+    st.session_state.detected_document_type = None
+    st.session_state.duplicate_check_done = False
+    st.session_state.duplicate_found = False
+    st.session_state.duplicate_action = None
+    st.session_state.export_triggered = False
+    st.session_state.export_status = None
+    st.session_state.product_matching_scores = {}
+    st.session_state.ocr_raw_text = None
+    st.session_state.document_analysis_details = {}
+    st.session_state.quartier_s2m = ""
+    st.session_state.nom_magasin_ulys = ""
+    st.session_state.fact_manuscrit = ""
+    st.session_state.vision_cascade = {}
+    st.session_state.processed_image_bytes = None
+    st.session_state.image_crop_info = None
+    st.session_state.fact_crop_info = None
+    st.session_state.field_repair_info = None
+    st.session_state.disambiguation_info = None
+    st.session_state.ocr_replay = None
+    st.session_state.replay_info = None
+    st.session_state.sheet_snapshot = None
+    for widget_key in DOCUMENT_FIELD_WIDGET_KEYS:
+        st.session_state.pop(widget_key, None)
+
+def apply_analysis_result(result: Dict, cached_disambiguation_only: bool = False):
+    """Détermine le type final et prépare le tableau des articles standardisés à partir du résultat d'analyse"""
+    raw_doc_type = result.get("type_document", "DOCUMENT INCONNU")
+    document_subtype = result.get("document_subtype", "").upper()
+    
+    if document_subtype == "DLP":
+        final_doc_type = "BDC LEADERPRICE"
+    elif document_subtype == "S2M":
+        final_doc_type = "BDC S2M"
+    elif document_subtype == "ULYS":
+        final_doc_type = "BDC ULYS"
+    elif document_subtype == "FACTURE":
+        final_doc_type = "FACTURE EN COMPTE"
+    else:
+        final_doc_type = normalize_document_type(raw_doc_type)
+    
+    st.session_state.detected_document_type = final_doc_type
+    
+    if st.session_state.document_analysis_details:
+        correction = st.session_state.document_analysis_details
+        st.info(f"⚠️ Correction appliquée: {correction.get('original_type')} → {correction.get('adjusted_type')}")
+    
+    fact_manuscrit = result.get("fact_manuscrit", "")
+    if fact_manuscrit and document_subtype in ["DLP", "S2M", "ULYS"]:
+        st.success(f"✅ FACT manuscrit détecté: {fact_manuscrit}")
+    
+    st.session_state.ocr_result = result
+    st.session_state.show_results = True
+    st.session_state.processing = False
+    
+    if "articles" in result:
+        std_data = []
+        for article in result["articles"]:
+            raw_name = article.get("article_brut", article.get("article", ""))
+            
+            if is_category_line(raw_name):
+                std_data.append({
+                    "Produit Brute": raw_name,
+                    "Produit Standard": raw_name,
+                    "Quantité": 0,
+                    "Confiance": "0%",
+                    "Auto": False
+                })
+            else:
+                produit_brut, produit_standard, confidence, status = standardize_product_for_bdc(raw_name)
+                
+                std_data.append({
+                    "Produit Brute": produit_brut,
+                    "Produit Standard": produit_standard,
+                    "Quantité": article.get("quantite", 0),
+                    "Confiance": f"{confidence*100:.1f}%",
+                    "Auto": confidence >= 0.7
+                })
+        
+        frames, st.session_state.disambiguation_info = disambiguate_low_confidence_rows(
+            [pd.DataFrame(std_data)], st.session_state.get("openai_priority", OPENAI_PRIORITY_INTERACTIVE),
+            cached_only=cached_disambiguation_only
+        )
+        st.session_state.edited_standardized_df = frames[0]
+
+def open_ocr_inbox_item(item_id: int) -> bool:
+    """Charge un document analysé depuis la file comme document courant"""
+    item = load_ocr_inbox_item(item_id)
+    if item is None or item["result"] is None:
+        return False
+    
+    reset_document_session()
+    st.session_state.uploaded_image = Image.open(BytesIO(item["image"]))
+    st.session_state.processed_image_bytes = item["image"]
+    st.session_state.image_preview_visible = True
+    st.session_state.document_scanned = True
+    for key, value in item["session"].items():
+        st.session_state[key] = value
+    st.session_state.analysis_coalesced = False
+    apply_analysis_result(item["result"])
+    delete_ocr_inbox_item(item_id)
+    return True
+
+@st.fragment(run_every=INBOX_POLL_SECONDS)
+def render_ocr_inbox():
+    """Affiche la file d'attente locale et traite un document par passage dès que le service répond"""
+    username = st.session_state.username
+    items = list_ocr_inbox(username)
+    if not items:
+        return
+    
+    if vision_circuit_allows_request() and any(item["status"] in ["pending", "processing"] for item in items):
+        if process_next_ocr_inbox_item(username):
+            items = list_ocr_inbox(username)
+    
+    st.markdown('<div class="card fade-in">', unsafe_allow_html=True)
+    st.markdown("<h4>📥 File d'attente locale</h4>", unsafe_allow_html=True)
+    
+    if not vision_circuit_allows_request():
+        st.warning("🔌 Service IA momentanément indisponible : les documents sont conservés localement "
+                   "et seront analysés automatiquement dès son retour.")
+    
+    for item in items:
+        col_name, col_status, col_action, col_delete = st.columns([3, 2, 2, 1])
+        with col_name:
+            st.write(f"**{item['filename'] or 'Document'}** — déposé à {datetime.fromtimestamp(item['created_at']).strftime('%H:%M:%S')}")
+        with col_status:
+            st.write(INBOX_STATUS_LABELS.get(item["status"], item["status"]))
+            if item["status"] == "error" and item["error"]:
+                st.caption(item["error"])
+        with col_action:
+            if item["status"] == "done":
+                if st.button("📂 Ouvrir", key=f"inbox_open_{item['id']}", use_container_width=True):
+                    if open_ocr_inbox_item(item["id"]):
+                        st.rerun()
+            elif item["status"] == "error":
+                if st.button("🔁 Réessayer", key=f"inbox_retry_{item['id']}", use_container_width=True):
+                    finish_ocr_inbox_item(item["id"], "pending")
+                    st.rerun(scope="fragment")
+        with col_delete:
+            if item["status"] != "processing":
+                if st.button("🗑️", key=f"inbox_delete_{item['id']}", help="Retirer de la file"):
+                    delete_ocr_inbox_item(item["id"])
+                    st.rerun(scope="fragment")
+    
+    st.markdown('</div>', unsafe_allow_html=True)
+
+#===============================================================
+# FONCTIONS UTILITAIRES
+# ============================================================
+# ============================================================
+# DÉTECTION DU DOCUMENT ET CORRECTION DE PERSPECTIVE (OPENCV)
+# ============================================================
+DOCUMENT_DETECTION_MAX_SIDE = 1000
+# La feuille doit couvrir au moins cette part de la photo pour être recadrée
+DOCUMENT_MIN_AREA_RATIO = 0.2
+# Bande au-dessus du quadrilatère : en dessous de cette hauteur (part de l'image), le bord est atteint
+DOCUMENT_TOP_MARGIN_RATIO = 0.03
+DESKEW_MAX_ANGLE = 15.0
+DESKEW_MIN_ANGLE = 0.3
+# Réduction maximale acceptée pour passer sous une frontière de tuile 512px (une rangée de tuiles en moins)
+VISION_TILE_SNAP_MIN_SCALE = 0.9
+
+def decode_image_cv(image_bytes: bytes) -> Optional[np.ndarray]:
+    """Décode des octets image en tableau BGR OpenCV"""
+    return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def encode_png_cv(img: np.ndarray) -> bytes:
+    """Encode un tableau BGR en PNG (compression rapide)"""
+    ok, buffer = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+    if not ok:
+        raise ValueError("Encodage PNG impossible")
+    return buffer.tobytes()
+
+def resize_for_detection(img: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Réduit l'image pour les détections (contours, lignes) et retourne le facteur d'échelle"""
+    scale = min(1.0, DOCUMENT_DETECTION_MAX_SIDE / max(img.shape[:2]))
+    if scale < 1.0:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img, scale
+
+def order_quad_points(points: np.ndarray) -> np.ndarray:
+    """Ordonne 4 points : haut-gauche, haut-droit, bas-droit, bas-gauche"""
+    points = points.reshape(4, 2).astype(np.float32)
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.array([
+        points[np.argmin(sums)], points[np.argmin(diffs)],
+        points[np.argmax(sums)], points[np.argmax(diffs)]
+    ], dtype=np.float32)
+
+def find_document_quad(img: np.ndarray) -> Optional[np.ndarray]:
+    """Cherche le contour quadrilatère de la feuille (coordonnées dans l'image d'origine)"""
+    small, scale = resize_for_detection(img)
+    gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+    min_area = DOCUMENT_MIN_AREA_RATIO * gray.shape[0] * gray.shape[1]
+    
+    # Bords (Canny) d'abord, puis seuillage d'Otsu (feuille claire sur fond sombre)
+    edges = cv2.dilate(cv2.Canny(gray, 50, 150), np.ones((3, 3), np.uint8), iterations=2)
+    _, bright = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    
+    for mask in [edges, bright]:
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+            if cv2.contourArea(contour) < min_area:
+                break
+            approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+            if len(approx) == 4 and cv2.isContourConvex(approx):
+                quad = order_quad_points(approx)
+                if quad_excludes_header(gray, quad):
+                    continue
+                return quad / scale
+    return None
+
+def quad_excludes_header(gray: np.ndarray, quad: np.ndarray) -> bool:
+    """
+    Indique si le quadrilatère est un cadre intérieur (tableau des articles) et non la feuille
+    
+    Photo cadrée serré ou scan sans fond : au-dessus du cadre, on trouve encore du papier
+    portant du texte (client, date, Fact). Recadrer couperait cet en-tête.
+    """
+    top = int(min(quad[0][1], quad[1][1]))
+    if top < DOCUMENT_TOP_MARGIN_RATIO * gray.shape[0]:
+        return False
+    x0, x1 = max(0, int(min(quad[:, 0]))), min(gray.shape[1], int(max(quad[:, 0])))
+    bottom = int(max(quad[2][1], quad[3][1]))
+    inside, band = gray[top:bottom, x0:x1], gray[:top, x0:x1]
+    if inside.size == 0 or band.size == 0:
+        return False
+    paper = float(np.median(inside))
+    # Fond (table, bureau) nettement plus sombre que la feuille : le cadre est bien la feuille
+    if float(np.median(band)) < 0.85 * paper:
+        return False
+    return float(np.mean(band < 0.6 * paper)) > 0.005
+
+def warp_document(img: np.ndarray, quad: np.ndarray) -> np.ndarray:
+    """Redresse la feuille vue en perspective en un rectangle"""
+    top_left, top_right, bottom_right, bottom_left = quad
+    width = int(max(np.linalg.norm(bottom_right - bottom_left), np.linalg.norm(top_right - top_left)))
+    height = int(max(np.linalg.norm(top_right - bottom_right), np.linalg.norm(top_left - bottom_left)))
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(quad, target)
+    return cv2.warpPerspective(img, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+def estimate_skew_angle(img: np.ndarray) -> float:
+    """Angle d'inclinaison (degrés) estimé par la médiane des lignes quasi horizontales (Hough)"""
+    small, _ = resize_for_detection(img)
+    edges = cv2.Canny(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), 50, 150)
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 360, threshold=80,
+                            minLineLength=small.shape[1] // 4, maxLineGap=10)
+    if lines is None:
+        return 0.0
+    angles = [
+        math.degrees(math.atan2(y2 - y1, x2 - x1))
+        for x1, y1, x2, y2 in lines.reshape(-1, 4)
+    ]
+    angles = [angle for angle in angles if abs(angle) <= DESKEW_MAX_ANGLE]
+    return float(np.median(angles)) if angles else 0.0
+
+def rotate_image(img: np.ndarray, angle: float) -> np.ndarray:
+    """Tourne l'image de l'angle donné (degrés) en agrandissant le cadre pour ne rien couper"""
+    height, width = img.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width, new_height = int(height * sin + width * cos), int(height * cos + width * sin)
+    matrix[0, 2] += new_width / 2 - width / 2
+    matrix[1, 2] += new_height / 2 - height / 2
+    return cv2.warpAffine(img, matrix, (new_width, new_height), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+def tile_snapped_size(width: int, height: int) -> Optional[Tuple[int, int]]:
+    """
+    Taille d'envoi économisant une rangée ou colonne de tuiles au prix d'une légère réduction
+    
+    Le modèle ne voit de toute façon que l'image réduite (voir vision_view_size) : on l'envoie
+    directement à cette taille, juste sous la frontière de tuile quand elle est proche.
+    """
+    view_width, view_height = vision_view_size(width, height)
+    factors = []
+    for side in (view_width, view_height):
+        tiles = math.ceil(side / 512)
+        factor = (tiles - 1) * 512 / side
+        if tiles > 1 and factor >= VISION_TILE_SNAP_MIN_SCALE:
+            factors.append(factor)
+    if not factors:
+        return None
+    factor = min(factors)
+    return int(view_width * factor), int(view_height * factor)
+
+def enhance_document_cv(img: np.ndarray) -> np.ndarray:
+    """Équivalent OpenCV de ImageOps.autocontrast + UnsharpMask(radius=1.2, percent=180)"""
+    img = cv2.merge([cv2.normalize(channel, None, 0, 255, cv2.NORM_MINMAX) for channel in cv2.split(img)])
+    blurred = cv2.GaussianBlur(img, (0, 0), 1.2)
+    return cv2.addWeighted(img, 2.8, blurred, -1.8, 0)
+
+def prepare_document_image(image_bytes: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Recadre la feuille (contour, perspective, redressement) puis applique le prétraitement
+    
+    Returns:
+        Tuple (image PNG prétraitée, rapport: contour trouvé, angle, surfaces, tokens estimés, durée)
+    """
+    started = time.perf_counter()
+    img = decode_image_cv(image_bytes) if cv2 is not None else None
+    if img is None:
+        return preprocess_image(image_bytes), {"available": False, "duration": time.perf_counter() - started}
+    
+    original_height, original_width = img.shape[:2]
+    quad = find_document_quad(img)
+    if quad is not None:
+        img = warp_document(img, quad)
+    
+    angle = estimate_skew_angle(img)
+    if abs(angle) < DESKEW_MIN_ANGLE:
+        angle = 0.0
+    else:
+        img = rotate_image(img, angle)
+    
+    height, width = img.shape[:2]
+    snapped = tile_snapped_size(width, height)
+    if snapped:
+        img = cv2.resize(img, snapped, interpolation=cv2.INTER_AREA)
+    processed = encode_png_cv(enhance_document_cv(img))
+    
+    return processed, {
+        "available": True,
+        "contour_found": quad is not None,
+        "deskew_angle": angle,
+        "original_size": (original_width, original_height),
+        "cropped_size": (width, height),
+        "sent_size": (img.shape[1], img.shape[0]),
+        "pixel_reduction": 1 - (width * height) / (original_width * original_height),
+        "tokens_before": estimate_image_tokens(original_width, original_height),
+        "tokens_after": estimate_image_tokens(img.shape[1], img.shape[0]),
+        "duration": time.perf_counter() - started
+    }
+
+# ============================================================
+# CONTRÔLE QUALITÉ DE LA PHOTO AVANT APPEL À L'API
+# ============================================================
+QUALITY_MIN_SHARPNESS = 60.0
+# Luminosité du papier (95e centile) en dessous de laquelle la photo est trop sombre
+QUALITY_MIN_PAPER_BRIGHTNESS = 110
+QUALITY_MAX_SATURATED_RATIO = 0.5
+# Hauteur minimale des caractères (px) dans l'image telle que vue par le modèle
+QUALITY_MIN_TEXT_HEIGHT = 6.0
+QUALITY_MIN_TEXT_COMPONENTS = 30
+QUALITY_ISSUE_LABELS = {
+    "blur": "Photo floue",
+    "dark": "Photo trop sombre",
+    "overexposed": "Photo surexposée (reflets)",
+    "small_text": "Texte trop petit (photo prise de trop loin)",
+    "no_text": "Aucun texte détecté"
+}
+
+def estimate_text_height(gray: np.ndarray) -> Tuple[Optional[float], int]:
+    """Hauteur médiane des caractères (composantes connexes) et nombre de composantes retenues"""
+    binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    widths, heights, areas = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT], stats[1:, cv2.CC_STAT_AREA]
+    is_glyph = (heights >= 3) & (heights <= 80) & (widths <= heights * 4) & (widths * 10 >= heights) & (areas >= 6)
+    glyph_heights = heights[is_glyph]
+    if len(glyph_heights) == 0:
+        return None, 0
+    return float(np.median(glyph_heights)), int(len(glyph_heights))
+
+def assess_image_quality(image_bytes: bytes) -> Dict[str, Any]:
+    """
+    Contrôle local et rapide de la photo : netteté (variance du laplacien), exposition et taille du texte
+    
+    Returns:
+        Dict avec les mesures, la liste des problèmes détectés et "passed"
+    """
+    started = time.perf_counter()
+    report = {"passed": True, "issues": [], "available": cv2 is not None}
+    if cv2 is None:
+        return report
+    
+    try:
+        original_width, original_height = Image.open(BytesIO(image_bytes)).size
+    except Exception:
+        return report
+    # Décodage JPEG directement à 1/4 de résolution pour les grandes photos (quelques ms)
+    flag = cv2.IMREAD_REDUCED_GRAYSCALE_4 if max(original_width, original_height) > 2000 else cv2.IMREAD_GRAYSCALE
+    gray = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flag)
+    if gray is None:
+        return report
+    scale = gray.shape[1] / original_width
+    
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel() / gray.size
+    paper_brightness = float(np.searchsorted(np.cumsum(histogram), 0.95))
+    saturated_ratio = float(histogram[254:].sum())
+    text_height, glyph_count = estimate_text_height(gray)
+    view_width, _ = vision_view_size(original_width, original_height)
+    view_text_height = text_height / scale * (view_width / original_width) if text_height else None
+    
+    if sharpness < QUALITY_MIN_SHARPNESS:
+        report["issues"].append("blur")
+    if paper_brightness < QUALITY_MIN_PAPER_BRIGHTNESS:
+        report["issues"].append("dark")
+    if saturated_ratio > QUALITY_MAX_SATURATED_RATIO:
+        report["issues"].append("overexposed")
+    if glyph_count < QUALITY_MIN_TEXT_COMPONENTS:
+        report["issues"].append("no_text")
+    elif view_text_height is not None and view_text_height < QUALITY_MIN_TEXT_HEIGHT:
+        report["issues"].append("small_text")
+    
+    report.update({
+        "passed": not report["issues"],
+        "sharpness": sharpness,
+        "paper_brightness": paper_brightness,
+        "saturated_ratio": saturated_ratio,
+        "text_height": view_text_height,
+        "glyph_count": glyph_count,
+        "duration": time.perf_counter() - started
+    })
+    return report
+
+def log_quality_check(username: str, report: Dict[str, Any], overridden: bool = False):
+    """Journalise le contrôle qualité dans la base locale (mesure des appels API évités)"""
+    try:
+        with closing(get_local_db()) as conn, conn:
+            conn.execute(
+                "INSERT INTO quality_gate_log (username, created_at, passed, overridden, issues, sharpness, "
+                "paper_brightness, text_height, duration) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    username, time.time(), int(report["passed"]), int(overridden), ",".join(report["issues"]),
+                    report.get("sharpness"), report.get("paper_brightness"), report.get("text_height"),
+                    report.get("duration")
+                )
+            )
+    except sqlite3.Error:
+        pass
+
+def get_quality_gate_summary() -> Dict[str, Any]:
+    """Totaux du contrôle qualité : contrôles, rejets, passages forcés et motifs"""
+    with closing(get_local_db()) as conn:
+        row = conn.execute(
+            "SELECT COUNT(*), SUM(passed = 0 AND overridden = 0), SUM(overridden), AVG(duration) FROM quality_gate_log"
+        ).fetchone()
+        issue_rows = conn.execute(
+            "SELECT issues FROM quality_gate_log WHERE passed = 0 AND overridden = 0"
+        ).fetchall()
+    reasons = {}
+    for (issues,) in issue_rows:
+        for issue in filter(None, issues.split(",")):
+            reasons[issue] = reasons.get(issue, 0) + 1
+    return {
+        "checked": row[0] or 0,
+        "rejected": row[1] or 0,
+        "overridden": row[2] or 0,
+        "avg_duration": row[3] or 0.0,
+        "reasons": reasons
+    }
+
+def preprocess_image(b: bytes) -> bytes:
+    """Prétraitement de l'image pour améliorer la qualité"""
+    if cv2 is not None:
+        img = decode_image_cv(b)
+        if img is not None:
+            return encode_png_cv(enhance_document_cv(img))
+    
+    img = Image.open(BytesIO(b)).convert("RGB")
+    img = ImageOps.autocontrast(img)
+    img = img.filter(ImageFilter.UnsharpMask(radius=1.2, percent=180))
+    out = BytesIO()
+    img.save(out, format="PNG", optimize=True, quality=95)
+    return out.getvalue()
+
+def encode_image_to_base64(image_bytes: bytes) -> str:
+    """Encode l'image en base64 pour OpenAI Vision"""
+    return base64.b64encode(image_bytes).decode('utf-8')
+
+def clean_text(text: str) -> str:
+    """Nettoie le texte"""
+    text = text.replace("\r", "\n")
+    text = re.sub(r"[^\S\r\n]+", " ", text)
+    return text.strip()
 
 def format_date_french(date_str: str) -> str:
     """Formate la date au format français JJ/MM/AAAA"""
@@ -2502,67 +4875,249 @@ def prepare_rows_for_sheet(document_type: str, data: dict, articles_df: pd.DataF
 # ============================================================
 # FONCTIONS DE DÉTECTION DE DOUBLONS - FILTRE 3: Même logique pour BDC et factures
 # ============================================================
-def check_for_duplicates(document_type: str, extracted_data: dict, worksheet) -> Tuple[bool, List[Dict]]:
-    """Vérifie si un document existe déjà dans Google Sheets"""
+def check_for_duplicates(document_type: str, extracted_data: dict, worksheet,
+                         snapshot: Optional[Dict[str, Any]] = None) -> Tuple[bool, List[Dict]]:
+    """Vérifie si un document existe déjà dans Google Sheets (recherche dans l'index local des doublons)"""
     try:
-        all_data = worksheet.get_all_values()
+        snapshot = get_sheet_snapshot(worksheet, snapshot)
         
-        if len(all_data) <= 1:
-            return False, []
-        
-        client_col = 2
         current_client = extracted_data.get('client', '')
         
         if "FACTURE" in document_type.upper():
-            doc_num_col = 3
             current_doc_num = extracted_data.get('numero_facture', '')
         else:
-            doc_num_col = 3
             current_doc_num = extracted_data.get('numero', '')
         
-        duplicates = []
-        for i, row in enumerate(all_data[1:], start=2):
-            if len(row) > max(doc_num_col, client_col):
-                row_client = row[client_col] if len(row) > client_col else ''
-                row_doc_num = row[doc_num_col] if len(row) > doc_num_col else ''
-                
-                if (row_client == current_client and 
-                    row_doc_num == current_doc_num and 
-                    current_client != '' and current_doc_num != ''):
-                    
-                    match_type = 'Client et Numéro identiques'
-                    
-                    if "ULYS" in current_client.upper() and "BDC" in document_type.upper():
-                        date_col = 1
-                        current_date = ""
-                        date_facture = extracted_data.get('date', '')
-                        if date_facture:
-                            try:
-                                date_obj = parser.parse(date_facture, dayfirst=True)
-                                current_date = date_obj.strftime("%d/%m/%Y")
-                            except:
-                                current_date = ""
-                        
-                        row_date = row[date_col] if len(row) > date_col else ''
-                        
-                        if row_date == current_date and current_date != '':
-                            match_type = 'Client, Numéro et Date identiques'
-                    
-                    duplicates.append({
-                        'row_number': i,
-                        'data': row,
-                        'match_type': match_type
-                    })
+        if current_client == '' or current_doc_num == '':
+            return False, []
+        
+        index = get_duplicate_index(snapshot["gid"])
+        with index["lock"]:
+            candidate_rows = list(index["by_number"].get((current_client, current_doc_num), []))
+        
+        if candidate_rows and not snapshot["reconciled"]:
+            # Doublon probable : numéros de ligne confirmés par une relecture complète
+            reconcile_sheet_snapshot(worksheet, snapshot)
+            with index["lock"]:
+                candidate_rows = list(index["by_number"].get((current_client, current_doc_num), []))
+        
+        current_date = ""
+        if "ULYS" in current_client.upper() and "BDC" in document_type.upper():
+            date_facture = extracted_data.get('date', '')
+            if date_facture:
+                try:
+                    date_obj = parser.parse(date_facture, dayfirst=True)
+                    current_date = date_obj.strftime("%d/%m/%Y")
+                except:
+                    current_date = ""
+        
+        with index["lock"]:
+            date_rows = set(index["by_number_date"].get((current_client, current_doc_num, current_date), []))
+            duplicates = [
+                {
+                    'row_number': row_num,
+                    'data': index["rows"][row_num - 1],
+                    'match_type': ('Client, Numéro et Date identiques' if current_date and row_num in date_rows
+                                   else 'Client et Numéro identiques')
+                }
+                for row_num in candidate_rows
+            ]
         
         return len(duplicates) > 0, duplicates
             
     except Exception as e:
+        invalidate_sheets_handles(e)
         st.error(f"❌ Erreur lors de la vérification des doublons: {str(e)}")
         return False, []
 
+# ============================================================
+# QUOTA GOOGLE SHEETS : SEAUX À JETONS LECTURE / ÉCRITURE ET NOUVEAUX ESSAIS
+# ============================================================
+# Quota par minute de l'API Sheets pour le compte de service (lectures et écritures séparées)
+SHEETS_READ_QUOTA = int(os.environ.get("CHANFOUI_SHEETS_READ_QUOTA", 60))
+SHEETS_WRITE_QUOTA = int(os.environ.get("CHANFOUI_SHEETS_WRITE_QUOTA", 60))
+# Rafale autorisée ; la recharge (quota - rafale)/min garantit le quota sur toute fenêtre d'une minute
+SHEETS_QUOTA_BURST = 10
+SHEETS_QUOTA_MAX_WAIT = 120
+SHEETS_QUOTA_ATTEMPTS = 5
+SHEETS_BACKOFF_BASE = 1.0
+SHEETS_BACKOFF_MAX = 16.0
+SHEETS_TRANSIENT_ERROR_CODES = (429, 500, 502, 503, 504)
+SHEETS_QUOTA_KIND_LABELS = {"read": "Lectures", "write": "Écritures"}
+
+@st.cache_resource
+def get_sheets_quota() -> Dict[str, Any]:
+    """Seaux à jetons lecture et écriture Google Sheets, partagés par les sessions et le thread d'envoi"""
+    now = time.monotonic()
+    return {
+        "condition": threading.Condition(),
+        "buckets": {
+            kind: {"limit": limit, "tokens": float(min(SHEETS_QUOTA_BURST, limit)), "updated": now}
+            for kind, limit in [("read", SHEETS_READ_QUOTA), ("write", SHEETS_WRITE_QUOTA)]
+        },
+        "stats": {
+            kind: {"calls": 0, "waits": 0, "wait_total": 0.0, "wait_max": 0.0, "throttled": 0, "retries": 0}
+            for kind in ["read", "write"]
+        }
+    }
+
+def refill_sheets_bucket(bucket: Dict[str, Any]):
+    """Recharge un seau au prorata du temps écoulé (à appeler sous le verrou)"""
+    now = time.monotonic()
+    capacity = min(SHEETS_QUOTA_BURST, bucket["limit"])
+    rate = max(bucket["limit"] - capacity, 1) / 60
+    bucket["tokens"] = min(float(capacity), bucket["tokens"] + (now - bucket["updated"]) * rate)
+    bucket["updated"] = now
+
+def acquire_sheets_quota(kind: str) -> float:
+    """
+    Attend un jeton du seau "read" ou "write" avant un appel à l'API Sheets
+    
+    Returns:
+        Temps d'attente en secondes
+    """
+    quota = get_sheets_quota()
+    condition = quota["condition"]
+    bucket = quota["buckets"][kind]
+    started = time.monotonic()
+    
+    with condition:
+        while True:
+            refill_sheets_bucket(bucket)
+            if bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                break
+            if time.monotonic() - started > SHEETS_QUOTA_MAX_WAIT:
+                raise TimeoutError("Quota Google Sheets saturé")
+            rate = max(bucket["limit"] - min(SHEETS_QUOTA_BURST, bucket["limit"]), 1) / 60
+            condition.wait(timeout=min(max((1 - bucket["tokens"]) / rate, 0.05), 1.0))
+        
+        waited = time.monotonic() - started
+        stats = quota["stats"][kind]
+        stats["calls"] += 1
+        if waited > 0.01:
+            stats["waits"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+    return waited
+
+def record_sheets_throttle(kind: str, error: Exception, retried: bool):
+    """Comptabilise une réponse 429/5xx ; sur un 429, le seau est vidé pour ralentir tous les appelants"""
+    quota = get_sheets_quota()
+    with quota["condition"]:
+        stats = quota["stats"][kind]
+        stats["throttled"] += 1
+        stats["retries"] += 1 if retried else 0
+        if getattr(getattr(error, "response", None), "status_code", None) == 429:
+            quota["buckets"][kind]["tokens"] = min(quota["buckets"][kind]["tokens"], 0.0)
+
+def is_transient_sheets_error(error: Exception) -> bool:
+    """Erreur passagère (quota, serveur, réseau) pour laquelle un nouvel essai a un sens"""
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, "status_code", None) in SHEETS_TRANSIENT_ERROR_CODES
+    return isinstance(error, (RequestException, ConnectionError, TimeoutError))
+
+def sheets_backoff_delay(attempt: int) -> float:
+    """Attente exponentielle avec gigue complète avant le nouvel essai numéro attempt (1, 2, ...)"""
+    return random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+
+def sheets_call(kind: str, func, *args, attempts: int = SHEETS_QUOTA_ATTEMPTS, **kwargs):
+    """
+    Appelle l'API Sheets sous quota ("read" ou "write"), avec nouveaux essais espacés sur 429/5xx
+    
+    Un 429 est un refus avant exécution : toujours renvoyé. Une erreur serveur sur une écriture
+    peut survenir après son application : seule une lecture est alors renvoyée. Les ajouts de
+    lignes (attempts=1) gèrent eux-mêmes leurs nouveaux essais et leur vérification.
+    """
+    for attempt in range(attempts):
+        acquire_sheets_quota(kind)
+        try:
+            return func(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status_code = getattr(e.response, "status_code", None)
+            if status_code not in SHEETS_TRANSIENT_ERROR_CODES:
+                raise
+            retry = (status_code == 429 or kind == "read") and attempt < attempts - 1
+            record_sheets_throttle(kind, e, retry)
+            if not retry:
+                raise
+            time.sleep(max(SHEETS_BACKOFF_BASE, sheets_backoff_delay(attempt + 1)))
+
 # ============================================================
 # GOOGLE SHEETS FUNCTIONS
 # ============================================================
+# Codes HTTP traités comme un jeton refusé : les handles en cache sont jetés et recréés
+SHEETS_AUTH_ERROR_CODES = (401, 403)
+
+@st.cache_resource
+def get_sheets_handles() -> Dict[str, Any]:
+    """
+    Client gspread autorisé, classeur et feuilles par GID, partagés par tout le processus
+    
+    Le jeton d'accès du compte de service est renouvelé automatiquement par la session
+    autorisée de gspread ; les handles ne sont recréés qu'après une erreur d'authentification.
+    """
+    return {
+        "lock": threading.Lock(),
+        "client": None,
+        "spreadsheet": None,
+        "worksheets": {},
+        "authorizations": 0,
+        "metadata_fetches": 0,
+        "reuses": 0,
+        "invalidations": 0
+    }
+
+def is_sheets_auth_error(error: Exception) -> bool:
+    """Indique si l'erreur Google Sheets vient d'un jeton expiré ou révoqué"""
+    if isinstance(error, RefreshError):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, "status_code", None) in SHEETS_AUTH_ERROR_CODES
+    return False
+
+def invalidate_sheets_handles(error: Optional[Exception] = None) -> bool:
+    """Jette les handles en cache (toujours sans erreur, sinon seulement sur erreur d'authentification)"""
+    if error is not None and not is_sheets_auth_error(error):
+        return False
+    handles = get_sheets_handles()
+    with handles["lock"]:
+        handles["client"] = None
+        handles["spreadsheet"] = None
+        handles["worksheets"] = {}
+        handles["invalidations"] += 1
+    return True
+
+def open_cached_worksheet(target_gid: Optional[int]):
+    """Retourne la feuille du GID depuis le cache ; autorisation et liste des feuilles seulement si nécessaire"""
+    handles = get_sheets_handles()
+    with handles["lock"]:
+        spreadsheet, worksheets = handles["spreadsheet"], handles["worksheets"]
+        if spreadsheet is not None and (target_gid is None or target_gid in worksheets):
+            handles["reuses"] += 1
+            return spreadsheet, worksheets.get(target_gid)
+    
+    # Appels réseau hors verrou : une attente de quota ne bloque ni les autres sessions ni le worker
+    opened = spreadsheet is None
+    if opened:
+        client = gspread.service_account_from_dict(dict(st.secrets["gcp_sheet"]))
+        spreadsheet = sheets_call("read", client.open_by_key, SHEET_ID)
+        worksheets = {}
+    if target_gid is not None:
+        # Feuille inconnue (premier accès, ou onglet recréé) : une seule relecture de la liste
+        worksheets = {int(worksheet.id): worksheet for worksheet in sheets_call("read", spreadsheet.worksheets)}
+    
+    with handles["lock"]:
+        if opened:
+            handles["client"] = client
+            handles["spreadsheet"] = spreadsheet
+            handles["worksheets"] = {}
+            handles["authorizations"] += 1
+        if target_gid is not None and handles["spreadsheet"] is spreadsheet:
+            handles["worksheets"] = worksheets
+            handles["metadata_fetches"] += 1
+    return spreadsheet, worksheets.get(target_gid)
+
 def get_worksheet(document_type: str):
     """Récupère la feuille Google Sheets correspondant au type de document"""
     try:
@@ -2576,31 +5131,218 @@ def get_worksheet(document_type: str):
             st.warning(f"⚠️ Type de document '{document_type}' non reconnu. Utilisation de la feuille par défaut.")
             normalized_type = "FACTURE EN COMPTE"
         
-        sa_info = dict(st.secrets["gcp_sheet"])
-        gc = gspread.service_account_from_dict(sa_info)
-        sh = gc.open_by_key(SHEET_ID)
-        
         target_gid = SHEET_GIDS.get(normalized_type)
         
+        try:
+            sh, worksheet = open_cached_worksheet(target_gid)
+        except Exception as e:
+            if not invalidate_sheets_handles(e):
+                raise
+            sh, worksheet = open_cached_worksheet(target_gid)
+        
         if target_gid is None:
             st.error(f"❌ GID non trouvé pour le type: {normalized_type}")
-            return sh.get_worksheet(0)
+            return sheets_call("read", sh.get_worksheet, 0)
         
-        for worksheet in sh.worksheets():
-            if int(worksheet.id) == target_gid:
-                return worksheet
+        if worksheet is not None:
+            return worksheet
         
         st.warning(f"⚠️ Feuille avec GID {target_gid} non trouvée. Utilisation de la première feuille.")
-        return sh.get_worksheet(0)
+        return sheets_call("read", sh.get_worksheet, 0)
         
     except Exception as e:
         st.error(f"❌ Erreur lors de la connexion à Google Sheets: {str(e)}")
         return None
 
-def find_table_range(worksheet, num_columns=8):
+# Seules colonnes lues pour l'export : Date, Client, N° facture / FACT
+SNAPSHOT_COLUMNS = ("B", "D")
+SNAPSHOT_FIRST_COLUMN = 1
+# Origine des numéros de série de dates de Google Sheets
+SHEETS_EPOCH = datetime(1899, 12, 30)
+# Relecture complète périodique de l'index (modifications manuelles de la feuille)
+DUPLICATE_INDEX_RESYNC_SECONDS = 900
+
+def sheet_value_to_text(value: Any, is_date: bool = False) -> str:
+    """Convertit une valeur non formatée (nombre, date en numéro de série) en texte comparable"""
+    if isinstance(value, bool):
+        return str(value).upper()
+    if isinstance(value, (int, float)):
+        if is_date:
+            return (SHEETS_EPOCH + timedelta(days=value)).strftime("%d/%m/%Y")
+        return str(int(value)) if float(value).is_integer() else str(value)
+    return "" if value is None else str(value)
+
+def read_sheet_projection(worksheet, first_row: int = 1) -> Tuple[List[List[str]], int]:
+    """
+    Lit les colonnes B:D à partir de first_row, valeurs non formatées
+    
+    Pas de mise en forme côté serveur ; les dates en numéros de série sont converties
+    localement en JJ/MM/AAAA.
+    
+    Returns:
+        Tuple (lignes projetées, taille de la réponse JSON en octets)
+    """
+    first_column, last_column = SNAPSHOT_COLUMNS
+    raw_values = sheets_call(
+        "read", worksheet.get,
+        f"{first_column}{first_row}:{last_column}",
+        value_render_option=ValueRenderOption.unformatted,
+        date_time_render_option=DateTimeOption.serial_number
+    )
+    values = [
+        [sheet_value_to_text(value, is_date=(index == 0)) for index, value in enumerate(row)]
+        for row in raw_values
+    ]
+    return values, len(json.dumps(list(raw_values), ensure_ascii=False).encode("utf-8"))
+
+def project_snapshot_row(row: List[str]) -> List[str]:
+    """Ramène une ligne complète (A:H) aux colonnes de l'instantané"""
+    return list(row[SNAPSHOT_FIRST_COLUMN:SNAPSHOT_FIRST_COLUMN + 3])
+
+# ============================================================
+# INDEX LOCAL DES DOUBLONS (CLIENT, NUMÉRO, DATE) PAR FEUILLE
+# ============================================================
+@st.cache_resource
+def get_duplicate_indexes() -> Dict[str, Any]:
+    """Index des documents déjà présents, par GID de feuille, partagés par tout le processus"""
+    return {"lock": threading.Lock(), "sheets": {}}
+
+def get_duplicate_index(gid: int) -> Dict[str, Any]:
+    """
+    Index d'une feuille : lignes B:D (la ligne N de la feuille est rows[N-1]) et
+    numéros de ligne par (client, numéro) et (client, numéro, date)
+    """
+    indexes = get_duplicate_indexes()
+    with indexes["lock"]:
+        if gid not in indexes["sheets"]:
+            indexes["sheets"][gid] = {
+                "lock": threading.Lock(),
+                "rows": [],
+                "by_number": {},
+                "by_number_date": {},
+                "synced_at": 0.0,
+                "full_syncs": 0,
+                "incremental_reads": 0,
+                "local_updates": 0
+            }
+        return indexes["sheets"][gid]
+
+def index_add_rows(index: Dict[str, Any], rows: List[List[str]]):
+    """Ajoute des lignes B:D à la fin de l'index (verrou déjà pris)"""
+    for row in rows:
+        index["rows"].append(row)
+        row_num = len(index["rows"])
+        date, client, number = (list(row) + ["", "", ""])[:3]
+        if row_num == 1 or not client or not number:
+            continue
+        index["by_number"].setdefault((client, number), []).append(row_num)
+        index["by_number_date"].setdefault((client, number, date), []).append(row_num)
+
+def index_replace_rows(index: Dict[str, Any], rows: List[List[str]]):
+    """Reconstruit tout l'index à partir des lignes données (verrou déjà pris)"""
+    index["rows"].clear()
+    index["by_number"] = {}
+    index["by_number_date"] = {}
+    index_add_rows(index, rows)
+
+def refresh_duplicate_index(worksheet, full: bool = False) -> Dict[str, Any]:
+    """
+    Met l'index à jour : lecture des seules lignes au-delà du dernier nombre connu,
+    ou relecture complète (premier accès, resynchronisation périodique, ou demandée)
+    
+    La lecture a lieu hors du verrou de l'index (attente de quota possible) ; les lignes
+    ajoutées entre-temps à l'index (autre session, ajout local) ne sont pas reprises deux fois.
+    
+    Returns:
+        Statistiques de la lecture (mode, lignes lues, octets, durée)
+    """
+    index = get_duplicate_index(int(worksheet.id))
+    started = time.perf_counter()
+    with index["lock"]:
+        full = full or not index["rows"] or time.time() - index["synced_at"] > DUPLICATE_INDEX_RESYNC_SECONDS
+        known = len(index["rows"])
+    
+    if full:
+        rows, size = read_sheet_projection(worksheet)
+    else:
+        rows, size = read_sheet_projection(worksheet, first_row=known + 1)
+    
+    with index["lock"]:
+        if full:
+            index_replace_rows(index, rows)
+            index["synced_at"] = time.time()
+            index["full_syncs"] += 1
+        else:
+            # Index raccourci entre-temps (suppressions) : la prochaine lecture rattrapera
+            added = len(index["rows"]) - known
+            if 0 <= added < len(rows):
+                index_add_rows(index, rows[added:])
+            index["incremental_reads"] += 1
+    return {
+        "mode": "full" if full else "incremental",
+        "rows_read": len(rows),
+        "bytes": size,
+        "seconds": time.perf_counter() - started
+    }
+
+def index_record_append(worksheet, new_rows: List[List[str]], response: Any):
+    """Reporte dans l'index nos propres lignes ajoutées, si elles suivent directement les lignes connues"""
+    updated_range = ((response or {}).get("updates") or {}).get("updatedRange", "") if isinstance(response, dict) else ""
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    index = get_duplicate_index(int(worksheet.id))
+    with index["lock"]:
+        # Sinon (ajout concurrent, réponse inconnue) : la prochaine lecture incrémentale les reprendra
+        if match and int(match.group(1)) == len(index["rows"]) + 1:
+            index_add_rows(index, [project_snapshot_row(row) for row in new_rows])
+            index["local_updates"] += 1
+
+def index_delete_rows(worksheet, row_numbers: List[int], updated_rows: Optional[Dict[int, List[str]]] = None):
+    """Reporte dans l'index des lignes modifiées (lignes complètes A:H) puis supprimées (numéros 1-based)"""
+    index = get_duplicate_index(int(worksheet.id))
+    with index["lock"]:
+        rows = list(index["rows"])
+        for row_num, row in (updated_rows or {}).items():
+            if 1 <= row_num <= len(rows):
+                rows[row_num - 1] = project_snapshot_row(row)
+        for row_num in sorted(set(row_numbers), reverse=True):
+            if 1 <= row_num <= len(rows):
+                del rows[row_num - 1]
+        index_replace_rows(index, rows)
+        index["local_updates"] += 1
+
+def take_sheet_snapshot(worksheet) -> Dict[str, Any]:
+    """Met à jour une fois l'index de la feuille pour tout l'export (doublons, plage, ajout)"""
+    refresh = refresh_duplicate_index(worksheet)
+    return {
+        "gid": int(worksheet.id),
+        "modes": [refresh["mode"]],
+        "rows_read": refresh["rows_read"],
+        "fetch_seconds": refresh["seconds"],
+        "bytes": refresh["bytes"],
+        "api_calls": 1,
+        "reconciled": refresh["mode"] == "full"
+    }
+
+def reconcile_sheet_snapshot(worksheet, snapshot: Dict[str, Any]):
+    """Relecture complète de l'index (numéros de ligne sûrs avant de supprimer des doublons)"""
+    refresh = refresh_duplicate_index(worksheet, full=True)
+    snapshot["modes"].append(refresh["mode"])
+    snapshot["rows_read"] += refresh["rows_read"]
+    snapshot["fetch_seconds"] += refresh["seconds"]
+    snapshot["bytes"] += refresh["bytes"]
+    snapshot["api_calls"] += 1
+    snapshot["reconciled"] = True
+
+def get_sheet_snapshot(worksheet, snapshot: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Réutilise l'instantané s'il porte sur cette feuille, sinon en prend un nouveau"""
+    if snapshot is not None and snapshot.get("gid") == int(worksheet.id):
+        return snapshot
+    return take_sheet_snapshot(worksheet)
+
+def find_table_range(worksheet, num_columns=8, snapshot: Optional[Dict[str, Any]] = None):
     """Trouve la plage de table dans la feuille avec un nombre de colonnes spécifique"""
     try:
-        all_data = worksheet.get_all_values()
+        all_data = get_duplicate_index(get_sheet_snapshot(worksheet, snapshot)["gid"])["rows"]
         
         if not all_data:
             return "A1:H1"
@@ -2626,8 +5368,133 @@ def find_table_range(worksheet, num_columns=8):
     except Exception as e:
         return "A2:H2"
 
+def merge_row_ranges(row_numbers: List[int]) -> List[Tuple[int, int]]:
+    """Regroupe des numéros de ligne (1-based) en plages contiguës (début, fin incluses)"""
+    ranges = []
+    for row_num in sorted(set(row_numbers)):
+        if ranges and row_num == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], row_num)
+        else:
+            ranges.append((row_num, row_num))
+    return ranges
+
+def build_delete_rows_requests(sheet_id: int, row_numbers: List[int]) -> List[Dict]:
+    """Requêtes deleteDimension par plage, de la dernière à la première (indices encore valides)"""
+    return [
+        {"deleteDimension": {"range": {
+            "sheetId": sheet_id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end
+        }}}
+        for start, end in reversed(merge_row_ranges(row_numbers))
+    ]
+
+def build_append_cells_request(sheet_id: int, rows: List[List[str]]) -> Dict:
+    """Requête appendCells : lignes ajoutées après la dernière ligne remplie, en texte brut"""
+    return {"appendCells": {
+        "sheetId": sheet_id,
+        "rows": [{"values": [{"userEnteredValue": {"stringValue": str(value)}} for value in row]} for row in rows],
+        "fields": "userEnteredValue"
+    }}
+
+def read_sheet_rows(worksheet, row_numbers: List[int]) -> Dict[int, List[str]]:
+    """
+    Lit les lignes complètes (A:H) données, par plages contiguës, en un seul appel
+    
+    Valeurs non formatées, converties comme l'instantané (dates JJ/MM/AAAA, nombres sans
+    séparateurs) : la comparaison avec les nouvelles lignes ignore la mise en forme des cellules.
+    """
+    ranges = merge_row_ranges(row_numbers)
+    value_ranges = sheets_call(
+        "read", worksheet.batch_get, [f"A{start}:H{end}" for start, end in ranges],
+        value_render_option=ValueRenderOption.unformatted,
+        date_time_render_option=DateTimeOption.serial_number
+    )
+    rows = {}
+    for (start, end), values in zip(ranges, value_ranges):
+        values = list(values)
+        for offset in range(end - start + 1):
+            row = values[offset] if offset < len(values) else []
+            row = [sheet_value_to_text(value, is_date=(column == SNAPSHOT_FIRST_COLUMN))
+                   for column, value in enumerate(row)]
+            rows[start + offset] = (row + [""] * 8)[:8]
+    return rows
+
+def build_overwrite_diff(old_rows: Dict[int, List[str]], new_rows: List[List[str]]) -> Dict[str, Any]:
+    """
+    Aligne les anciennes et nouvelles lignes d'un document par désignation (dans l'ordre d'apparition)
+    
+    Returns:
+        Différence minimale : cellules modifiées par ligne (plages de colonnes contiguës),
+        lignes à ajouter, lignes à supprimer
+    """
+    designation_col = 5
+    old_by_designation = {}
+    for row_num in sorted(old_rows):
+        key = old_rows[row_num][designation_col].strip().casefold()
+        old_by_designation.setdefault(key, []).append(row_num)
+    
+    updates, appends, updated_rows, cells = [], [], {}, 0
+    for new_row in new_rows:
+        new_row = [str(value) for value in new_row]
+        candidates = old_by_designation.get(new_row[designation_col].strip().casefold())
+        if not candidates:
+            appends.append(new_row)
+            continue
+        row_num = candidates.pop(0)
+        changed = [col for col, value in enumerate(new_row) if old_rows[row_num][col] != value]
+        if not changed:
+            continue
+        updated_rows[row_num] = new_row
+        cells += len(changed)
+        for start, end in merge_row_ranges(changed):
+            updates.append((row_num, start, new_row[start:end + 1]))
+    
+    deletes = sorted(row_num for row_nums in old_by_designation.values() for row_num in row_nums)
+    return {"updates": updates, "appends": appends, "deletes": deletes, "updated_rows": updated_rows, "cells": cells}
+
+def build_overwrite_requests(sheet_id: int, diff: Dict[str, Any]) -> List[Dict]:
+    """updateCells d'abord (numéros de ligne encore valides), puis suppressions, puis ajout"""
+    requests = [
+        {"updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": row_num - 1, "columnIndex": column},
+            "rows": [{"values": [{"userEnteredValue": {"stringValue": value}} for value in values]}],
+            "fields": "userEnteredValue"
+        }}
+        for row_num, column, values in diff["updates"]
+    ]
+    requests += build_delete_rows_requests(sheet_id, diff["deletes"])
+    if diff["appends"]:
+        requests.append(build_append_cells_request(sheet_id, diff["appends"]))
+    return requests
+
+def overwrite_document_rows(worksheet, duplicate_rows: List[int], new_rows: List[List[str]]) -> Optional[Dict[str, Any]]:
+    """
+    Remplace les lignes d'un document par ses nouvelles lignes (différences seulement, une requête atomique)
+    
+    Returns:
+        Différences appliquées (avec old_count et api_calls), ou None si les lignes ont
+        changé de client ou de numéro depuis la vérification (rien n'est écrit)
+    """
+    old_rows = read_sheet_rows(worksheet, duplicate_rows)
+    api_calls = 1
+    
+    # Lignes déplacées depuis la vérification : ne rien écrire sur de mauvaises lignes
+    expected = project_snapshot_row(new_rows[0])[1:]
+    if any(project_snapshot_row(row)[1:] != expected for row in old_rows.values()):
+        return None
+    
+    # Modifications, ajouts et suppressions : une seule requête atomique
+    diff = build_overwrite_diff(old_rows, new_rows)
+    if diff["cells"] or diff["appends"] or diff["deletes"]:
+        sheets_call("write", worksheet.spreadsheet.batch_update,
+                    {"requests": build_overwrite_requests(worksheet.id, diff)})
+        api_calls += 1
+    # Les lignes ajoutées suivent les lignes restantes : reprises à la prochaine lecture incrémentale
+    index_delete_rows(worksheet, diff["deletes"], diff["updated_rows"])
+    return dict(diff, old_count=len(old_rows), api_calls=api_calls)
+
 def save_to_google_sheets(document_type: str, data: dict, articles_df: pd.DataFrame, 
-                         duplicate_action: str = None, duplicate_rows: List[int] = None):
+                         duplicate_action: str = None, duplicate_rows: List[int] = None,
+                         snapshot: Optional[Dict[str, Any]] = None):
     """Sauvegarde les données dans Google Sheets (version production)"""
     try:
         ws = get_worksheet(document_type)
@@ -2636,24 +5503,14 @@ def save_to_google_sheets(document_type: str, data: dict, articles_df: pd.DataFr
             st.error("❌ Impossible de se connecter à Google Sheets")
             return False, "Erreur de connexion"
         
+        snapshot = get_sheet_snapshot(ws, snapshot)
+        
         new_rows = prepare_rows_for_sheet(document_type, data, articles_df)
         
         if not new_rows:
             st.warning("⚠️ Aucune donnée à enregistrer (toutes les lignes ont une quantité de 0)")
             return False, "Aucune donnée"
         
-        if duplicate_action == "overwrite" and duplicate_rows:
-            try:
-                duplicate_rows.sort(reverse=True)
-                for row_num in duplicate_rows:
-                    ws.delete_rows(row_num)
-                
-                st.info(f"🗑️ {len(duplicate_rows)} ligne(s) dupliquée(s) supprimée(s)")
-                
-            except Exception as e:
-                st.error(f"❌ Erreur lors de la suppression des doublons: {str(e)}")
-                return False, str(e)
-        
         if duplicate_action == "skip":
             st.warning("⏸️ Import annulé - Document ignoré")
             return True, "Document ignoré (doublon)"
@@ -2668,13 +5525,45 @@ def save_to_google_sheets(document_type: str, data: dict, articles_df: pd.DataFr
         preview_df = pd.DataFrame(new_rows, columns=columns)
         st.dataframe(preview_df, use_container_width=True)
         
-        table_range = find_table_range(ws, num_columns=8)
+        if duplicate_action == "overwrite" and duplicate_rows:
+            try:
+                diff = overwrite_document_rows(ws, duplicate_rows, new_rows)
+                if diff is None:
+                    st.error("❌ La feuille a changé depuis la vérification des doublons : relancez l'export")
+                    return False, "Doublons déplacés"
+                snapshot["api_calls"] += diff["api_calls"]
+                snapshot["diff"] = {key: diff[key] if key == "cells" else len(diff[key])
+                                    for key in ["cells", "appends", "deletes", "updated_rows"]}
+                
+                st.info(f"✏️ Différences appliquées : {diff['cells']} cellule(s) modifiée(s) sur "
+                        f"{len(diff['updated_rows'])} ligne(s), {len(diff['appends'])} ligne(s) ajoutée(s), "
+                        f"{len(diff['deletes'])} ligne(s) supprimée(s), {diff['old_count'] - len(diff['updated_rows'])} inchangée(s) "
+                        f"sur {diff['old_count']} existante(s)")
+                
+            except Exception as e:
+                invalidate_sheets_handles(e)
+                st.error(f"❌ Erreur lors du remplacement des doublons (feuille inchangée): {str(e)}")
+                return False, str(e)
+            
+            st.success(f"✅ {len(new_rows)} ligne(s) mise(s) à jour avec succès dans Google Sheets!")
+            st.caption(f"📊 Export : {snapshot['api_calls']} appel(s) API Google Sheets | "
+                       f"{snapshot['bytes'] / 1024:.1f} Ko téléchargés | {snapshot['rows_read']} ligne(s) lue(s) "
+                       f"({', '.join('complète' if mode == 'full' else 'incrémentale' for mode in snapshot['modes'])})")
+            st.balloons()
+            return True, f"{len(new_rows)} lignes mise(s) à jour"
+        
+        table_range = find_table_range(ws, num_columns=8, snapshot=snapshot)
+        index = get_duplicate_index(snapshot["gid"])
+        with index["lock"]:
+            base_row_count = len(index["rows"])
         
         try:
-            if ":" in table_range and table_range.count(":") == 1:
-                ws.append_rows(new_rows, table_range=table_range)
-            else:
-                ws.append_rows(new_rows)
+            snapshot["api_calls"] += 1
+            append_response = append_rows_idempotent(
+                ws, new_rows, base_row_count,
+                table_range=table_range if ":" in table_range and table_range.count(":") == 1 else None
+            )
+            index_record_append(ws, new_rows, append_response)
             
             action_msg = "enregistrée(s)"
             if duplicate_action == "overwrite":
@@ -2688,33 +5577,477 @@ def save_to_google_sheets(document_type: str, data: dict, articles_df: pd.DataFr
             sheet_url = f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/edit#gid={SHEET_GIDS.get(normalized_type, '')}"
             st.markdown(f'<div class="info-box">🔗 <a href="{sheet_url}" target="_blank">Ouvrir Google Sheets</a></div>', unsafe_allow_html=True)
             
+            st.caption(f"📊 Export : {snapshot['api_calls']} appel(s) API Google Sheets | "
+                       f"{snapshot['bytes'] / 1024:.1f} Ko téléchargés | {snapshot['rows_read']} ligne(s) lue(s) "
+                       f"({', '.join('complète' if mode == 'full' else 'incrémentale' for mode in snapshot['modes'])})")
+            
             st.balloons()
             return True, f"{len(new_rows)} lignes {action_msg}"
             
         except Exception as e:
-            st.error(f"❌ Erreur lors de l'enregistrement: {str(e)}")
-            
-            try:
-                st.info("🔄 Tentative alternative d'enregistrement...")
-                
-                all_data = ws.get_all_values()
-                
-                for row in new_rows:
-                    all_data.append(row)
-                
-                ws.update('A1', all_data)
-                
-                st.success(f"✅ {len(new_rows)} ligne(s) enregistrée(s) avec méthode alternative!")
-                return True, f"{len(new_rows)} lignes enregistrées (méthode alternative)"
-                
-            except Exception as e2:
-                st.error(f"❌ Échec de la méthode alternative: {str(e2)}")
-                return False, str(e)
+            invalidate_sheets_handles(e)
+            # Plus de réécriture complète de la feuille : les lignes partent dans la file d'envoi locale
+            enqueue_sheets_export(st.session_state.username, normalize_document_type(document_type),
+                                  snapshot["gid"], new_rows, base_row_count, str(e), data=data)
+            st.warning(f"💾 Google Sheets indisponible ({str(e)}) : {len(new_rows)} ligne(s) conservée(s) localement, "
+                       f"envoi automatique dès le retour du service")
+            return SHEETS_EXPORT_QUEUED, f"{len(new_rows)} lignes en attente d'envoi"
                 
     except Exception as e:
+        invalidate_sheets_handles(e)
         st.error(f"❌ Erreur lors de l'enregistrement: {str(e)}")
         return False, str(e)
 
+# ============================================================
+# AJOUT IDEMPOTENT ET FILE D'ENVOI LOCALE (OUTBOX) GOOGLE SHEETS
+# ============================================================
+# Envoi différé : « Synchroniser » enregistre l'export localement, un thread l'envoie en arrière-plan
+SHEETS_WRITE_BEHIND = os.environ.get("CHANFOUI_SHEETS_WRITE_BEHIND", "1").lower() not in ["0", "false", "non"]
+SHEETS_APPEND_ATTEMPTS = 4
+SHEETS_OUTBOX_POLL_SECONDS = 30
+SHEETS_OUTBOX_STATUS_REFRESH_SECONDS = 5
+# Un lot complet (plusieurs dizaines de documents) part en un seul passage du worker
+SHEETS_OUTBOX_BATCH_SIZE = 100
+SHEETS_OUTBOX_DONE_VISIBLE_SECONDS = 3600
+# Retour de save_to_google_sheets quand l'export est conservé dans la file locale
+SHEETS_EXPORT_QUEUED = "queued"
+SHEETS_OUTBOX_STATUS_LABELS = {
+    "held": "📦 Dans le lot (non envoyé)",
+    "pending": "⏳ En attente d'envoi",
+    "sending": "📤 Envoi en cours",
+    "duplicate": "⚠️ Doublon à confirmer",
+    "done": "✅ Synchronisé",
+    "skipped": "⏸️ Ignoré",
+    "error": "❌ Échec"
+}
+
+def rows_fingerprint(rows: List[List[str]]) -> str:
+    """Empreinte des lignes d'un export (marqueur d'idempotence, sans colonne supplémentaire dans la feuille)"""
+    return hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def find_rows_in_tail(worksheet, rows: List[List[str]], first_row: int) -> Optional[int]:
+    """Cherche les lignes, dans l'ordre et contiguës, après first_row ; retourne leur première ligne ou None"""
+    tail = [
+        ([str(value) for value in row] + [""] * 8)[:8]
+        for row in sheets_call("read", worksheet.get, f"A{first_row}:H")
+    ]
+    expected = [([str(value) for value in row] + [""] * 8)[:8] for row in rows]
+    for offset in range(len(tail) - len(expected) + 1):
+        if tail[offset:offset + len(expected)] == expected:
+            return first_row + offset
+    return None
+
+def append_rows_idempotent(worksheet, rows: List[List[str]], base_row_count: int,
+                           table_range: Optional[str] = None, resume: bool = False) -> Dict[str, Any]:
+    """
+    Ajoute les lignes avec nouveaux essais (attente exponentielle) sans risque de doublon
+    
+    Après une erreur d'issue incertaine (délai dépassé, 5xx), la fin de la feuille (au-delà
+    de base_row_count) est relue avant le nouvel essai : si l'envoi a abouti, rien n'est renvoyé.
+    Un 429 est un refus avant exécution : nouvel essai sans relecture. Avec resume=True,
+    base_row_count a été mémorisé lors d'un envoi antérieur (file d'envoi) : la vérification
+    a lieu aussi avant le premier envoi. Seule couche de nouveaux essais pour l'ajout.
+    
+    Returns:
+        Réponse de l'API, ou {"verified_row": n} si les lignes étaient déjà présentes
+    """
+    verify = resume
+    for attempt in range(SHEETS_APPEND_ATTEMPTS):
+        if attempt:
+            time.sleep(sheets_backoff_delay(attempt))
+        if verify:
+            try:
+                found_row = find_rows_in_tail(worksheet, rows, base_row_count + 1)
+            except Exception as e:
+                if not is_transient_sheets_error(e) or attempt == SHEETS_APPEND_ATTEMPTS - 1:
+                    raise
+                continue
+            if found_row is not None:
+                return {"verified_row": found_row}
+        try:
+            if table_range:
+                return sheets_call("write", worksheet.append_rows, rows, table_range=table_range, attempts=1)
+            return sheets_call("write", worksheet.append_rows, rows, attempts=1)
+        except Exception as e:
+            if not is_transient_sheets_error(e) or attempt == SHEETS_APPEND_ATTEMPTS - 1:
+                raise
+            verify = verify or getattr(getattr(e, "response", None), "status_code", None) != 429
+
+def enqueue_sheets_export(username: str, document_type: str, gid: int, rows: List[List[str]],
+                          base_row_count: Optional[int] = None, error: Optional[str] = None,
+                          action: str = "add_new", data: Optional[Dict] = None,
+                          status: str = "pending") -> int:
+    """
+    Place un export dans la file d'envoi locale et retourne son identifiant
+    
+    Même lignes et même action = même entrée : encore en file, elle est réutilisée ;
+    déjà envoyée ou en échec, elle est remise en attente (nouvel export volontaire).
+    Un export "held" reste dans le lot de l'opérateur jusqu'à l'envoi du lot.
+    base_row_count n'est donné qu'après un envoi tenté (issue incertaine) : le worker
+    vérifiera alors la fin de la feuille avant de renvoyer.
+    """
+    now = time.time()
+    data = data or {}
+    is_facture = "FACTURE" in document_type.upper()
+    doc_number = data.get("numero_facture" if is_facture else "numero", "") or ""
+    client = data.get("client", "") or ""
+    label = f"{document_type} — {client or 'client ?'} n° {doc_number or '?'}"
+    fingerprint = hashlib.sha256(f"{action}:{rows_fingerprint(rows)}".encode("utf-8")).hexdigest()
+    
+    with closing(get_local_db()) as conn, conn:
+        existing = conn.execute("SELECT id, status FROM sheets_outbox WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        if existing and existing["status"] in ["done", "error", "skipped"]:
+            conn.execute(
+                "UPDATE sheets_outbox SET status = ?, attempts = 0, next_attempt_at = 0, error = NULL, "
+                "duplicate_rows_json = NULL, base_row_count = ?, base_recorded = ?, username = ?, "
+                "updated_at = ? WHERE id = ?",
+                (status, base_row_count or 0, int(base_row_count is not None), username, now, existing["id"])
+            )
+        elif existing and base_row_count is not None and existing["status"] != "sending":
+            conn.execute(
+                "UPDATE sheets_outbox SET base_row_count = ?, base_recorded = 1, updated_at = ? WHERE id = ?",
+                (base_row_count, now, existing["id"])
+            )
+        if existing:
+            item_id = existing["id"]
+        else:
+            item_id = conn.execute(
+                "INSERT INTO sheets_outbox (username, document_type, gid, rows_json, fingerprint, base_row_count, "
+                "base_recorded, action, client, doc_number, doc_date, label, status, created_at, updated_at, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (username, document_type, gid, json.dumps(rows, ensure_ascii=False), fingerprint, base_row_count or 0,
+                 int(base_row_count is not None), action, client, doc_number, data.get("date", "") or "", label, status, now, now, error)
+            ).lastrowid
+    if status == "pending":
+        wake_sheets_outbox_worker()
+    return item_id
+
+def release_sheets_outbox_batch(username: str) -> int:
+    """Envoie le lot de l'opérateur : tous ses exports "held" passent ensemble en attente d'envoi"""
+    with closing(get_local_db()) as conn, conn:
+        released = conn.execute(
+            "UPDATE sheets_outbox SET status = 'pending', next_attempt_at = 0, updated_at = ? "
+            "WHERE username = ? AND status = 'held'",
+            (time.time(), username)
+        ).rowcount
+    if released:
+        wake_sheets_outbox_worker()
+    return released
+
+def list_sheets_outbox(username: str) -> List[Dict[str, Any]]:
+    """Exports de l'utilisateur dans la file d'envoi (les envoyés restent visibles un moment)"""
+    with closing(get_local_db()) as conn:
+        rows = conn.execute(
+            "SELECT id, document_type, label, action, status, attempts, created_at, updated_at, error, "
+            "rows_json, duplicate_rows_json FROM sheets_outbox "
+            "WHERE username = ? AND (status NOT IN ('done', 'skipped') OR updated_at > ?) ORDER BY created_at",
+            (username, time.time() - SHEETS_OUTBOX_DONE_VISIBLE_SECONDS)
+        ).fetchall()
+    return [
+        dict(row, line_count=len(json.loads(row["rows_json"])),
+             duplicate_rows=json.loads(row["duplicate_rows_json"] or "[]"))
+        for row in rows
+    ]
+
+def claim_sheets_outbox_jobs(limit: int = SHEETS_OUTBOX_BATCH_SIZE) -> List[Dict[str, Any]]:
+    """Réserve les plus anciens exports prêts (tous utilisateurs), ou abandonnés en cours d'envoi"""
+    now = time.time()
+    with closing(get_local_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT * FROM sheets_outbox WHERE (status = 'pending' AND next_attempt_at <= ?) "
+            "OR (status = 'sending' AND updated_at < ?) ORDER BY created_at LIMIT ?",
+            (now, now - INBOX_STALE_SECONDS, limit)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE sheets_outbox SET status = 'sending', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            [(now, row["id"]) for row in rows]
+        )
+        conn.commit()
+    return [dict(row, attempts=row["attempts"] + 1) for row in rows]
+
+def finish_sheets_outbox_item(item_id: int, status: str, error: Optional[str] = None,
+                              duplicate_rows: Optional[List[int]] = None, retry_in: float = 0.0):
+    """Enregistre l'état d'un export de la file (envoyé, doublon à trancher, nouvel essai, échec)"""
+    now = time.time()
+    with closing(get_local_db()) as conn, conn:
+        conn.execute(
+            "UPDATE sheets_outbox SET status = ?, updated_at = ?, error = ?, next_attempt_at = ?, "
+            "duplicate_rows_json = COALESCE(?, duplicate_rows_json) WHERE id = ?",
+            (status, now, error, now + retry_in,
+             json.dumps(duplicate_rows) if duplicate_rows is not None else None, item_id)
+        )
+
+def set_sheets_outbox_action(item_id: int, action: str):
+    """
+    Décision de l'opérateur (remplacer, ajouter, ignorer, réessayer) : l'export repart à zéro
+    
+    La base mémorisée avant un envoi antérieur est conservée : seules les lignes écrites
+    après elle peuvent faire passer l'export pour déjà envoyé.
+    """
+    with closing(get_local_db()) as conn, conn:
+        conn.execute(
+            "UPDATE sheets_outbox SET action = ?, status = 'pending', attempts = 0, next_attempt_at = 0, "
+            "error = NULL, updated_at = ? WHERE id = ?",
+            (action, time.time(), item_id)
+        )
+    wake_sheets_outbox_worker()
+
+def delete_sheets_outbox_item(item_id: int):
+    """Retire un export de la file"""
+    with closing(get_local_db()) as conn, conn:
+        conn.execute("DELETE FROM sheets_outbox WHERE id = ?", (item_id,))
+
+def lookup_duplicate_rows(gid: int, client: str, doc_number: str) -> List[int]:
+    """Lignes de la feuille portant déjà ce client et ce numéro (index local, sans appel)"""
+    if not client or not doc_number:
+        return []
+    index = get_duplicate_index(gid)
+    with index["lock"]:
+        return list(index["by_number"].get((client, doc_number), []))
+
+def fail_sheets_outbox_jobs(state: Dict[str, Any], jobs: List[Dict[str, Any]], error: Exception):
+    """Échec d'envoi : nouvel essai différé si l'erreur est passagère (ou jeton expiré), sinon échec"""
+    # Jeton expiré : handles recréés au prochain passage, l'export est simplement retenté
+    retry = invalidate_sheets_handles(error) or is_transient_sheets_error(error)
+    state["last_error"] = str(error)
+    for job in jobs:
+        finish_sheets_outbox_item(
+            job["id"], "pending" if retry else "error", str(error),
+            retry_in=max(SHEETS_BACKOFF_BASE, sheets_backoff_delay(job["attempts"])) if retry else 0.0
+        )
+
+def flush_sheets_outbox_group(state: Dict[str, Any], gid: int, jobs: List[Dict[str, Any]]):
+    """
+    Traite les exports d'une même feuille : doublons, remplacements, puis ajouts regroupés
+    
+    Un remplacement ou un envoi qui échoue ne change que l'état des exports concernés.
+    """
+    _, worksheet = open_cached_worksheet(gid)
+    if worksheet is None:
+        raise RuntimeError(f"Feuille avec GID {gid} introuvable")
+    refresh_duplicate_index(worksheet)
+    reconciled = False
+    # Documents déjà retenus dans ce lot : une seconde copie (même feuille scannée deux fois) est un doublon
+    accepted = set()
+    
+    batched, verified = [], []
+    for job in jobs:
+        rows = json.loads(job["rows_json"])
+        action = job["action"]
+        if action == "skip":
+            finish_sheets_outbox_item(job["id"], "skipped")
+            continue
+        key = (job["client"], job["doc_number"]) if job["client"] and job["doc_number"] else None
+        if action == "auto" and key in accepted:
+            finish_sheets_outbox_item(job["id"], "duplicate", duplicate_rows=[])
+            continue
+        if job["base_recorded"] and action in ["auto", "overwrite"]:
+            # Envoi antérieur d'issue incertaine : ses propres lignes ne doivent pas passer pour un doublon
+            try:
+                found_row = find_rows_in_tail(worksheet, rows, job["base_row_count"] + 1)
+            except Exception as e:
+                fail_sheets_outbox_jobs(state, [job], e)
+                continue
+            if found_row is not None:
+                if key:
+                    accepted.add(key)
+                finish_sheets_outbox_item(job["id"], "done")
+                state["jobs_sent"] += 1
+                state["rows_sent"] += len(rows)
+                continue
+            # Absentes de la fin de feuille : export ordinaire (doublons, puis ajout regroupé)
+            job = dict(job, base_recorded=0)
+        if action in ["auto", "overwrite"]:
+            duplicates = lookup_duplicate_rows(gid, job["client"], job["doc_number"])
+            if duplicates and not reconciled:
+                # Doublon probable : numéros de ligne confirmés par une relecture complète
+                refresh_duplicate_index(worksheet, full=True)
+                reconciled = True
+                duplicates = lookup_duplicate_rows(gid, job["client"], job["doc_number"])
+            if action == "auto" and duplicates:
+                finish_sheets_outbox_item(job["id"], "duplicate", duplicate_rows=duplicates)
+                continue
+            if action == "overwrite" and duplicates:
+                accepted.add(key)
+                try:
+                    replaced = overwrite_document_rows(worksheet, duplicates, rows)
+                except Exception as e:
+                    fail_sheets_outbox_jobs(state, [job], e)
+                    continue
+                if replaced is None:
+                    finish_sheets_outbox_item(job["id"], "error", "Doublons déplacés : relancez l'export")
+                else:
+                    finish_sheets_outbox_item(job["id"], "done")
+                    state["jobs_sent"] += 1
+                    state["rows_sent"] += len(rows)
+                continue
+        if key:
+            accepted.add(key)
+        # Base mémorisée avant un envoi (issue incertaine) : envoi seul, avec vérification de la fin de feuille
+        (verified if job["base_recorded"] else batched).append((job, rows))
+    
+    index = get_duplicate_index(gid)
+    if batched:
+        with index["lock"]:
+            base_row_count = len(index["rows"])
+        # Base mémorisée avant l'envoi : un nouvel essai saura où chercher des lignes déjà écrites
+        with closing(get_local_db()) as conn, conn:
+            conn.executemany("UPDATE sheets_outbox SET base_row_count = ?, base_recorded = 1 WHERE id = ?",
+                             [(base_row_count, job["id"]) for job, _ in batched])
+    
+    for group in [[entry] for entry in verified] + ([batched] if batched else []):
+        all_rows = [row for _, rows in group for row in rows]
+        try:
+            if group is batched:
+                response = append_rows_idempotent(worksheet, all_rows, base_row_count)
+            else:
+                response = append_rows_idempotent(worksheet, all_rows, group[0][0]["base_row_count"],
+                                                  resume=True)
+        except Exception as e:
+            fail_sheets_outbox_jobs(state, [job for job, _ in group], e)
+            continue
+        if "verified_row" not in (response or {}):
+            state["appends"] += 1
+        index_record_append(worksheet, all_rows, response)
+        for job, _ in group:
+            finish_sheets_outbox_item(job["id"], "done")
+        state["jobs_sent"] += len(group)
+        state["rows_sent"] += len(all_rows)
+
+def process_sheets_outbox_batch(state: Dict[str, Any]) -> int:
+    """Un passage du worker : réserve un lot d'exports et les envoie, feuille par feuille"""
+    jobs = claim_sheets_outbox_jobs()
+    by_gid = {}
+    for job in jobs:
+        by_gid.setdefault(job["gid"], []).append(job)
+    
+    for gid, group in by_gid.items():
+        try:
+            flush_sheets_outbox_group(state, gid, group)
+        except Exception as e:
+            # Feuille inaccessible (ouverture, index) : les exports non encore traités sont concernés
+            ids = [job["id"] for job in group]
+            with closing(get_local_db()) as conn:
+                unfinished = {
+                    row["id"] for row in conn.execute(
+                        f"SELECT id FROM sheets_outbox WHERE status = 'sending' AND id IN ({','.join('?' * len(ids))})", ids
+                    ).fetchall()
+                }
+            fail_sheets_outbox_jobs(state, [job for job in group if job["id"] in unfinished], e)
+    if jobs:
+        state["batches"] += 1
+    state["last_run"] = time.time()
+    return len(jobs)
+
+def run_sheets_outbox_worker(state: Dict[str, Any]):
+    """Boucle du thread d'envoi : vide la file, puis attend un nouvel export ou le prochain passage"""
+    while True:
+        try:
+            processed = process_sheets_outbox_batch(state)
+        except Exception as e:
+            state["last_error"] = str(e)
+            processed = 0
+        if not processed:
+            state["wake"].wait(SHEETS_OUTBOX_POLL_SECONDS)
+            state["wake"].clear()
+
+@st.cache_resource
+def get_sheets_outbox_worker() -> Dict[str, Any]:
+    """Démarre (une fois par processus) le thread qui envoie la file locale vers Google Sheets"""
+    state = {
+        "wake": threading.Event(),
+        "batches": 0,
+        "appends": 0,
+        "jobs_sent": 0,
+        "rows_sent": 0,
+        "last_run": 0.0,
+        "last_error": None
+    }
+    state["thread"] = threading.Thread(target=run_sheets_outbox_worker, args=(state,),
+                                       name="sheets-outbox", daemon=True)
+    state["thread"].start()
+    return state
+
+def wake_sheets_outbox_worker():
+    """Réveille le thread d'envoi (démarré au besoin)"""
+    get_sheets_outbox_worker()["wake"].set()
+
+def enqueue_document_export(document_type: str, data: dict, articles_df: pd.DataFrame,
+                            held: bool = False) -> Optional[int]:
+    """Prépare les lignes du document et les confie à la file d'envoi, ou au lot en cours (réponse immédiate)"""
+    normalized_type = normalize_document_type(document_type)
+    gid = SHEET_GIDS.get(normalized_type, SHEET_GIDS["FACTURE EN COMPTE"])
+    rows = prepare_rows_for_sheet(normalized_type, data, articles_df)
+    if not rows:
+        return None
+    return enqueue_sheets_export(st.session_state.username, normalized_type, gid, rows, action="auto", data=data,
+                                 status="held" if held else "pending")
+
+@st.fragment(run_every=SHEETS_OUTBOX_STATUS_REFRESH_SECONDS)
+def render_sheets_outbox():
+    """Affiche l'état de synchronisation de chaque document envoyé ou en attente"""
+    username = st.session_state.username
+    items = list_sheets_outbox(username)
+    if not items:
+        return
+    if any(item["status"] in ["pending", "sending"] for item in items):
+        # Après un redémarrage, la file persistée est reprise dès le premier affichage
+        get_sheets_outbox_worker()
+    
+    st.markdown('<div class="card fade-in">', unsafe_allow_html=True)
+    st.markdown("<h4>📤 Synchronisation Google Sheets</h4>", unsafe_allow_html=True)
+    st.caption("Les exports sont conservés localement et envoyés en arrière-plan, sans risque de doublon.")
+    
+    held = [item for item in items if item["status"] == "held"]
+    if held:
+        # Un seul contrôle des doublons et un seul ajout par feuille pour tout le lot
+        if st.button(f"🚀 Envoyer le lot ({len(held)} document(s), {sum(item['line_count'] for item in held)} ligne(s))",
+                    key="outbox_release_batch", type="primary", use_container_width=True):
+            release_sheets_outbox_batch(username)
+            st.rerun(scope="fragment")
+    
+    for item in items:
+        col_name, col_status, col_action = st.columns([3, 2, 3])
+        with col_name:
+            st.write(f"**{item['label'] or item['document_type']}** — {item['line_count']} ligne(s), "
+                     f"{datetime.fromtimestamp(item['created_at']).strftime('%H:%M:%S')}")
+        with col_status:
+            st.write(SHEETS_OUTBOX_STATUS_LABELS.get(item["status"], item["status"]))
+            if item["status"] == "duplicate":
+                if item["duplicate_rows"]:
+                    st.caption(f"{len(item['duplicate_rows'])} ligne(s) existante(s) pour ce client et ce numéro")
+                else:
+                    st.caption("Même client et même numéro qu'un autre export du même envoi")
+            elif item["error"] and item["status"] != "done":
+                st.caption(item["error"])
+        with col_action:
+            if item["status"] == "duplicate":
+                col_replace, col_add, col_skip = st.columns(3)
+                if col_replace.button("🔄", key=f"outbox_overwrite_{item['id']}", help="Remplacer les lignes existantes"):
+                    set_sheets_outbox_action(item["id"], "overwrite")
+                    st.rerun(scope="fragment")
+                if col_add.button("➕", key=f"outbox_add_{item['id']}", help="Ajouter comme nouveau document"):
+                    set_sheets_outbox_action(item["id"], "add_new")
+                    st.rerun(scope="fragment")
+                if col_skip.button("⏸️", key=f"outbox_skip_{item['id']}", help="Ignorer cet export"):
+                    set_sheets_outbox_action(item["id"], "skip")
+                    st.rerun(scope="fragment")
+            elif item["status"] == "held":
+                if st.button("🗑️", key=f"outbox_unbatch_{item['id']}", help="Retirer du lot"):
+                    delete_sheets_outbox_item(item["id"])
+                    st.rerun(scope="fragment")
+            elif item["status"] == "error":
+                col_retry, col_delete = st.columns(2)
+                if col_retry.button("🔁", key=f"outbox_retry_{item['id']}", help="Réessayer"):
+                    set_sheets_outbox_action(item["id"], item["action"])
+                    st.rerun(scope="fragment")
+                if col_delete.button("🗑️", key=f"outbox_delete_{item['id']}", help="Retirer de la file"):
+                    delete_sheets_outbox_item(item["id"])
+                    st.rerun(scope="fragment")
+    
+    st.markdown('</div>', unsafe_allow_html=True)
+
 # ============================================================
 # HEADER AVEC LOGO - VERSION TECH AMÉLIORÉE
 # ============================================================
@@ -2793,13 +6126,52 @@ st.markdown("""
 st.markdown('<div class="upload-box">', unsafe_allow_html=True)
 uploaded = st.file_uploader(
     "**Déposez votre document ici ou cliquez pour parcourir**",
-    type=["jpg", "jpeg", "png"],
+    type=["jpg", "jpeg", "png", "pdf"],
     label_visibility="collapsed",
-    help="Formats supportés : JPG, JPEG, PNG | Taille max : 10MB",
+    help="Formats supportés : JPG, JPEG, PNG, PDF (plusieurs pages) | Taille max : 10MB",
     key="file_uploader_main"
 )
 st.markdown('</div>', unsafe_allow_html=True)
 
+with st.expander("📸 Document en plusieurs photos"):
+    st.caption("Pour un document trop long pour une seule photo : déposez toutes les photos dans l'ordre "
+               "(haut du document en premier). Les lignes photographiées deux fois ne sont comptées qu'une fois.")
+    multi_uploaded = st.file_uploader(
+        "Photos du document",
+        type=["jpg", "jpeg", "png"],
+        accept_multiple_files=True,
+        label_visibility="collapsed",
+        key="file_uploader_multi"
+    )
+    if multi_uploaded:
+        for index, photo in enumerate(multi_uploaded, start=1):
+            if photo.file_id not in st.session_state.multi_photo_quality:
+                st.session_state.multi_photo_quality[photo.file_id] = assess_image_quality(photo.getvalue())
+            photo_quality = st.session_state.multi_photo_quality[photo.file_id]
+            status = "✅" if photo_quality["passed"] else "⚠️ " + ", ".join(
+                QUALITY_ISSUE_LABELS.get(issue, issue) for issue in photo_quality["issues"]
+            )
+            st.write(f"{index}. {photo.name} — {status}")
+        
+        if len(multi_uploaded) >= 2 and st.button(f"🔍 Analyser ces {len(multi_uploaded)} photos comme un seul document",
+                                                   key="analyze_multi_button", use_container_width=True):
+            reset_document_session()
+            st.session_state.uploaded_image = Image.open(multi_uploaded[0])
+            st.session_state.image_preview_visible = True
+            st.session_state.document_scanned = True
+            st.session_state.image_quality = None
+            with st.spinner(f"🤖 Analyse des {len(multi_uploaded)} photos en parallèle..."):
+                try:
+                    parts = (prepare_document_image(photo.getvalue())[0] for photo in multi_uploaded)
+                    result = analyze_document_parts(parts, overlapping=True,
+                                                    labels=[photo.name for photo in multi_uploaded])
+                    apply_analysis_result(result)
+                    st.rerun()
+                except (VisionUnavailableError,) + VISION_OUTAGE_ERRORS:
+                    st.warning("🔌 Service IA momentanément indisponible : réessayez l'analyse de ces photos dans quelques instants.")
+                except Exception as e:
+                    st.error(f"❌ Erreur système: {str(e)}")
+
 st.markdown(f"""
 <div style="display: flex; justify-content: center; gap: 20px; margin-top: 20px; font-size: 0.85rem; color: #333333 !important;">
     <div style="text-align: center;">
@@ -2823,29 +6195,40 @@ st.markdown(f"""
 
 st.markdown('</div>', unsafe_allow_html=True)
 
+# ============================================================
+# CONTRÔLE QUALITÉ DE LA PHOTO (AVANT TOUT APPEL IA)
+# ============================================================
+if uploaded and uploaded != st.session_state.uploaded_file and not is_pdf_upload(uploaded):
+    previous_quality = st.session_state.image_quality
+    if previous_quality and previous_quality.get("overridden") and previous_quality.get("file_id") == uploaded.file_id:
+        # Analyse forcée par l'utilisateur malgré le contrôle qualité
+        log_quality_check(st.session_state.username, previous_quality, overridden=True)
+    else:
+        quality = assess_image_quality(uploaded.getvalue())
+        quality["file_id"] = uploaded.file_id
+        st.session_state.image_quality = quality
+        if not quality["passed"]:
+            log_quality_check(st.session_state.username, quality)
+            # Le fichier est marqué comme traité : l'analyse IA n'est pas lancée
+            st.session_state.uploaded_file = uploaded
+            st.session_state.uploaded_image = Image.open(uploaded)
+            reset_document_session()
+            st.session_state.processing = False
+            st.session_state.image_preview_visible = True
+            st.session_state.document_scanned = False
+        elif quality.get("available"):
+            log_quality_check(st.session_state.username, quality)
+
 # ============================================================
 # TRAITEMENT AUTOMATIQUE DE L'IMAGE - VERSION AMÉLIORÉE V1.3
 # ============================================================
 if uploaded and uploaded != st.session_state.uploaded_file:
     st.session_state.uploaded_file = uploaded
-    st.session_state.uploaded_image = Image.open(uploaded)
-    st.session_state.ocr_result = None
-    st.session_state.show_results = False
+    st.session_state.uploaded_image = None if is_pdf_upload(uploaded) else Image.open(uploaded)
+    reset_document_session()
     st.session_state.processing = True
-    st.session_state.detected_document_type = None
-    st.session_state.duplicate_check_done = False
-    st.session_state.duplicate_found = False
-    st.session_state.duplicate_action = None
     st.session_state.image_preview_visible = True
     st.session_state.document_scanned = True
-    st.session_state.export_triggered = False
-    st.session_state.export_status = None
-    st.session_state.product_matching_scores = {}
-    st.session_state.ocr_raw_text = None
-    st.session_state.document_analysis_details = {}
-    st.session_state.quartier_s2m = ""
-    st.session_state.nom_magasin_ulys = ""
-    st.session_state.fact_manuscrit = ""
     
     progress_container = st.empty()
     with progress_container.container():
@@ -2894,68 +6277,23 @@ if uploaded and uploaded != st.session_state.uploaded_file:
         st.markdown('</div>', unsafe_allow_html=True)
     
     try:
-        buf = BytesIO()
-        st.session_state.uploaded_image.save(buf, format="JPEG")
-        image_bytes = buf.getvalue()
-        
-        img_processed = preprocess_image(image_bytes)
-        
-        result = analyze_document_with_backup(img_processed)
-        
-        if result:
-            raw_doc_type = result.get("type_document", "DOCUMENT INCONNU")
-            document_subtype = result.get("document_subtype", "").upper()
-            
-            if document_subtype == "DLP":
-                final_doc_type = "BDC LEADERPRICE"
-            elif document_subtype == "S2M":
-                final_doc_type = "BDC S2M"
-            elif document_subtype == "ULYS":
-                final_doc_type = "BDC ULYS"
-            elif document_subtype == "FACTURE":
-                final_doc_type = "FACTURE EN COMPTE"
-            else:
-                final_doc_type = normalize_document_type(raw_doc_type)
-            
-            st.session_state.detected_document_type = final_doc_type
-            
-            if st.session_state.document_analysis_details:
-                correction = st.session_state.document_analysis_details
-                st.info(f"⚠️ Correction appliquée: {correction.get('original_type')} → {correction.get('adjusted_type')}")
-            
-            fact_manuscrit = result.get("fact_manuscrit", "")
-            if fact_manuscrit and document_subtype in ["DLP", "S2M", "ULYS"]:
-                st.success(f"✅ FACT manuscrit détecté: {fact_manuscrit}")
+        if is_pdf_upload(uploaded):
+            # Pages rastérisées une à une ; la page 1 fournit l'en-tête, toutes les pages les articles
+            check_pdf_pages(uploaded.getvalue())
+            result = analyze_document_parts(iter_pdf_pages(uploaded.getvalue()), overlapping=False, label_prefix="Page")
+            st.session_state.uploaded_image = Image.open(BytesIO(st.session_state.processed_image_bytes))
+        else:
+            buf = BytesIO()
+            st.session_state.uploaded_image.save(buf, format="JPEG")
+            image_bytes = buf.getvalue()
             
-            st.session_state.ocr_result = result
-            st.session_state.show_results = True
-            st.session_state.processing = False
+            img_processed, st.session_state.image_crop_info = prepare_document_image(image_bytes)
+            st.session_state.processed_image_bytes = img_processed
             
-            if "articles" in result:
-                std_data = []
-                for article in result["articles"]:
-                    raw_name = article.get("article_brut", article.get("article", ""))
-                    
-                    if any(cat in raw_name.upper() for cat in ["VINS ROUGES", "VINS BLANCS", "VINS ROSES", "LIQUEUR", "CONSIGNE"]):
-                        std_data.append({
-                            "Produit Brute": raw_name,
-                            "Produit Standard": raw_name,
-                            "Quantité": 0,
-                            "Confiance": "0%",
-                            "Auto": False
-                        })
-                    else:
-                        produit_brut, produit_standard, confidence, status = standardize_product_for_bdc(raw_name)
-                        
-                        std_data.append({
-                            "Produit Brute": produit_brut,
-                            "Produit Standard": produit_standard,
-                            "Quantité": article.get("quantite", 0),
-                            "Confiance": f"{confidence*100:.1f}%",
-                            "Auto": confidence >= 0.7
-                        })
-                
-                st.session_state.edited_standardized_df = pd.DataFrame(std_data)
+            result = analyze_document_with_backup(img_processed)
+        
+        if result:
+            apply_analysis_result(result)
             
             progress_container.empty()
             st.rerun()
@@ -2963,10 +6301,47 @@ if uploaded and uploaded != st.session_state.uploaded_file:
             st.error("❌ Échec de l'analyse IA - Veuillez réessayer avec une image plus claire")
             st.session_state.processing = False
         
+    except (VisionUnavailableError,) + VISION_OUTAGE_ERRORS:
+        progress_container.empty()
+        st.session_state.processing = False
+        if is_pdf_upload(uploaded):
+            st.warning("🔌 Service IA momentanément indisponible : redéposez ce PDF dans quelques instants.")
+        else:
+            # Service IA en panne : le document est conservé localement et analysé dès son retour
+            enqueue_ocr_document(st.session_state.username, uploaded.name, st.session_state.processed_image_bytes)
+            st.warning("📥 Service IA momentanément indisponible : le document a été placé dans la file d'attente "
+                       "et sera analysé automatiquement.")
+    except PdfPageError as e:
+        progress_container.empty()
+        st.error(f"❌ {str(e)}")
+        st.session_state.processing = False
     except Exception as e:
         st.error(f"❌ Erreur système: {str(e)}")
         st.session_state.processing = False
 
+if (st.session_state.image_quality and not st.session_state.image_quality["passed"]
+        and not st.session_state.image_quality.get("overridden") and not st.session_state.show_results):
+    quality = st.session_state.image_quality
+    st.markdown('<div class="card fade-in">', unsafe_allow_html=True)
+    st.markdown('<h4>📷 Photo à reprendre</h4>', unsafe_allow_html=True)
+    st.warning("La photo ne permet pas une lecture fiable : "
+               + ", ".join(QUALITY_ISSUE_LABELS.get(issue, issue) for issue in quality["issues"])
+               + ". Reprenez la photo (bien éclairée, nette, document cadré de près) puis déposez-la à nouveau.")
+    st.caption(f"Netteté {quality['sharpness']:.0f} (min {QUALITY_MIN_SHARPNESS:.0f}) | "
+               f"Luminosité papier {quality['paper_brightness']:.0f} (min {QUALITY_MIN_PAPER_BRIGHTNESS}) | "
+               f"Zones saturées {quality['saturated_ratio'] * 100:.0f}% | "
+               f"Hauteur du texte {quality['text_height'] or 0:.1f}px (min {QUALITY_MIN_TEXT_HEIGHT:.0f}) | "
+               f"Contrôle en {quality['duration'] * 1000:.0f} ms")
+    if st.button("⚠️ Analyser quand même", key="quality_override_button",
+                help="Lance l'analyse IA malgré le contrôle qualité"):
+        st.session_state.image_quality["overridden"] = True
+        st.session_state.uploaded_file = None
+        st.rerun()
+    st.markdown('</div>', unsafe_allow_html=True)
+
+render_ocr_inbox()
+render_sheets_outbox()
+
 # ============================================================
 # APERÇU DU DOCUMENT (TOUJOURS VISIBLE SI SCANNÉ)
 # ============================================================
@@ -3029,6 +6404,192 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
             if doit_m_extrait:
                 st.write(f"- DOIT M extrait du texte: {doit_m_extrait}")
     
+    with st.expander("📈 Performance & coûts IA"):
+        crop_info = st.session_state.image_crop_info
+        if crop_info and crop_info.get("available"):
+            (original_width, original_height), (width, height) = crop_info["original_size"], crop_info["cropped_size"]
+            st.write(f"**Recadrage du document :** contour {'détecté' if crop_info['contour_found'] else 'non détecté'} "
+                     f"| redressement {crop_info['deskew_angle']:.1f}° | {original_width}×{original_height} → {width}×{height} px "
+                     f"(surface {-crop_info['pixel_reduction'] * 100:+.0f}%), envoyé en "
+                     f"{crop_info['sent_size'][0]}×{crop_info['sent_size'][1]} px | tokens image estimés "
+                     f"{crop_info['tokens_before']} → {crop_info['tokens_after']} "
+                     f"({crop_info['tokens_after'] - crop_info['tokens_before']:+d}) | {crop_info['duration'] * 1000:.0f} ms")
+
+        cascade = st.session_state.vision_cascade or {}
+        if cascade.get("tiers"):
+            st.write("**Ce document :**")
+            st.dataframe(pd.DataFrame([{
+                "Modèle": call["model"],
+                "Latence (s)": round(call["latency"], 2),
+                "Attente file (s)": round(call.get("queue_wait", 0.0), 2),
+                "Tokens entrée": call["prompt_tokens"],
+                "Tokens sortie": call["completion_tokens"],
+                "Coût (USD)": round(call["cost_usd"], 4)
+            } for call in cascade["tiers"]]), use_container_width=True)
+            if cascade.get("escalated"):
+                st.write("**Escalade vers le modèle complet :**", cascade.get("reasons", []))
+            if cascade.get("parts"):
+                st.write(f"**Images du document** (durée totale {cascade['parts_wall_time']:.1f}s) :")
+                st.dataframe(pd.DataFrame([{
+                    "Image": part["label"],
+                    "Préparation (s)": round(part["prepare_seconds"], 2),
+                    "Analyse (s)": round(part["seconds"], 2),
+                    "Articles lus": part["articles"]
+                } for part in cascade["parts"]]), use_container_width=True)
+            if cascade.get("tiling"):
+                tiling = cascade["tiling"]
+                st.write(f"✂️ Tableau découpé : {tiling['rows']} lignes en {tiling['strips']} bandes | "
+                         f"durée totale {tiling['wall_time']:.1f}s (appel le plus long {tiling['longest_call']:.1f}s)")
+            if st.session_state.analysis_coalesced:
+                st.write("🔗 Résultat partagé avec une analyse identique déjà en cours (aucun appel supplémentaire)")
+        
+        tier_stats = get_vision_tier_stats()
+        with tier_stats["lock"]:
+            documents = tier_stats["documents"]
+            escalations = tier_stats["escalations"]
+            tiers = {model: dict(values) for model, values in tier_stats["tiers"].items()}
+        
+        st.write("**Cascade (toutes sessions) :**")
+        st.write(f"- Documents : {documents} | Escalades : {escalations} ({(escalations / documents * 100) if documents else 0:.1f}%)")
+        if tiers:
+            st.dataframe(pd.DataFrame([{
+                "Modèle": model,
+                "Appels": values["calls"],
+                "Acceptés": values["accepted"],
+                "Latence moy. (s)": round(values["latency_total"] / values["calls"], 2) if values["calls"] else 0,
+                "Coût total (USD)": round(values["cost_usd"], 4),
+                "Coût moy. (USD)": round(values["cost_usd"] / values["calls"], 4) if values["calls"] else 0
+            } for model, values in tiers.items()]), use_container_width=True)
+        
+        inflight = get_inflight_analyses()
+        with inflight["lock"]:
+            st.write(f"- Analyses regroupées (même image en parallèle) : {inflight['coalesced']} "
+                     f"sur {inflight['leaders'] + inflight['coalesced']} | En cours : {len(inflight['inflight'])}")
+        
+        limiter = get_openai_rate_limiter()
+        with limiter["condition"]:
+            refill_openai_buckets(limiter)
+            queued = [priority for priority, _ in limiter["queue"]]
+            available_requests = limiter["requests"]
+            available_tokens = limiter["tokens"]
+            limiter_stats = {priority: dict(values) for priority, values in limiter["stats"].items()}
+        
+        st.write(f"**Limiteur OpenAI ({OPENAI_RPM_LIMIT} req/min, {OPENAI_TPM_LIMIT} tokens/min) :**")
+        st.write(f"- Disponible : {available_requests:.0f} requêtes, {available_tokens:.0f} tokens | "
+                 f"File d'attente : {len(queued)} ({', '.join(f'{OPENAI_PRIORITY_LABELS.get(p, p)}: {queued.count(p)}' for p in sorted(set(queued))) or 'vide'})")
+        if limiter_stats:
+            st.dataframe(pd.DataFrame([{
+                "Priorité": OPENAI_PRIORITY_LABELS.get(priority, priority),
+                "Requêtes servies": values["granted"],
+                "Attente moy. (s)": round(values["wait_total"] / values["granted"], 2) if values["granted"] else 0,
+                "Attente max (s)": round(values["wait_max"], 2)
+            } for priority, values in sorted(limiter_stats.items())]), use_container_width=True)
+        
+        history = get_vision_latency_history()
+        with history["lock"]:
+            hedge_calls, hedged_count, hedge_wins = history["calls"], history["hedged"], history["hedge_wins"]
+            hedge_cost = history["hedge_cost_usd"]
+            p99_primary = latency_percentile(history["primary"], 99)
+            p99_effective = latency_percentile(history["effective"], 99)
+            call_classes = list(history["samples"])
+        
+        st.write(f"**Hedging Vision :** {'activé' if VISION_HEDGING_ENABLED else 'désactivé'} "
+                 f"(p{VISION_HEDGE_PERCENTILE:.0f}, plafond {VISION_HEDGE_MAX_RATE*100:.0f}% des appels)")
+        for call_class in sorted(call_classes):
+            threshold = get_hedge_threshold(call_class)
+            if threshold is not None:
+                st.write(f"- Seuil {call_class} : {threshold:.1f}s")
+        st.write(f"- Requêtes de secours : {hedged_count}/{hedge_calls} "
+                 f"({(hedged_count / hedge_calls * 100) if hedge_calls else 0:.1f}%) | Gagnées par le secours : {hedge_wins} "
+                 f"| Coût des requêtes perdues : {hedge_cost:.4f} USD")
+        if hedged_count and p99_primary and p99_effective:
+            st.write(f"- p99 de la requête principale : {p99_primary:.1f}s → p99 effectif avec secours : {p99_effective:.1f}s")
+
+        fact_crop = st.session_state.fact_crop_info
+        if fact_crop:
+            call = fact_crop["call"]
+            agreement = ("identique à la lecture pleine page" if fact_crop["value"] == fact_crop["main_value"]
+                         else f"lecture pleine page : {fact_crop['main_value'] or '—'}")
+            st.write(f"**Numéro Fact (coin de l'en-tête) :** {fact_crop['value'] or 'non trouvé'} ({agreement}, "
+                     f"retenu : {fact_crop.get('retained') or '—'}) | "
+                     f"{call['latency']:.2f}s | {call['prompt_tokens'] + call['completion_tokens']} tokens | "
+                     f"{call['cost_usd']:.5f} USD")
+        fact_stats = get_fact_crop_stats()
+        with fact_stats["lock"]:
+            if fact_stats["calls"]:
+                st.write(f"- Lectures ciblées (toutes sessions) : {fact_stats['calls']} | Numéro trouvé : {fact_stats['found']} "
+                         f"| Désaccords avec la pleine page : {fact_stats['disagreements']} "
+                         f"| Latence moy. {fact_stats['latency_total'] / fact_stats['calls']:.2f}s "
+                         f"| Tokens moy. {fact_stats['tokens_total'] / fact_stats['calls']:.0f} "
+                         f"| Coût total {fact_stats['cost_usd']:.4f} USD"
+                         + (f" | Écartées (autres documents) : {fact_stats['discarded']}, "
+                            f"{fact_stats['discarded_cost_usd']:.4f} USD" if fact_stats["discarded"] else ""))
+
+        disambiguation = st.session_state.disambiguation_info
+        if disambiguation and disambiguation["lines"]:
+            call = disambiguation["call"]
+            st.write(f"**Lignes à faible confiance :** {disambiguation['lines']} | Envoyées : {disambiguation['sent']} "
+                     f"| En cache : {disambiguation['cached']} | Rapprochées par l'IA : {disambiguation['picked']}"
+                     + (f" | {call['latency']:.2f}s | {call['prompt_tokens'] + call['completion_tokens']} tokens "
+                        f"| {call['cost_usd']:.5f} USD" if call else ""))
+        disambiguation_cache = get_disambiguation_cache()
+        with disambiguation_cache["lock"]:
+            if disambiguation_cache["calls"]:
+                st.write(f"- Requêtes groupées (toutes sessions) : {disambiguation_cache['calls']} "
+                         f"| Lignes envoyées : {disambiguation_cache['lines_sent']} "
+                         f"| Rapprochées : {disambiguation_cache['lines_picked']} "
+                         f"| Servies par le cache : {disambiguation_cache['lines_cached']} "
+                         f"| Coût total {disambiguation_cache['cost_usd']:.4f} USD")
+
+        quality_summary = get_quality_gate_summary()
+        st.write(f"**Contrôle qualité photo :** {quality_summary['checked']} contrôles "
+                 f"({quality_summary['avg_duration'] * 1000:.0f} ms en moyenne) | Rejets : {quality_summary['rejected']} "
+                 f"| Analyses forcées : {quality_summary['overridden']} "
+                 f"| Appels IA évités : {max(0, quality_summary['rejected'] - quality_summary['overridden'])}")
+        if quality_summary["reasons"]:
+            st.write("- Motifs : " + ", ".join(f"{QUALITY_ISSUE_LABELS.get(issue, issue)} : {count}"
+                                               for issue, count in quality_summary["reasons"].items()))
+
+        sheets_handles = get_sheets_handles()
+        with sheets_handles["lock"]:
+            st.write(f"**Google Sheets :** {'connecté' if sheets_handles['spreadsheet'] is not None else 'non connecté'} "
+                     f"| Autorisations : {sheets_handles['authorizations']} "
+                     f"| Lectures de la liste des feuilles : {sheets_handles['metadata_fetches']} "
+                     f"| Réutilisations du cache : {sheets_handles['reuses']} "
+                     f"| Invalidations : {sheets_handles['invalidations']}")
+        sheets_quota = get_sheets_quota()
+        with sheets_quota["condition"]:
+            for bucket in sheets_quota["buckets"].values():
+                refill_sheets_bucket(bucket)
+            quota_state = {kind: (bucket["tokens"], dict(sheets_quota["stats"][kind]))
+                           for kind, bucket in sheets_quota["buckets"].items()}
+        for kind, (tokens, values) in quota_state.items():
+            st.write(f"- Quota {SHEETS_QUOTA_KIND_LABELS[kind].lower()} "
+                     f"({SHEETS_READ_QUOTA if kind == 'read' else SHEETS_WRITE_QUOTA}/min) : {values['calls']} appel(s) "
+                     f"| Disponible : {max(tokens, 0):.1f} | Attentes : {values['waits']} "
+                     f"(moy. {values['wait_total'] / values['calls'] if values['calls'] else 0:.2f}s, max {values['wait_max']:.2f}s) "
+                     f"| Réponses 429/5xx : {values['throttled']} | Nouveaux essais : {values['retries']}")
+        if SHEETS_WRITE_BEHIND:
+            outbox_worker = get_sheets_outbox_worker()
+            st.write(f"- Envoi en arrière-plan : {outbox_worker['jobs_sent']} export(s), {outbox_worker['rows_sent']} ligne(s) "
+                     f"en {outbox_worker['appends']} ajout(s) groupé(s) sur {outbox_worker['batches']} passage(s)"
+                     + (f" | Dernière erreur : {outbox_worker['last_error']}" if outbox_worker["last_error"] else ""))
+        duplicate_indexes = get_duplicate_indexes()
+        with duplicate_indexes["lock"]:
+            indexed_sheets = dict(duplicate_indexes["sheets"])
+        for gid, index in indexed_sheets.items():
+            with index["lock"]:
+                st.write(f"- Index des doublons (GID {gid}) : {len(index['rows'])} lignes | "
+                         f"Relectures complètes : {index['full_syncs']} | Lectures incrémentales : {index['incremental_reads']} "
+                         f"| Mises à jour locales : {index['local_updates']} "
+                         f"| Dernière resynchronisation il y a {time.time() - index['synced_at']:.0f}s")
+
+        breaker = get_vision_circuit_breaker()
+        with breaker["lock"]:
+            st.write(f"**Disjoncteur Vision :** {breaker['state']} | Échecs consécutifs : {breaker['failures']}"
+                     f"/{VISION_BREAKER_FAILURE_THRESHOLD} | Ouvertures : {breaker['opened_count']} "
+                     f"| Appels refusés sans attente : {breaker['rejected']}")
+    
     st.markdown('<div class="success-box fade-in">', unsafe_allow_html=True)
     st.markdown(f'''
     <div style="display: flex; align-items: start; gap: 15px;">
@@ -3238,6 +6799,44 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
     </div>
     ''', unsafe_allow_html=True)
     
+    missing_fields = detect_missing_fields(result)
+    if missing_fields and st.session_state.processed_image_bytes:
+        st.warning(f"⚠️ Champs manquants ou invalides : {', '.join(missing_fields)}")
+        col_repair, col_crop = st.columns([2, 1])
+        with col_crop:
+            use_header_crop = st.checkbox("Entête uniquement", value=True, key="repair_header_crop",
+                                          help="N'envoie que le haut du document (moins coûteux)")
+        with col_repair:
+            if st.button("🩹 Compléter les champs manquants",
+                        key="repair_fields_button",
+                        use_container_width=True,
+                        help="Redemande uniquement ces champs à l'IA, sans réanalyser tout le document"):
+                with st.spinner("🩹 Recherche des champs manquants..."):
+                    try:
+                        repaired, repair_info = repair_missing_fields(
+                            st.session_state.processed_image_bytes, result, missing_fields, use_header_crop
+                        )
+                        st.session_state.ocr_result = repaired
+                        st.session_state.field_repair_info = repair_info
+                        # Les champs de saisie doivent reprendre les nouvelles valeurs
+                        for widget_key in DOCUMENT_FIELD_WIDGET_KEYS:
+                            st.session_state.pop(widget_key, None)
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"❌ Erreur lors de la réparation des champs: {str(e)}")
+    
+    repair_info = st.session_state.field_repair_info
+    if repair_info and repair_info.get("call"):
+        call = repair_info["call"]
+        full_calls = (st.session_state.vision_cascade or {}).get("tiers", [])
+        full_cost = sum(c["cost_usd"] for c in full_calls)
+        cost_share = f" ({call['cost_usd'] / full_cost * 100:.0f}% d'une analyse complète)" if full_cost else ""
+        if repair_info["filled"]:
+            st.success(f"🩹 Champs complétés : {', '.join(repair_info['filled'])} — "
+                       f"{call['latency']:.1f}s, {call['cost_usd']:.4f} USD{cost_share}")
+        else:
+            st.info(f"🩹 Aucun champ trouvé par la requête ciblée — {call['cost_usd']:.4f} USD{cost_share}")
+    
     st.markdown('</div>', unsafe_allow_html=True)
     
     # ========================================================
@@ -3299,6 +6898,12 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
                 "Auto": st.column_config.CheckboxColumn(
                     "Auto",
                     help="Standardisé automatiquement par l'IA"
+                ),
+                "Source": st.column_config.TextColumn(
+                    "Source",
+                    width="small",
+                    disabled=True,
+                    help="Catalogue : rapprochement local | IA (texte) : choisi par la requête groupée, à vérifier | À vérifier : aucun produit sûr"
                 )
             },
             use_container_width=True,
@@ -3374,7 +6979,8 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
                         "Auto": confidence >= 0.7
                     })
             
-            st.session_state.edited_standardized_df = pd.DataFrame(new_data)
+            frames, st.session_state.disambiguation_info = disambiguate_low_confidence_rows([pd.DataFrame(new_data)])
+            st.session_state.edited_standardized_df = frames[0]
             st.rerun()
         
         st.markdown('</div>', unsafe_allow_html=True)
@@ -3456,8 +7062,21 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
                     key="export_button",
                     help="Cliquez pour exporter les données vers le cloud"):
             
-            st.session_state.export_triggered = True
-            st.rerun()
+            if SHEETS_WRITE_BEHIND or st.session_state.sheets_batch_mode:
+                # Aucune attente réseau : doublons et envoi sont traités par le thread d'envoi
+                if enqueue_document_export(doc_type, st.session_state.data_for_sheets,
+                                           st.session_state.edited_standardized_df.copy(),
+                                           held=st.session_state.sheets_batch_mode) is None:
+                    st.warning("⚠️ Aucune donnée à enregistrer (toutes les lignes ont une quantité de 0)")
+                else:
+                    st.session_state.export_status = "queued"
+                    st.rerun()
+            else:
+                st.session_state.export_triggered = True
+                st.rerun()
+    
+        st.checkbox("📦 Mode lot", key="sheets_batch_mode",
+                    help="Les documents exportés s'accumulent dans un lot, envoyé en une fois depuis « Synchronisation Google Sheets »")
     
     with col_info:
         st.markdown(f"""
@@ -3479,10 +7098,12 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
             ws = get_worksheet(normalized_doc_type)
             
             if ws:
+                st.session_state.sheet_snapshot = take_sheet_snapshot(ws)
                 duplicate_found, duplicates = check_for_duplicates(
                     normalized_doc_type,
                     st.session_state.data_for_sheets,
-                    ws
+                    ws,
+                    snapshot=st.session_state.sheet_snapshot
                 )
                 
                 if not duplicate_found:
@@ -3590,10 +7211,14 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
                 st.session_state.data_for_sheets,
                 export_df,
                 duplicate_action=st.session_state.duplicate_action,
-                duplicate_rows=st.session_state.duplicate_rows if st.session_state.duplicate_action == "overwrite" else None
+                duplicate_rows=st.session_state.duplicate_rows if st.session_state.duplicate_action == "overwrite" else None,
+                snapshot=st.session_state.sheet_snapshot
             )
+            st.session_state.sheet_snapshot = None
             
-            if success:
+            if success == SHEETS_EXPORT_QUEUED:
+                st.session_state.export_status = "queued"
+            elif success:
                 st.session_state.export_status = "completed"
                 st.markdown("""
                 <div style="padding: 25px; background: linear-gradient(135deg, #10B981 0%, #34D399 100%); color: white !important; border-radius: 18px; text-align: center; margin: 20px 0;">
@@ -3619,6 +7244,14 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
             st.error(f"❌ Erreur système : {str(e)}")
             st.session_state.export_status = "error"
     
+    if st.session_state.export_status == "queued":
+        if st.session_state.sheets_batch_mode:
+            st.info("📦 Document ajouté au lot : passez au document suivant, puis « Envoyer le lot » "
+                    "dans « Synchronisation Google Sheets ».")
+        else:
+            st.info("📤 Export enregistré dans la file d'envoi locale : vous pouvez passer au document suivant. "
+                    "Suivi dans « Synchronisation Google Sheets ».")
+    
     # ============================================================
     # BOUTONS DE NAVIGATION - AMÉLIORATION DU BOUTON "NOUVEAU DOCUMENT"
     # ============================================================
@@ -3628,7 +7261,11 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
         st.markdown('<div class="card">', unsafe_allow_html=True)
         st.markdown('<h4>🧭 Navigation</h4>', unsafe_allow_html=True)
         
-        col_nav1, col_nav2 = st.columns(2)
+        if st.session_state.replay_info:
+            st.info(f"⚡ Règles réappliquées localement en {st.session_state.replay_info['seconds'] * 1000:.0f} ms "
+                    f"({st.session_state.replay_info['articles']} articles, aucun appel OpenAI)")
+        
+        col_nav1, col_nav2, col_nav3 = st.columns(3)
         
         with col_nav1:
             if st.button("📄 Nouveau document", 
@@ -3636,26 +7273,14 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
                         type="secondary",
                         key="new_doc_main_nav",
                         help="Effacer toutes les informations et revenir au début"):
-                st.session_state.ocr_result = None
+                reset_document_session()
                 st.session_state.data_for_sheets = None
                 st.session_state.edited_standardized_df = None
-                st.session_state.product_matching_scores = {}
                 st.session_state.uploaded_file = None
                 st.session_state.uploaded_image = None
                 st.session_state.image_preview_visible = False
-                st.session_state.show_results = False
-                st.session_state.detected_document_type = None
-                st.session_state.duplicate_check_done = False
-                st.session_state.duplicate_found = False
-                st.session_state.duplicate_action = None
                 st.session_state.document_scanned = False
-                st.session_state.export_triggered = False
-                st.session_state.export_status = None
-                st.session_state.ocr_raw_text = None
-                st.session_state.document_analysis_details = {}
-                st.session_state.quartier_s2m = ""
-                st.session_state.nom_magasin_ulys = ""
-                st.session_state.fact_manuscrit = ""
+                st.session_state.image_quality = None
                 
                 st.markdown(
                     """
@@ -3689,6 +7314,18 @@ if st.session_state.show_results and st.session_state.ocr_result and not st.sess
                 st.session_state.product_matching_scores = {}
                 st.rerun()
         
+        with col_nav3:
+            if st.button("⚡ Réappliquer les règles",
+                        use_container_width=True,
+                        type="secondary",
+                        key="replay_main_nav",
+                        disabled=not st.session_state.ocr_replay,
+                        help="Rejouer le traitement local (clients, DOIT M, sous-type, standardisation) sur la réponse Vision enregistrée, sans nouvel appel"):
+                if replay_document_analysis():
+                    st.rerun()
+                else:
+                    st.warning("⚠️ Réponse Vision enregistrée illisible : utilisez « Réanalyser »")
+        
         st.markdown('</div>', unsafe_allow_html=True)
 
 # ============================================================
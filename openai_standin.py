@@ -0,0 +1,305 @@
+"""
+Serveur local compatible OpenAI pour les tests hors-ligne et les essais de charge
+
+Rejoue les réponses enregistrées (clé = SHA-256 du modèle, du prompt et de l'image) sur
+POST /v1/chat/completions, avec latence, erreurs (429/500/timeouts) et
+streaming configurables.
+
+Utilisation:
+    python openai_standin.py --port 8765 --recordings recordings/ \\
+        --latency lognormal:2.5,0.4 --error-429 0.05 --error-500 0.02 --timeouts 0.01
+
+Puis pointer l'application sur le serveur:
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=local streamlit run app_AI.py
+
+Les enregistrements se créent en lançant l'application contre la vraie API avec
+OPENAI_RECORD_DIR=recordings/ : chaque réponse est écrite dans <clé>.json. Les niveaux
+de la cascade (modèle rapide / complet) et les requêtes texte seules ont chacun leur clé.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+# ============================================================
+# RÉPONSE PAR DÉFAUT (REQUÊTE NON ENREGISTRÉE)
+# ============================================================
+DEFAULT_CONTENT = json.dumps({
+    "type_document": "BDC",
+    "document_subtype": "DLP",
+    "client": "DLP",
+    "adresse_livraison": "Leader Price Akadimbahoaka",
+    "fact_manuscrit_trouve": "oui",
+    "fact_manuscrit": "251193",
+    "numero": "251193",
+    "date": "15/01/2024",
+    "articles": [
+        {"article_brut": "COTE DE FIANAR ROUGE 75CL", "quantite": 12},
+        {"article_brut": "MAROPARASY BLANC DOUX 75CL", "quantite": 6}
+    ]
+}, ensure_ascii=False)
+
+# ============================================================
+# LATENCE CONFIGURABLE
+# ============================================================
+def parse_latency_spec(spec: str):
+    """
+    Construit un tirage de latence (secondes) à partir d'une spécification:
+    fixed:1.5 | uniform:0.5,3 | normal:2,0.5 | lognormal:median,sigma
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v.strip()]
+    kind = kind.strip().lower()
+
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: values[0] * random.lognormvariate(0.0, values[1])
+    raise ValueError(f"Spécification de latence inconnue: {spec}")
+
+# ============================================================
+# ENREGISTREMENTS
+# ============================================================
+def recording_key(model: str, prompt: str, image_bytes: Optional[bytes]) -> str:
+    """SHA-256 du modèle, du prompt et de l'image (même calcul que recording_key dans app_AI.py)"""
+    digest = hashlib.sha256()
+    for part in [model.encode("utf-8"), prompt.encode("utf-8"), image_bytes or b""]:
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+def find_recording_key(payload: Dict[str, Any]) -> str:
+    """Clé de la requête : modèle, texte du prompt et première image data: URL (absente pour une requête texte)"""
+    texts, image_bytes = [], None
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url" and image_bytes is None:
+                url = part.get("image_url", {}).get("url", "")
+                match = re.match(r'data:[^;]+;base64,(.*)', url, re.DOTALL)
+                if match:
+                    image_bytes = base64.b64decode(match.group(1))
+    return recording_key(payload.get("model", ""), "\n".join(texts), image_bytes)
+
+def load_recording(recordings_dir: Optional[str], key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Charge <clé>.json depuis le dossier d'enregistrements"""
+    if not recordings_dir or not key:
+        return None
+    path = os.path.join(recordings_dir, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def estimate_tokens(text: str) -> int:
+    """Estimation grossière du nombre de tokens (4 caractères par token)"""
+    return max(1, len(text) // 4)
+
+# ============================================================
+# SERVEUR HTTP
+# ============================================================
+class StandInHandler(BaseHTTPRequestHandler):
+    """Gestionnaire HTTP imitant /v1/chat/completions"""
+
+    server_version = "OpenAIStandIn/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.config["verbose"]:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _count(self, key: str):
+        with self.server.stats_lock:
+            self.server.stats[key] = self.server.stats.get(key, 0) + 1
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            with self.server.stats_lock:
+                self._send_json(200, dict(self.server.stats))
+        elif self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [
+                {"id": "gpt-4o", "object": "model"}, {"id": "gpt-4o-mini", "object": "model"}
+            ]})
+        else:
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        config = self.server.config
+        self._count("requests")
+
+        # Injection d'erreurs
+        roll = random.random()
+        if roll < config["timeouts"]:
+            self._count("timeouts")
+            time.sleep(config["timeout_seconds"])
+            self.close_connection = True
+            return
+        roll -= config["timeouts"]
+        if roll < config["error_429"]:
+            self._count("errors_429")
+            self._send_json(429, {"error": {"message": "Rate limit reached (stand-in)", "type": "rate_limit_exceeded"}},
+                            headers={"Retry-After": "1"})
+            return
+        roll -= config["error_429"]
+        if roll < config["error_500"]:
+            self._count("errors_500")
+            self._send_json(500, {"error": {"message": "Internal error (stand-in)", "type": "server_error"}})
+            return
+
+        recording = load_recording(config["recordings"], find_recording_key(payload))
+        if recording:
+            self._count("replayed")
+            content = recording.get("content", "")
+        else:
+            self._count("default")
+            content = config["default_content"]
+
+        if config["replay_latency"] and recording and recording.get("latency"):
+            delay = float(recording["latency"])
+        else:
+            delay = config["latency"]()
+
+        prompt_text = json.dumps(payload.get("messages", []))
+        usage = {
+            "prompt_tokens": estimate_tokens(re.sub(r'base64,[A-Za-z0-9+/=]+', '', prompt_text)) + 765,
+            "completion_tokens": estimate_tokens(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        model = payload.get("model", "gpt-4o")
+        completion_id = f"chatcmpl-standin-{uuid.uuid4().hex[:12]}"
+
+        if payload.get("stream"):
+            self._stream(completion_id, model, content, usage, delay,
+                         include_usage=bool((payload.get("stream_options") or {}).get("include_usage")))
+            return
+
+        time.sleep(delay)
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        })
+
+    def _stream(self, completion_id: str, model: str, content: str, usage: Dict[str, int],
+                delay: float, include_usage: bool):
+        """Envoie la réponse en Server-Sent Events, étalée sur la latence tirée"""
+        chunk_count = max(1, self.server.config["stream_chunks"])
+        size = max(1, len(content) // chunk_count + 1)
+        pieces = [content[i:i + size] for i in range(0, len(content), size)] or [""]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        def send_event(body: Any):
+            data = body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)
+            self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        send_event({**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+        for piece in pieces:
+            time.sleep(delay / len(pieces))
+            send_event({**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+        send_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if include_usage:
+            send_event({**base, "choices": [], "usage": usage})
+        send_event("[DONE]")
+
+def build_server(host: str, port: int, config: Dict[str, Any]) -> ThreadingHTTPServer:
+    """Crée le serveur (utilisable aussi depuis un script de benchmark)"""
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.stats = {}
+    server.stats_lock = threading.Lock()
+    return server
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Serveur local compatible OpenAI (rejeu des réponses Vision)")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--recordings", default="recordings", help="Dossier des réponses <clé>.json")
+    arg_parser.add_argument("--default-response", help="Fichier texte renvoyé pour les requêtes non enregistrées")
+    arg_parser.add_argument("--latency", default="fixed:0", help="fixed:s | uniform:a,b | normal:mu,sigma | lognormal:median,sigma")
+    arg_parser.add_argument("--replay-latency", action="store_true", help="Utiliser la latence enregistrée si disponible")
+    arg_parser.add_argument("--error-429", type=float, default=0.0, help="Proportion de réponses 429")
+    arg_parser.add_argument("--error-500", type=float, default=0.0, help="Proportion de réponses 500")
+    arg_parser.add_argument("--timeouts", type=float, default=0.0, help="Proportion de requêtes sans réponse")
+    arg_parser.add_argument("--timeout-seconds", type=float, default=120.0)
+    arg_parser.add_argument("--stream-chunks", type=int, default=20)
+    arg_parser.add_argument("--seed", type=int)
+    arg_parser.add_argument("--verbose", action="store_true")
+    args = arg_parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    default_content = DEFAULT_CONTENT
+    if args.default_response:
+        with open(args.default_response, encoding="utf-8") as f:
+            default_content = f.read()
+
+    config = {
+        "recordings": args.recordings,
+        "default_content": default_content,
+        "latency": parse_latency_spec(args.latency),
+        "replay_latency": args.replay_latency,
+        "error_429": args.error_429,
+        "error_500": args.error_500,
+        "timeouts": args.timeouts,
+        "timeout_seconds": args.timeout_seconds,
+        "stream_chunks": args.stream_chunks,
+        "verbose": args.verbose,
+    }
+
+    server = build_server(args.host, args.port, config)
+    print(f"🧪 Serveur OpenAI local sur http://{args.host}:{args.port}/v1 (enregistrements: {args.recordings})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()